@@ -1,10 +1,28 @@
 #define IN1 2
 #define IN2 3
 
+// Binary frame: sync bytes, then little endian sequence number (16 bits),
+// micros() timestamp (32 bits), position (32 bits) and CRC-16/CCITT-FALSE
+// of the sequence number, timestamp and position.
+#define FRAME_SYNC1 0xA5
+#define FRAME_SYNC2 0x5A
+#define MIN_RATE 1
+#define MAX_RATE 100
+
 int last_in1;
 int last_in2;
 int last_code;
-int pos = 0;
+volatile long pos = 0;
+
+// Text mode (one line per second) until the host asks for binary frames,
+// so older hosts keep working
+bool binary = false;
+unsigned long period_us = 1000000UL;
+unsigned long next_sample;
+unsigned int seq = 0;
+
+char cmd_buf[16];
+byte cmd_len = 0;
 
 int decode(int in1, int in2)
 {
@@ -58,10 +76,109 @@ void setup() {
 
   attachInterrupt(0, isr1, CHANGE);
   attachInterrupt(1, isr2, CHANGE);
+
+  next_sample = micros();
+}
+
+unsigned int crc16_update(unsigned int crc, byte data)
+{
+  crc ^= (unsigned int)data << 8;
+  for (byte i = 0; i < 8; i++)
+  {
+    if (crc & 0x8000)
+      crc = (crc << 1) ^ 0x1021;
+    else
+      crc <<= 1;
+  }
+  return crc;
+}
+
+void send_frame(long cur_pos, unsigned long timestamp)
+{
+  byte frame[14];
+  frame[0] = FRAME_SYNC1;
+  frame[1] = FRAME_SYNC2;
+  frame[2] = seq & 0xFF;
+  frame[3] = seq >> 8;
+  for (byte i = 0; i < 4; i++)
+  {
+    frame[4 + i] = (timestamp >> (8 * i)) & 0xFF;
+    frame[8 + i] = ((unsigned long)cur_pos >> (8 * i)) & 0xFF;
+  }
+  unsigned int crc = 0xFFFF;
+  for (byte i = 2; i < 12; i++)
+    crc = crc16_update(crc, frame[i]);
+  frame[12] = crc & 0xFF;
+  frame[13] = crc >> 8;
+  Serial.write(frame, sizeof(frame));
+  seq++;
+}
+
+// "BIN <rate>" switches to binary frames at rate per second and
+// "ASCII" back to text. Both are acknowledged with a line of text
+// before the first sample in the new mode.
+void handle_command(const char *cmd)
+{
+  if (strncmp(cmd, "BIN ", 4) == 0)
+  {
+    long rate = atol(cmd + 4);
+    if (rate < MIN_RATE || rate > MAX_RATE)
+    {
+      Serial.println("ERR");
+      return;
+    }
+    Serial.print("BIN ");
+    Serial.println(rate);
+    binary = true;
+    period_us = 1000000UL / rate;
+    next_sample = micros();
+  }
+  else if (strcmp(cmd, "ASCII") == 0)
+  {
+    Serial.println("ASCII");
+    binary = false;
+    period_us = 1000000UL;
+    next_sample = micros();
+  }
+}
+
+void poll_commands()
+{
+  while (Serial.available() > 0)
+  {
+    char c = Serial.read();
+    if (c == '\r' || c == '\n')
+    {
+      cmd_buf[cmd_len] = 0;
+      if (cmd_len > 0)
+        handle_command(cmd_buf);
+      cmd_len = 0;
+    }
+    else if (cmd_len < sizeof(cmd_buf) - 1)
+    {
+      cmd_buf[cmd_len++] = c;
+    }
+  }
 }
 
 void loop() {
-  delay(1000);
-  Serial.println(pos);
+  poll_commands();
+
+  unsigned long now = micros();
+  if ((long)(now - next_sample) < 0)
+    return;
+  next_sample += period_us;
+  // Skip ahead rather than bursting if sending fell behind
+  if ((long)(now - next_sample) >= 0)
+    next_sample = now + period_us;
+
+  noInterrupts();
+  long cur_pos = pos;
+  interrupts();
+
+  if (binary)
+    send_frame(cur_pos, now);
+  else
+    Serial.println(cur_pos);
 }
 
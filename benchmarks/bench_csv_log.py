@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_csv_log.py
+
+Compare write system calls and throughput of the original one row per
+write CSV log against the buffered, rotating CsvSink
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import csv
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filament_watch.sinks import CsvSink # pylint: disable=wrong-import-position
+
+class LegacyCsvLog(object):
+    '''The CSV log as originally written by main()'''
+    def __init__(self, path):
+        self.csv = open(path, 'w')
+        self.csv.write(','.join(CsvSink.field_names))
+        self.csv.write('\n')
+
+    def update(self, detection):
+        '''Write one row and flush it'''
+        stat = detection['stat']
+        fields = [
+            time.strftime('%H:%M:%S', time.localtime(detection['time'])),
+            detection['alarm'], stat['printing'], detection['valid'],
+            detection['pos'], detection['meas_change_norm'], stat['gcode_change'],
+            stat['summary'], stat['state'], stat['file_name'], stat['file_pos'],
+            stat['file_size'], stat['gcode_filament_pos'], stat['gcode_filament_total'],
+            stat['bed_target'], stat['bed_actual'], stat['tool0_target'], stat['tool0_actual']]
+        fields = [str(x) for x in fields]
+        self.csv.write(','.join(fields))
+        self.csv.write('\n')
+        self.csv.flush()
+
+    def close(self):
+        '''Close the log'''
+        self.csv.close()
+
+def detections(rows, start):
+    '''Detector results for a print reporting once a second'''
+    for row in range(rows):
+        stat = {
+            'printing': True, 'summary': 'Printing benchy.gcode, %d%%' % (row * 100 // rows),
+            'state': 'Printing', 'file_name': 'benchy.gcode', 'file_pos': row * 40,
+            'file_size': rows * 40, 'gcode_filament_pos': row * 0.5, 'gcode_filament_total': rows * 0.5,
+            'gcode_change': 0.52, 'bed_target': 60.0, 'bed_actual': 59.8,
+            'tool0_target': 210.0, 'tool0_actual': 209.6,
+        }
+        yield {
+            'time': start + row, 'alarm': False, 'valid': True, 'pos': row * 13,
+            'meas_change_raw': 13.0, 'meas_change_norm': 0.52, 'stat': stat,
+        }
+
+def write_syscalls():
+    '''Number of write system calls made by this process so far'''
+    with open('/proc/self/io') as io_file:
+        for line in io_file:
+            if line.startswith('syscw:'):
+                return int(line.split()[1])
+    return 0
+
+def measure(log, rows):
+    '''Return (seconds, write syscalls) to log rows detections and close'''
+    results = list(detections(rows, time.time()))
+    start_syscalls = write_syscalls()
+    start = time.time()
+    for detection in results:
+        log.update(detection)
+    log.close()
+    return time.time() - start, write_syscalls() - start_syscalls
+
+def main():
+    '''Run the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=86400, help='Rows to log (one per simulated second)')
+    parser.add_argument('--maxsize', type=float, default=10, help='CsvSink rotation size in MB')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        legacy_path = os.path.join(tmp_dir, 'legacy.csv')
+        sink_path = os.path.join(tmp_dir, 'sink.csv')
+        results = [
+            ('Original', legacy_path, measure(LegacyCsvLog(legacy_path), args.rows)),
+            ('CsvSink', sink_path, measure(CsvSink(sink_path, max_bytes=int(args.maxsize * 1024 * 1024)), args.rows)),
+        ]
+        print('%d rows, one per simulated second' % (args.rows))
+        print('Log         Seconds   Rows/s   Write syscalls   On disk (MB)   Bad rows')
+        for name, path, (seconds, syscalls) in results:
+            files = [path] + glob.glob(path + '.*')
+            on_disk = sum(os.path.getsize(name) for name in files)
+            with open(path, newline='') as csv_file:
+                bad_rows = sum(1 for row in csv.reader(csv_file) if len(row) != len(CsvSink.field_names))
+            print('%-10s %8.2f %8.0f %16d %14.2f %10d' % (name, seconds, args.rows / seconds, syscalls,
+                                                          on_disk / 1024.0 / 1024.0, bad_rows))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
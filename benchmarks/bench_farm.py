@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_farm.py
+
+Monitor a synthetic farm of printers from one process and measure CPU use,
+threads and detection latency as the number of printers grows. Each printer
+has a simulated encoder on a pseudo terminal and a stub OctoPrint server,
+both run in a separate process so only monitoring is measured.
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from filament_watch.filament_watch import PrinterMonitor, run_engines # pylint: disable=wrong-import-position
+from filament_watch.octoprint_ctl import create_session # pylint: disable=wrong-import-position
+from filament_watch.web_server import WebServer # pylint: disable=wrong-import-position
+from fake_encoder import FakeEncoderFirmware # pylint: disable=wrong-import-position
+from stub_octoprint import StubOctoPrint # pylint: disable=wrong-import-position
+from synthetic_gcode import generate # pylint: disable=wrong-import-position
+
+def simulate_farm(printers, encoder_rate, conn):
+    '''Child process: run a stub OctoPrint and a simulated encoder per
+    printer until told to stop'''
+    gcode = generate(256 * 1024)
+    stubs = []
+    encoders = []
+    for _ in range(printers):
+        stub = StubOctoPrint().start()
+        stub.gcode = gcode
+        stub.state = 'Printing'
+        stubs.append(stub)
+        encoders.append(FakeEncoderFirmware(counts_per_sec=50.0 * encoder_rate / 20).start())
+    conn.send([(stub.host, stub.api_key, encoder.dev) for stub, encoder in zip(stubs, encoders)])
+
+    def advance():
+        '''Move each print along so G-code extrusion is expected'''
+        while True:
+            for stub in stubs:
+                stub.file_pos = (stub.file_pos + 200) % len(gcode)
+            time.sleep(0.1)
+    thread = threading.Thread(target=advance)
+    thread.daemon = True
+    thread.start()
+    conn.recv()
+    for encoder in encoders:
+        encoder.stop()
+    for stub in stubs:
+        stub.stop()
+
+def printer_config(name, host, api_key, dev, encoder_rate):
+    '''Configuration of one simulated printer'''
+    return {
+        'name': name, 'dev': dev, 'baudrate': 115200, 'encoderrate': encoder_rate,
+        'apikey': api_key, 'octoprinthost': host,
+        'octoprintconnecttimeout': 3.05, 'octoprintreadtimeout': 10,
+        'octoprintconcurrent': 1, 'octoprintpush': 0, 'csvlog': None,
+        'alarmchangethreshold': 0.1, 'alarmminprinttime': 5, 'alarmaction': 'pause',
+        'encoderscalingfactor': 0.040, 'windowduration': 120,
+    }
+
+def poll_overview(url, stop):
+    '''Poll the farm overview like a browser would'''
+    session = requests.Session()
+    etag = None
+    while not stop.is_set():
+        reply = session.get(url, headers={'If-None-Match': etag} if etag else {})
+        etag = reply.headers.get('ETag')
+        stop.wait(1.0)
+
+def run_farm(printers, encoder_rate, port, warmup, duration): # pylint: disable=too-many-locals
+    '''Monitor a farm of the given size and return its measurements'''
+    parent_conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=simulate_farm, args=(printers, encoder_rate, child_conn))
+    child.start()
+    farm = parent_conn.recv()
+
+    names = ['printer%d' % (index + 1) for index in range(printers)]
+    session = create_session(hosts=printers)
+    web_server = WebServer(port, False, printer_names=names)
+    web_server.start()
+    executor = None
+    if printers > 1:
+        executor = ThreadPoolExecutor(max_workers=2 * printers, thread_name_prefix='octoprint')
+    monitors = [PrinterMonitor(printer_config(name, host, api_key, dev, encoder_rate), session, None,
+                               web_server.printer(name), executor)
+                for name, (host, api_key, dev) in zip(names, farm)]
+    stop = threading.Event()
+    poller = threading.Thread(target=poll_overview, args=('http://127.0.0.1:%d/gen_farm' % (port), stop))
+    poller.start()
+
+    async def measure():
+        '''Run the engines, measuring after the warm up period'''
+        task = asyncio.ensure_future(run_engines([monitor.engine for monitor in monitors], 3600))
+        await asyncio.sleep(warmup)
+        for monitor in monitors:
+            monitor.engine.latency.reset()
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        start = time.time()
+        await asyncio.sleep(duration)
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        elapsed = time.time() - start
+        threads = threading.active_count()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        cpu = (end_usage.ru_utime - start_usage.ru_utime) + (end_usage.ru_stime - start_usage.ru_stime)
+        return cpu / elapsed, threads
+
+    try:
+        cpu_fraction, threads = asyncio.run(measure())
+    finally:
+        stop.set()
+        poller.join()
+        for monitor in monitors:
+            monitor.stop()
+        web_server.stop()
+        if executor:
+            executor.shutdown()
+        parent_conn.send('stop')
+        child.join()
+
+    detections = [monitor.engine.latency.snapshot().get('detection') for monitor in monitors]
+    detections = [detection for detection in detections if detection]
+    statuses = [monitor.engine.latency.snapshot().get('status') for monitor in monitors]
+    statuses = [status for status in statuses if status]
+    reports = sum(detection['count'] for detection in detections)
+    return {
+        'printers': printers,
+        'encoder_rate': encoder_rate,
+        'cpu_percent': 100.0 * cpu_fraction,
+        'cpu_percent_per_printer': 100.0 * cpu_fraction / printers,
+        'threads': threads,
+        'reports_per_sec': reports / float(duration),
+        'detection_mean_ms': (sum(d['mean_ms'] * d['count'] for d in detections) / reports) if reports else None,
+        'detection_max_ms': max(d['max_ms'] for d in detections) if detections else None,
+        'status_mean_ms': (sum(s['mean_ms'] * s['count'] for s in statuses) /
+                           sum(s['count'] for s in statuses)) if statuses else None,
+    }
+
+def run_farm_process(queue, args):
+    '''Run one farm size in its own process, since CherryPy can only be
+    started once per process'''
+    queue.put(run_farm(*args))
+
+def main():
+    '''Run the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--printers', type=int, nargs='+', default=[1, 5, 10, 20, 40], help='Farm sizes to measure')
+    parser.add_argument('--encoderrate', type=int, default=20, help='Encoder samples per second per printer')
+    parser.add_argument('--port', type=int, default=18090, help='Web server port')
+    parser.add_argument('--warmup', type=float, default=5.0, help='Seconds to run before measuring')
+    parser.add_argument('--duration', type=float, default=20.0, help='Seconds to measure for')
+    parser.add_argument('--json', help='Write results to this file')
+    args = parser.parse_args()
+
+    results = []
+    print('Printers   CPU %   CPU %/printer   Threads   Reports/s   Detection ms (mean/max)   Status ms')
+    for printers in args.printers:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_farm_process,
+                                          args=(queue, (printers, args.encoderrate, args.port,
+                                                        args.warmup, args.duration)))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+        print('%8d %7.1f %15.2f %9d %11.1f %12.2f / %-10.1f %9.1f' % (
+            result['printers'], result['cpu_percent'], result['cpu_percent_per_printer'],
+            result['threads'], result['reports_per_sec'],
+            result['detection_mean_ms'] or 0, result['detection_max_ms'] or 0,
+            result['status_mean_ms'] or 0))
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_gcode_index.py
+
+Compare memory use and lookup latency of the sparse extrusion index against
+the dense 16 byte resolution table it replaced, and the speed of the bulk
+scanner, in one process and across several, against parsing line by line
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from filament_watch import gcode_index # pylint: disable=wrong-import-position
+from filament_watch.gcode_index import GcodeExtrusionParser, index_file # pylint: disable=wrong-import-position
+from gcode_corpus import corpus, index_result, line_index, scanned_index # pylint: disable=wrong-import-position
+from synthetic_gcode import generate # pylint: disable=wrong-import-position
+
+def dense_usage_table(gcode, resolution=16):
+    '''The table previously built by OctoPrintAccess.cache_file: one entry
+    for every resolution bytes of the file'''
+    usage = [None] * int((len(gcode) + 1) / resolution + 1)
+    total = 0
+    last_extrude = 0.0
+    file_pos = 0
+    usage[0] = total
+    for line in gcode.split(b'\n'):
+        file_pos += len(line) + 1
+        if line.startswith(b'G92 '):
+            for token in line.split(b' '):
+                if token[0:1] == b'E':
+                    last_extrude = float(token[1:])
+        if line.startswith(b'G1 '):
+            for token in line.split(b' '):
+                if token[0:1] == b'E':
+                    dist = float(token[1:])
+                    total += dist - last_extrude
+                    last_extrude = dist
+                    usage[int(file_pos / resolution)] = total
+    usage[int(file_pos / resolution)] = total
+    for idx in range(len(usage)):
+        if usage[idx] is None:
+            usage[idx] = usage[idx - 1]
+    return usage
+
+def sparse_index(gcode):
+    '''Build the sparse index by streaming the file in 64 KiB chunks'''
+    parser = GcodeExtrusionParser()
+    for pos in range(0, len(gcode), 64 * 1024):
+        parser.feed(gcode[pos:pos + 64 * 1024])
+    return parser.finish()
+
+def check_corpus():
+    '''Assert that the scanner matches parsing line by line exactly, with
+    and without NumPy and however the file is split into chunks'''
+    files = corpus()
+    for name, gcode in files.items():
+        expected = index_result(line_index, gcode)
+        for use_numpy in (True, False):
+            for chunk_size, scan_size in ((64 * 1024, None), (1000, 4096), (7, 50)):
+                assert index_result(scanned_index, gcode, use_numpy, chunk_size, scan_size) == expected, \
+                    'Scanner differs on %s (NumPy %s, %d byte chunks)' % (name, use_numpy, chunk_size)
+        with tempfile.NamedTemporaryFile(suffix='.gcode') as gcode_file:
+            gcode_file.write(gcode)
+            gcode_file.flush()
+            for processes, chunk_size in ((1, 16 * 1024 * 1024), (3, 1000)):
+                assert index_result(index_file, gcode_file.name, processes, chunk_size) == expected, \
+                    'index_file differs on %s (%d processes)' % (name, processes)
+    print('Scanner matches the line parser on %d files' % (len(files)))
+
+def throughput(func, gcode, *args):
+    '''MB/s of func(gcode), best of three runs'''
+    best = None
+    for _ in range(3):
+        start = time.time()
+        func(gcode, *args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(gcode) / 1024.0 / 1024.0 / best
+
+def measure_build(func, gcode):
+    '''Return the result of func(gcode) along with its retained memory'''
+    gc.collect()
+    tracemalloc.start()
+    result = func(gcode)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, retained
+
+def main():
+    '''Run the comparison'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=float, default=20, help='Size of synthetic G-code file')
+    parser.add_argument('--lookups', type=int, default=100000, help='Number of lookups to time')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes for parallel indexing (default: one per CPU)')
+    args = parser.parse_args()
+
+    check_corpus()
+
+    gcode = generate(int(args.size_mb * 1024 * 1024))
+    positions = [random.randrange(len(gcode)) for _ in range(args.lookups)]
+
+    dense, dense_mem = measure_build(dense_usage_table, gcode)
+    sparse, sparse_mem = measure_build(sparse_index, gcode)
+
+    dense_time = timeit.timeit(lambda: [dense[int(pos / 16)] for pos in positions], number=1)
+    sparse_time = timeit.timeit(lambda: [sparse.lookup(pos) for pos in positions], number=1)
+
+    print('File size:       %.1f MB' % (len(gcode) / 1024.0 / 1024.0))
+    print('Dense table:     %d entries, %.1f MB retained, %.2f us/lookup' % (
+        len(dense), dense_mem / 1024.0 / 1024.0, dense_time / args.lookups * 1e6))
+    print('Sparse index:    %d entries, %.1f MB retained, %.2f us/lookup' % (
+        len(sparse), sparse_mem / 1024.0 / 1024.0, sparse_time / args.lookups * 1e6))
+    del dense, sparse
+
+    line_speed = throughput(line_index, gcode)
+    print('Line by line:    %.1f MB/s' % (line_speed))
+    regex_speed = throughput(scanned_index, gcode, False)
+    print('Scanner (re):    %.1f MB/s, %.1fx' % (regex_speed, regex_speed / line_speed))
+    if gcode_index.numpy is not None:
+        numpy_speed = throughput(scanned_index, gcode)
+        print('Scanner (NumPy): %.1f MB/s, %.1fx' % (numpy_speed, numpy_speed / line_speed))
+
+    with tempfile.NamedTemporaryFile(suffix='.gcode') as gcode_file:
+        gcode_file.write(gcode)
+        gcode_file.flush()
+        file_speed = throughput(lambda _: index_file(gcode_file.name, 1), gcode)
+        print('File, 1 process: %.1f MB/s, %.1fx' % (file_speed, file_speed / line_speed))
+        parallel_speed = throughput(lambda _: index_file(gcode_file.name, args.processes), gcode)
+        print('File, %d processes: %.1f MB/s, %.1fx' % (
+            args.processes, parallel_speed, parallel_speed / line_speed))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_history_store.py
+
+Measure HistoryStore ingest and query throughput for months of 1 Hz
+detector results
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filament_watch.history_store import HistoryStore # pylint: disable=wrong-import-position
+
+def detections(days, start, print_hours=4, idle_hours=2):
+    '''Detector results once a second: prints of print_hours separated by
+    idle_hours'''
+    cycle = (print_hours + idle_hours) * 3600
+    stat = {'file_name': 'benchy.gcode', 'gcode_change': 0.52, 'file_pos': 0, 'printing': False}
+    printing_stat = dict(stat, printing=True)
+    detection = {'alarm': False, 'meas_change_norm': 0.5}
+    for second in range(int(days * 86400)):
+        detection = dict(detection, time=start + second, pos=second,
+                         stat=printing_stat if second % cycle < print_hours * 3600 else stat)
+        yield detection
+
+def timed(func, repeat):
+    '''Mean seconds per call of func'''
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+def main():
+    '''Run the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=float, default=90, help='Days of 1 Hz results to ingest')
+    parser.add_argument('--queries', type=int, default=50, help='Number of times to run each query')
+    parser.add_argument('--points', type=int, default=1000, help='Points per downsampled series')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'history.db')
+        store = HistoryStore(path, retention_days=0, batch_interval=1.0, batch_size=10000).start()
+        start_time = time.time() - args.days * 86400
+        rows = int(args.days * 86400)
+        start = time.time()
+        for detection in detections(args.days, start_time):
+            store.add('printer1', detection)
+        store.stop()
+        ingest = time.time() - start
+        size = sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in os.listdir(tmp_dir))
+        print('Ingested %d results (%.0f days) in %.1f s: %.0f results/s, %.0f MB on disk' % (
+            rows, args.days, ingest, rows / ingest, size / 1024.0 / 1024.0))
+
+        prints = store.prints('printer1', limit=1000000)
+        print_ids = [print_info['id'] for print_info in prints]
+        random.seed(1)
+        print('Query                                  ms')
+        print('%-35s %6.2f' % ('List the 50 latest prints', 1000 * timed(lambda: store.prints('printer1'), args.queries)))
+        print('%-35s %6.2f' % ('One 4 hour print (%d samples)' % (len(store.samples('printer1', print_ids[0]))),
+                               1000 * timed(lambda: store.samples('printer1', random.choice(print_ids)), args.queries)))
+
+        def hour():
+            '''Results of a random hour'''
+            hour_start = start_time + random.random() * (args.days * 86400 - 3600)
+            return store.samples('printer1', start=hour_start, end=hour_start + 3600)
+        print('%-35s %6.2f' % ('A random hour (3600 samples)', 1000 * timed(hour, args.queries)))
+
+        for method in ('lttb', 'minmax'):
+            print('%-35s %6.2f' % ('One 4 hour print, %s to %d' % (method, args.points),
+                                   1000 * timed(lambda: store.series('printer1', args.points, method,
+                                                                     random.choice(print_ids)), args.queries)))
+            for label, span in (('2 minutes', 120), ('1 hour', 3600), ('12 hours', 43200), ('7 days', 7 * 86400)):
+                def window():
+                    '''Downsampled series of a random window'''
+                    window_start = start_time + random.random() * (args.days * 86400 - span)
+                    return store.series('printer1', args.points, method, start=window_start, end=window_start + span)
+                print('%-35s %6.2f' % ('%s, %s to %d' % (label, method, args.points), 1000 * timed(window, args.queries)))
+
+        start = time.time()
+        deleted = store.expire(start_time + args.days * 86400 / 3)
+        print('Expired the oldest third (%d results) in %.1f s' % (deleted, time.time() - start))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
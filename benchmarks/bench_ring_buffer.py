@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_ring_buffer.py
+
+Compare the sliding window list (append + pop(0)) previously used for
+recent positions against TimeSeriesRing
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filament_watch.ring_buffer import TimeSeriesRing # pylint: disable=wrong-import-position
+
+def list_window(window, samples):
+    '''Previous implementation: prefilled list, append + pop(0) per sample'''
+    recent = [0] * window
+    change = 0
+    for pos in range(samples):
+        recent.append(pos)
+        recent.pop(0)
+        change = (recent[-1] - recent[0]) / len(recent)
+    return change
+
+def ring_window(window, samples):
+    '''TimeSeriesRing with the same prefill and window'''
+    recent = TimeSeriesRing(window)
+    recent.fill(0, 0.0)
+    change = 0
+    for pos in range(samples):
+        recent.append(pos, 0.0)
+        change = recent.rate(window)
+    return change
+
+def main():
+    '''Run the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=100000, help='Samples to append per run')
+    parser.add_argument('--windows', type=int, nargs='+', default=[120, 1800, 36000, 180000],
+                        help='Window lengths in samples (e.g. 36000 is 30 minutes at 20 Hz)')
+    args = parser.parse_args()
+
+    print('Window     List          Ring')
+    for window in args.windows:
+        assert list_window(window, 1000) == ring_window(window, 1000)
+        list_time = min(timeit.repeat(lambda: list_window(window, args.samples), number=1, repeat=3))
+        ring_time = min(timeit.repeat(lambda: ring_window(window, args.samples), number=1, repeat=3))
+        print('%-8d %7.2f us %9.2f us' % (window, list_time / args.samples * 1e6, ring_time / args.samples * 1e6))
+
+if __name__ == '__main__':
+    main()
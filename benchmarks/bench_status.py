@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_status.py
+
+Measure OctoPrintAccess.status() latency against a stub OctoPrint server
+with injected per-request latency, fetching sequentially and concurrently
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from filament_watch.octoprint_ctl import OctoPrintAccess # pylint: disable=wrong-import-position
+from stub_octoprint import StubOctoPrint # pylint: disable=wrong-import-position
+from synthetic_gcode import generate # pylint: disable=wrong-import-position
+
+def time_status(octoprint, polls):
+    '''Return the mean status() latency in seconds'''
+    start = time.time()
+    for _ in range(polls):
+        octoprint.status()
+    return (time.time() - start) / polls
+
+def main():
+    '''Run the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, nargs='+', default=[0.0, 0.05, 0.1, 0.3], help='Injected latency per request in seconds')
+    parser.add_argument('--polls', type=int, default=20, help='Number of status polls to time')
+    args = parser.parse_args()
+
+    stub = StubOctoPrint().start()
+    stub.gcode = generate(1024 * 1024)
+    stub.state = 'Printing'
+    stub.file_pos = len(stub.gcode) // 2
+
+    print('Latency   Sequential   Concurrent')
+    for latency in args.latency:
+        stub.latency = 0.0
+        sequential = OctoPrintAccess(stub.host, stub.api_key, 120, concurrent_status=False)
+        concurrent = OctoPrintAccess(stub.host, stub.api_key, 120, concurrent_status=True)
+        # Wait for the index so every poll does the same work
+        for octoprint in (sequential, concurrent):
+            while octoprint.status()['indexing']:
+                time.sleep(0.05)
+        stub.latency = latency
+        print('%5.0f ms %9.1f ms %10.1f ms' % (latency * 1000,
+                                               time_status(sequential, args.polls) * 1000,
+                                               time_status(concurrent, args.polls) * 1000))
+    stub.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_suite.py
+
+Benchmarks of the G-code indexing, status, encoder and web hot paths, with
+machine readable results
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cherrypy
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from filament_watch.microcontroller_if import ArduinoInterface # pylint: disable=wrong-import-position
+from filament_watch.octoprint_ctl import OctoPrintAccess # pylint: disable=wrong-import-position
+from filament_watch.web_server import WebServer # pylint: disable=wrong-import-position
+from fake_encoder import FakeEncoderFirmware # pylint: disable=wrong-import-position
+from stub_octoprint import StubOctoPrint # pylint: disable=wrong-import-position
+from synthetic_gcode import generate # pylint: disable=wrong-import-position
+
+BENCHMARKS = ('cache_file', 'measure_filament', 'status', 'get_pos_change', 'gen_change')
+
+def progress(msg):
+    '''Report progress without mixing it into the results'''
+    sys.stderr.write(msg + '\n')
+    sys.stderr.flush()
+
+def percentiles(times, scale=1.0):
+    '''Mean, median, 99th percentile and maximum of a list of durations'''
+    times = sorted(times)
+    return {
+        'count': len(times),
+        'mean': scale * sum(times) / len(times),
+        'p50': scale * times[len(times) // 2],
+        'p99': scale * times[min(len(times) - 1, int(len(times) * 0.99))],
+        'max': scale * times[-1],
+    }
+
+def synthetic_gcode(size, block_size=16 * 1024 * 1024):
+    '''size bytes of synthetic G-code. Large files repeat one block, which
+    is much quicker than generating them and parses at the same speed.'''
+    block = b'G92 E0\n' + generate(min(size, block_size))
+    if len(block) >= size:
+        return block
+    return (block * (size // len(block) + 1))[:size]
+
+def version_info():
+    '''What was measured, so results can be compared between versions'''
+    repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    try:
+        commit = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=repo,
+                                         stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+def wait_for_index(octoprint, file_name):
+    '''Index file_name with cache_file, returning the seconds it took'''
+    start = time.time()
+    while octoprint.cache_file(file_name) is not None:
+        time.sleep(0.005)
+    return time.time() - start
+
+def bench_cache_file(stub, sizes_mb, index_processes=1):
+    '''Index speed of OctoPrintAccess.cache_file, downloading the file and
+    reading it from a local uploads folder. Returns the results and the
+    OctoPrintAccess holding the largest index.'''
+    results = []
+    octoprint = None
+    uploads_dir = tempfile.mkdtemp(prefix='bench_uploads')
+    try:
+        for size_mb in sizes_mb:
+            stub.gcode = synthetic_gcode(int(size_mb * 1024 * 1024))
+            # A new file name, so nothing is reused from the previous size
+            stub.file_name = 'bench%g.gcode' % (size_mb)
+            octoprint = OctoPrintAccess(stub.host, stub.api_key, 120)
+            seconds = wait_for_index(octoprint, stub.file_name)
+
+            local_path = os.path.join(uploads_dir, stub.file_name)
+            with open(local_path, 'wb') as gcode_file:
+                gcode_file.write(stub.gcode)
+            local = OctoPrintAccess(stub.host, stub.api_key, 120, uploads_dir=uploads_dir,
+                                    index_processes=index_processes)
+            local_seconds = wait_for_index(local, stub.file_name)
+            os.remove(local_path)
+
+            result = {
+                'size_mb': len(stub.gcode) / 1024.0 / 1024.0,
+                'seconds': seconds,
+                'mb_per_sec': len(stub.gcode) / 1024.0 / 1024.0 / seconds,
+                'local_seconds': local_seconds,
+                'local_mb_per_sec': len(stub.gcode) / 1024.0 / 1024.0 / local_seconds,
+                'index_processes': index_processes,
+                'index_entries': len(octoprint.gcode_index),
+            }
+            progress('cache_file %7.1f MB: %6.2f s, %6.1f MB/s downloaded, %6.1f MB/s local' % (
+                result['size_mb'], seconds, result['mb_per_sec'], result['local_mb_per_sec']))
+            results.append(result)
+    finally:
+        os.rmdir(uploads_dir)
+    return results, octoprint
+
+def bench_measure_filament(octoprint, file_size, lookups):
+    '''Latency of OctoPrintAccess.measure_filament at random file positions'''
+    rng = random.Random(1)
+    positions = [rng.randrange(file_size) for _ in range(lookups)]
+    measure = octoprint.measure_filament
+    start = time.perf_counter()
+    for file_pos in positions:
+        measure(file_pos)
+    mean = (time.perf_counter() - start) / lookups
+    times = []
+    clock = time.perf_counter
+    for file_pos in positions[:min(lookups, 100000)]:
+        call_start = clock()
+        measure(file_pos)
+        times.append(clock() - call_start)
+    result = percentiles(times, 1e6)
+    # The batch mean excludes the overhead of timing each call
+    result['mean'] = mean * 1e6
+    result['unit'] = 'us'
+    result['index_entries'] = len(octoprint.gcode_index)
+    progress('measure_filament: %.2f us mean, %.2f us p99 over %d index entries' % (
+        result['mean'], result['p99'], result['index_entries']))
+    return result
+
+def bench_status(stub, polls):
+    '''Latency of OctoPrintAccess.status against the stub while printing an
+    indexed file, fetching printer and job status sequentially and
+    concurrently'''
+    stub.gcode = synthetic_gcode(1024 * 1024)
+    stub.file_name = 'status.gcode'
+    stub.file_pos = len(stub.gcode) // 2
+    results = {}
+    for mode, concurrent in (('sequential', False), ('concurrent', True)):
+        octoprint = OctoPrintAccess(stub.host, stub.api_key, 120, concurrent_status=concurrent)
+        while octoprint.status()['indexing']:
+            time.sleep(0.05)
+        times = []
+        for _ in range(polls):
+            start = time.perf_counter()
+            octoprint.status()
+            times.append(time.perf_counter() - start)
+        results[mode] = percentiles(times, 1000.0)
+        results[mode]['unit'] = 'ms'
+        progress('status %s: %.2f ms mean, %.2f ms p99' % (mode, results[mode]['mean'], results[mode]['p99']))
+    return results
+
+def write_frames(fd, data, chunk_size=4096):
+    '''Write data to a blocking file descriptor in chunks'''
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view[:chunk_size])
+        view = view[written:]
+
+def bench_get_pos_change(frames, sample_rate=100):
+    '''Rate at which ArduinoInterface.get_pos_change decodes binary frames
+    arriving over a pty as fast as they can be written'''
+    firmware = FakeEncoderFirmware().start()
+    interface = None
+    try:
+        interface = ArduinoInterface(firmware.dev, 115200, 120, sample_rate)
+        if not interface.sample_rate:
+            raise RuntimeError('Binary frames were not negotiated')
+        # Take over from the firmware loop and send a burst of frames with
+        # sample_rate timestamps
+        firmware.running = False
+        firmware.thread.join()
+        os.set_blocking(firmware.master, True)
+        interface.read_timeout = 0.5
+        while interface.get_pos_change() != [None, None]:
+            pass
+        burst = b''.join(firmware.frame(index / float(sample_rate)) for index in range(frames))
+        decoded_before = interface.reader.decoder.frames
+        writer = threading.Thread(target=write_frames, args=(firmware.master, burst))
+        start = time.perf_counter()
+        writer.start()
+        reports = 0
+        last_report = start
+        while True:
+            pos, _ = interface.get_pos_change()
+            if pos is None:
+                break
+            reports += 1
+            last_report = time.perf_counter()
+        writer.join()
+        seconds = last_report - start
+        decoded = interface.reader.decoder.frames - decoded_before
+        counters = interface.counters.snapshot()
+        result = {
+            'frames': frames,
+            'decoded': decoded,
+            'reports': reports,
+            'seconds': seconds,
+            'frames_per_sec': decoded / seconds if seconds else None,
+            'mb_per_sec': len(burst) * decoded / float(frames) / 1024.0 / 1024.0 / seconds if seconds else None,
+            'dropped': counters.get('dropped', 0),
+            'crc_errors': counters.get('crc_errors', 0),
+        }
+    finally:
+        if interface is not None:
+            interface.stop()
+        firmware.running = False
+        firmware.stop()
+    progress('get_pos_change: %d frames in %.2f s, %.0f frames/s, %d dropped' % (
+        result['decoded'], result['seconds'], result['frames_per_sec'] or 0, result['dropped']))
+    return result
+
+def poll_gen_change(url, clients, duration, queue):
+    '''Client process: poll gen_change like dashboards would, from clients
+    threads, as fast as the server answers'''
+    stop = threading.Event()
+    results = []
+
+    def client():
+        '''One dashboard'''
+        session = requests.Session()
+        since = None
+        log_since = None
+        times = []
+        errors = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                reply = session.get(url, params={'since': since, 'log_since': log_since}, timeout=30)
+                data = reply.json()
+                since, log_since = data['seq'], data['log_seq']
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                errors += 1
+                continue
+            times.append(time.perf_counter() - start)
+        results.append((times, errors))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    queue.put(([duration for times, _ in results for duration in times], sum(errors for _, errors in results)))
+
+def bench_gen_change(port, client_counts, duration):
+    '''Requests per second served by gen_change to N polling clients while
+    the dashboard is updated once a second'''
+    web_server = WebServer(port, False)
+    web_server.start()
+    stop = threading.Event()
+
+    def publish():
+        '''Feed the dashboard like WebSink does'''
+        pos = 0
+        while not stop.is_set():
+            pos += 25
+            chart_time = time.time() * 1000
+            web_server.update({
+                'gcode': [chart_time, 1.0], 'actual': [chart_time, 1.0], 'alarm': False,
+                'printing': True, 'valid': True, 'time_to_valid': 0, 'filament_pos': pos,
+                'summary': 'Printing bench.gcode - 50%', 'file_pos': pos * 10,
+                'bed_target': 60.0, 'bed_actual': 60.0, 'tool0_target': 210.0, 'tool0_actual': 210.0,
+            })
+            if pos % 250 == 0:
+                web_server.log('Benchmark log message %d' % (pos))
+            stop.wait(1.0)
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+
+    url = 'http://127.0.0.1:%d/gen_change' % (port)
+    # The clients must not share this process's interpreter lock
+    context = multiprocessing.get_context('spawn')
+    results = []
+    try:
+        for clients in client_counts:
+            queue = context.Queue()
+            process = context.Process(target=poll_gen_change, args=(url, clients, duration, queue))
+            process.start()
+            times, errors = queue.get()
+            process.join()
+            result = percentiles(times, 1000.0) if times else {'count': 0}
+            result.update({
+                'clients': clients,
+                'unit': 'ms',
+                'requests_per_sec': len(times) / duration,
+                'errors': errors,
+            })
+            progress('gen_change %3d clients: %7.0f requests/s, %.2f ms p99, %d errors' % (
+                clients, result['requests_per_sec'], result.get('p99', 0), errors))
+            results.append(result)
+    finally:
+        stop.set()
+        publisher.join()
+        web_server.stop()
+        cherrypy.engine.exit()
+    return results
+
+def main():
+    '''Run the benchmarks and write their results as JSON'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help='Benchmarks to run')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 10, 100, 500],
+                        help='Sizes of synthetic G-code to index in MB')
+    parser.add_argument('--indexprocesses', type=int, default=1,
+                        help='Processes to index files in the local uploads folder in (0 for one per CPU)')
+    parser.add_argument('--lookups', type=int, default=1000000, help='measure_filament calls to time')
+    parser.add_argument('--polls', type=int, default=500, help='status calls to time')
+    parser.add_argument('--frames', type=int, default=200000, help='Encoder frames to decode')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16, 64],
+                        help='Numbers of gen_change clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to poll gen_change for')
+    parser.add_argument('--port', type=int, default=18091, help='Web server port')
+    parser.add_argument('--output', help='Write results to this file rather than standard output')
+    args = parser.parse_args()
+
+    results = {'version': version_info()}
+    stub = StubOctoPrint().start()
+    stub.state = 'Printing'
+    try:
+        if 'cache_file' in args.benchmarks or 'measure_filament' in args.benchmarks:
+            sizes = args.sizes if 'cache_file' in args.benchmarks else [max(args.sizes)]
+            cache_file, octoprint = bench_cache_file(stub, sizes, args.indexprocesses or None)
+            if 'cache_file' in args.benchmarks:
+                results['cache_file'] = cache_file
+            if 'measure_filament' in args.benchmarks:
+                results['measure_filament'] = bench_measure_filament(octoprint, len(stub.gcode), args.lookups)
+            stub.gcode = b''
+        if 'status' in args.benchmarks:
+            results['status'] = bench_status(stub, args.polls)
+    finally:
+        stub.stop()
+    if 'get_pos_change' in args.benchmarks:
+        results['get_pos_change'] = bench_get_pos_change(args.frames)
+    if 'gen_change' in args.benchmarks:
+        results['gen_change'] = bench_gen_change(args.port, args.clients, args.duration)
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+            json_file.write('\n')
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fake_encoder.py
+
+Simulated encoder firmware on a pseudo terminal, speaking the same text and
+binary protocols as arduino/filament_watch/filament_watch.ino
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import binascii
+import os
+import pty
+import struct
+import threading
+import time
+import tty
+
+class FakeEncoderFirmware(object): # pylint: disable=too-many-instance-attributes
+    '''Sends one text position per second until asked for binary frames,
+    like the real firmware. The filament advances counts_per_sec encoder
+    counts per second while feeding is True. dev is the device to open.'''
+    def __init__(self, counts_per_sec=100.0, binary=True):
+        self.counts_per_sec = counts_per_sec
+        self.feeding = True
+        # False simulates firmware older than the binary protocol
+        self.binary_supported = binary
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.dev = os.ttyname(self.slave)
+        self.binary = False
+        self.period = 1.0
+        self.seq = 0
+        self.pos = 0.0
+        self.frames_sent = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        '''Start sending samples'''
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop sending samples and close the pseudo terminal'''
+        self.running = False
+        if self.thread:
+            self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def handle_command(self, line):
+        '''Act on a line sent by the host'''
+        if line.startswith(b'BIN ') and self.binary_supported:
+            rate = int(line[4:])
+            os.write(self.master, b'BIN %d\r\n' % rate)
+            self.binary = True
+            self.period = 1.0 / rate
+        elif line == b'ASCII' and self.binary_supported:
+            os.write(self.master, b'ASCII\r\n')
+            self.binary = False
+            self.period = 1.0
+
+    def frame(self, timestamp):
+        '''Encode one binary sample'''
+        body = struct.pack('<HIi', self.seq & 0xffff, int(timestamp * 1e6) & 0xffffffff, int(self.pos))
+        self.seq += 1
+        return b'\xa5\x5a' + body + struct.pack('<H', binascii.crc_hqx(body, 0xffff))
+
+    def run(self):
+        '''Firmware main loop'''
+        os.set_blocking(self.master, False)
+        start = time.time()
+        next_sample = start
+        line = b''
+        while self.running:
+            try:
+                line += os.read(self.master, 256)
+            except (BlockingIOError, OSError):
+                pass
+            while b'\n' in line:
+                cmd, line = line.split(b'\n', 1)
+                self.handle_command(cmd.strip())
+
+            now = time.time()
+            if now >= next_sample:
+                if self.feeding:
+                    self.pos += self.counts_per_sec * self.period
+                try:
+                    if self.binary:
+                        os.write(self.master, self.frame(now - start))
+                    else:
+                        os.write(self.master, b'%d\r\n' % int(self.pos))
+                    self.frames_sent += 1
+                except (BlockingIOError, OSError):
+                    pass
+                next_sample += self.period
+                if next_sample < now:
+                    next_sample = now + self.period
+            time.sleep(min(0.01, max(0.0, next_sample - time.time())))
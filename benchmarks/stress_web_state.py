@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+stress_web_state.py
+
+Hammer the published web state from many reader threads while the writer
+publishes as fast as it can, checking every reply for torn reads
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+
+from filament_watch.web_server import WebGen # pylint: disable=wrong-import-position
+from web_state_reader import reader # pylint: disable=wrong-import-position
+
+def main():
+    '''Run the stress test'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=32, help='Number of reader threads')
+    parser.add_argument('--seconds', type=float, default=5.0, help='Duration of the test')
+    parser.add_argument('--history', type=int, default=120, help='History length')
+    args = parser.parse_args()
+
+    webgen = WebGen(args.history, 5)
+    stop = threading.Event()
+    results = []
+    threads = [threading.Thread(target=reader, args=(webgen, args.history, stop, results))
+               for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+
+    seq = 0
+    log_seq = 0
+    publish_times = []
+    end = time.time() + args.seconds
+    while time.time() < end:
+        start = time.time()
+        seq += 1
+        webgen.update({'filament_pos': seq}, [seq, 1.0], [seq, 2.0])
+        if seq % 7 == 0:
+            log_seq += 1
+            webgen.add_log('%d log message' % (log_seq))
+        publish_times.append(time.time() - start)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    reads = sum(result[0] for result in results)
+    errors = [error for result in results for error in result[1]]
+    publish_times.sort()
+    print('%d publishes, %d reads by %d readers' % (seq, reads, args.readers))
+    # With CPU-bound readers the writer mostly waits for the GIL, not for
+    # the readers themselves
+    print('Publish time median %.3f ms, 99th percentile %.3f ms' % (
+        publish_times[len(publish_times) // 2] * 1000,
+        publish_times[int(len(publish_times) * 0.99)] * 1000))
+    if errors:
+        print('%d inconsistent reads, e.g. %s' % (len(errors), errors[0]))
+        sys.exit(1)
+    print('No torn reads')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+stub_octoprint.py
+
+Minimal stand-in for the OctoPrint REST API and SockJS push socket, with
+injectable latency
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import json
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Serve the subset of the OctoPrint API used by filament_watch'''
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one segment to avoid delayed ACK stalls
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args): # pylint: disable=arguments-differ
+        pass
+
+    def authorized(self):
+        '''Check the API key passed in the header or query string'''
+        query = parse_qs(urlparse(self.path).query)
+        key = self.headers.get('X-Api-Key') or query.get('apikey', [None])[0]
+        return key == self.server.api_key
+
+    def send(self, code, body, content_type='application/json'):
+        '''Send a complete response'''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        '''Handle GET requests'''
+        stub = self.server
+        path = urlparse(self.path).path
+        stub.record(path)
+        time.sleep(stub.latency)
+        if not self.authorized():
+            self.send(403, 'Invalid API key', 'text/plain')
+        elif path == '/api/printer':
+            if not stub.operational:
+                self.send(409, 'Printer is not operational', 'text/plain')
+            else:
+                self.send(200, json.dumps(stub.printer_json()))
+        elif path == '/api/job':
+            self.send(200, json.dumps(stub.job_json()))
+        elif path.startswith('/api/files/local/'):
+            name = path[len('/api/files/local/'):]
+            if name != stub.file_name:
+                self.send(404, 'Not found', 'text/plain')
+            else:
+                self.send(200, json.dumps(stub.file_json()))
+        elif path.startswith('/downloads/files/local/'):
+            self.send(200, stub.gcode, 'text/plain')
+        else:
+            self.send(404, 'Not found', 'text/plain')
+
+    def send_chunk(self, data):
+        '''Send one chunk of a chunked response'''
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def stream_push(self):
+        '''Serve a SockJS xhr_streaming session, pushing a "current" message
+        every push_interval seconds'''
+        stub = self.server
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript; charset=UTF-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            self.send_chunk(b'h' * 2048 + b'\n')
+            self.send_chunk(b'o\n')
+            while stub.push_enabled:
+                message = json.dumps({'current': stub.current_json()})
+                self.send_chunk(b'a' + json.dumps([message]).encode('utf-8') + b'\n')
+                time.sleep(stub.push_interval)
+            self.send_chunk(b'c[3000,"Go away!"]\n')
+            self.send_chunk(b'')
+        except (IOError, OSError):
+            pass
+        self.close_connection = True
+
+    def do_POST(self): # pylint: disable=invalid-name
+        '''Handle POST requests'''
+        stub = self.server
+        path = urlparse(self.path).path
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        stub.record(path)
+        time.sleep(stub.latency)
+        if not self.authorized():
+            self.send(403, 'Invalid API key', 'text/plain')
+        elif path in ('/api/job', '/api/printer/printhead'):
+            stub.commands.append((path, json.loads(body.decode('utf-8'))))
+            self.send(204, b'')
+        elif path == '/api/login':
+            self.send(200, json.dumps({'name': 'stub', 'session': 'stubsession'}))
+        elif path.startswith('/sockjs/') and path.endswith('/xhr_send'):
+            stub.push_received.extend(json.loads(body.decode('utf-8')))
+            self.send(204, b'')
+        elif path.startswith('/sockjs/') and path.endswith('/xhr_streaming'):
+            self.stream_push()
+        else:
+            self.send(404, 'Not found', 'text/plain')
+
+class StubOctoPrint(ThreadingMixIn, HTTPServer): # pylint: disable=too-many-instance-attributes
+    '''Threaded stub OctoPrint server. Set the public attributes to change
+    what it reports.'''
+    daemon_threads = True
+
+    def __init__(self, port=0, api_key='stubkey', latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubHandler)
+        self.api_key = api_key
+        self.latency = latency
+        self.operational = True
+        self.state = 'Operational'
+        self.file_name = 'stub.gcode'
+        self.gcode = b''
+        self.file_pos = 0
+        self.bed = (60.0, 60.0)
+        self.tool0 = (210.0, 210.0)
+        self.commands = []
+        self.push_enabled = True
+        self.push_interval = 0.5
+        self.push_received = []
+        self.requests = {}
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients timing out and hanging up are expected
+        pass
+
+    @property
+    def host(self):
+        '''host:port to pass to OctoPrintAccess'''
+        return '127.0.0.1:%d' % (self.server_address[1])
+
+    def record(self, path):
+        '''Count requests per path'''
+        self.requests[path] = self.requests.get(path, 0) + 1
+
+    def printer_json(self):
+        '''Body of /api/printer'''
+        return {
+            'temperature': {
+                'bed': {'actual': self.bed[0], 'target': self.bed[1], 'offset': 0},
+                'tool0': {'actual': self.tool0[0], 'target': self.tool0[1], 'offset': 0},
+            },
+            'state': {'text': self.state, 'flags': {'printing': self.state == 'Printing'}},
+        }
+
+    def job_json(self):
+        '''Body of /api/job'''
+        printing = self.state == 'Printing'
+        size = len(self.gcode)
+        return {
+            'job': {'file': {'name': self.file_name if printing else None,
+                             'origin': 'local',
+                             'size': size if printing else None,
+                             'date': 1440000000}},
+            'progress': {'completion': 100.0 * self.file_pos / size if printing and size else None,
+                         'filepos': self.file_pos if printing else None,
+                         'printTime': 1 if printing else None,
+                         'printTimeLeft': 3600 if printing else None},
+            'state': self.state,
+        }
+
+    def current_json(self):
+        '''Payload of a pushed "current" message'''
+        job = self.job_json()
+        return {
+            'state': {'text': self.state if self.operational else 'Offline',
+                      'flags': {'operational': self.operational, 'printing': self.state == 'Printing'}},
+            'job': job['job'],
+            'progress': job['progress'],
+            'temps': [{'time': int(time.time()),
+                       'bed': {'actual': self.bed[0], 'target': self.bed[1]},
+                       'tool0': {'actual': self.tool0[0], 'target': self.tool0[1]}}],
+        }
+
+    def file_json(self):
+        '''Body of /api/files/local/<name>'''
+        return {
+            'name': self.file_name,
+            'path': self.file_name,
+            'origin': 'local',
+            'size': len(self.gcode),
+            'date': 1440000000,
+            'refs': {'download': 'http://%s/downloads/files/local/%s' % (self.host, self.file_name)},
+        }
+
+    def start(self):
+        '''Serve requests on a background thread'''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving and close the socket'''
+        self.push_enabled = False
+        self.shutdown()
+        self.server_close()
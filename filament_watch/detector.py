@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+detector.py
+
+Decides whether the filament has stopped feeding
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+class FilamentDetector(object):
+    '''Compares the measured filament movement against the movement the
+    G-code calls for. update is called once per encoder report with the
+    latest printer status; the alarm is only armed once printing has been
+    running for min_print_time reports.'''
+    def __init__(self, change_threshold, min_print_time, scaling_factor):
+        self.change_threshold = change_threshold
+        self.min_print_time = min_print_time
+        self.scaling_factor = scaling_factor
+        self.printing_count = 0
+
+    def reset(self):
+        '''Forget any print in progress'''
+        self.printing_count = 0
+
+    def update(self, pos, meas_change_raw, stat):
+        '''Process one encoder report. stat is a status dict as returned by
+        OctoPrintAccess.status. Returns a dict describing the result; started
+        and stopped are set on the report where printing starts or stops.'''
+        meas_change_norm = meas_change_raw * self.scaling_factor
+
+        started = False
+        stopped = False
+        if stat['printing']:
+            if self.printing_count == 0:
+                started = True
+            self.printing_count += 1
+        else:
+            if self.printing_count != 0:
+                stopped = True
+            self.printing_count = 0
+
+        valid = self.printing_count >= self.min_print_time
+
+        # No G-code extrusion expected (e.g. a long travel move or a pause)
+        # can't be a jam
+        alarm = False
+        if valid and stat['gcode_change'] > 0 and (meas_change_norm / stat['gcode_change']) < self.change_threshold:
+            alarm = True
+
+        return {
+            'pos': pos,
+            'meas_change_raw': meas_change_raw,
+            'meas_change_norm': meas_change_norm,
+            'printing_count': self.printing_count,
+            'valid': valid,
+            'time_to_valid': self.min_print_time - self.printing_count,
+            'alarm': alarm,
+            'started': started,
+            'stopped': stopped,
+            'stat': stat,
+        }
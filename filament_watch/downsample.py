@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+downsample.py
+
+Reduce long chart series to a target number of points
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+def lttb(points, threshold):
+    '''Largest-Triangle-Three-Buckets: pick threshold of the (time, value)
+    points, keeping the first and last, so that the line through them
+    looks like the line through all of them. Points must be in time
+    order.'''
+    count = len(points)
+    if threshold >= count:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:max(threshold, 0)]
+    sampled = [points[0]]
+    # Points 1..count-2 are split into threshold-2 buckets of this width
+    every = (count - 2) / float(threshold - 2)
+    selected = 0
+    for bucket in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle
+        avg_start = int((bucket + 1) * every) + 1
+        avg_end = min(int((bucket + 2) * every) + 1, count)
+        avg_time = 0.0
+        avg_value = 0.0
+        for point_time, point_value in points[avg_start:avg_end]:
+            avg_time += point_time
+            avg_value += point_value
+        avg_count = avg_end - avg_start
+        avg_time /= avg_count
+        avg_value /= avg_count
+
+        sel_time, sel_value = points[selected]
+        max_area = -1.0
+        for index in range(int(bucket * every) + 1, int((bucket + 1) * every) + 1):
+            point_time, point_value = points[index]
+            area = abs((sel_time - avg_time) * (point_value - sel_value) -
+                       (sel_time - point_time) * (avg_value - sel_value))
+            if area > max_area:
+                max_area = area
+                next_selected = index
+        sampled.append(points[next_selected])
+        selected = next_selected
+    sampled.append(points[-1])
+    return sampled
+
+def min_max(points, start, end, threshold):
+    '''Split start..end into threshold/2 buckets and keep the lowest and
+    highest of the (time, value) points in each, in time order, so no spike
+    is lost'''
+    buckets = max(1, threshold // 2)
+    width = (end - start) / float(buckets)
+    if width <= 0:
+        width = 1.0
+    lows = [None] * buckets
+    highs = [None] * buckets
+    for point in points:
+        bucket = int((point[0] - start) / width)
+        if bucket < 0:
+            bucket = 0
+        elif bucket >= buckets:
+            bucket = buckets - 1
+        low = lows[bucket]
+        if low is None:
+            lows[bucket] = highs[bucket] = point
+        elif point[1] < low[1]:
+            lows[bucket] = point
+        elif point[1] > highs[bucket][1]:
+            highs[bucket] = point
+    sampled = []
+    for low, high in zip(lows, highs):
+        if low is None:
+            continue
+        if low is high:
+            sampled.append(low)
+        elif low[0] <= high[0]:
+            sampled.extend((low, high))
+        else:
+            sampled.extend((high, low))
+    return sampled
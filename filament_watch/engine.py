@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+engine.py
+
+asyncio engine connecting the encoder, OctoPrint, the detector and the sinks
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import Counters, LatencyStats
+
+class MonitorEngine(object): # pylint: disable=too-many-instance-attributes
+    '''Runs each stage of monitoring as its own task so that a slow stage
+    never holds up the others. The encoder and OctoPrint are polled by
+    independent sources; the detector combines each encoder report with
+    the latest printer status as soon as the report arrives, then hands
+    the result to each sink and, if the alarm is set, to alarm dispatch
+    through bounded queues.
+
+    The encoder, OctoPrint and sink objects block, so each is called on
+    its own single thread executor, which also keeps calls to any one of
+    them in order. When many printers are monitored, a shared executor can
+    be given for the OctoPrint stages; each has at most one call
+    outstanding, so order is kept. A call that overruns its stage deadline
+    is logged and counted, and the stage carries on waiting for it; the
+    other stages are unaffected. A call that raises is logged and counted
+    too, and the stage carries on with its next call.
+
+    No alarm is raised while the latest printer status is older than
+    max_status_age seconds (by default three status intervals), as when
+    OctoPrint stops responding; a print that had since finished or been
+    paused would otherwise be cancelled on stale information.'''
+    default_deadlines = {
+        'encoder': 12.0,
+        'status': 5.0,
+        'detector': 0.1,
+        'sink': 2.0,
+        'alarm': 10.0,
+    }
+    # Seconds to wait before retrying a stage whose call failed
+    error_delay = 1.0
+
+    def __init__(self, encoder, octoprint, detector, sinks, alarm_action, # pylint: disable=too-many-arguments
+                 status_interval=1.0, deadlines=None, queue_length=32, name=None, executor=None,
+                 max_status_age=None):
+        self.encoder = encoder
+        self.octoprint = octoprint
+        self.detector = detector
+        self.sinks = sinks
+        self.alarm_action = alarm_action
+        self.status_interval = status_interval
+        self.max_status_age = max_status_age if max_status_age is not None else 3 * status_interval
+        self.deadlines = dict(self.default_deadlines)
+        if deadlines:
+            self.deadlines.update(deadlines)
+        self.queue_length = queue_length
+        self.latency = LatencyStats()
+        self.counters = Counters()
+        self.stat = None
+        self.stat_time = None
+        self.status_stale = False
+        self.running = False
+        self.loop = None
+        self.status_ready = None
+        self.encoder_queue = None
+        self.alarm_queue = None
+        self.sink_queues = []
+        self.executors = {}
+        self.shared_executor = executor
+        self.name = name
+        self.logger = logging.getLogger(__name__ if name is None else '%s.%s' % (__name__, name))
+
+    def executor(self, name):
+        '''Executor for one stage. Encoder reads block for up to the read
+        timeout and sinks must finish writing before they are closed, so
+        they always get a dedicated thread.'''
+        if self.shared_executor is not None and name in ('status', 'alarm'):
+            return self.shared_executor
+        if name not in self.executors:
+            self.executors[name] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        return self.executors[name]
+
+    async def call(self, stage, name, func, *args):
+        '''Run func on the named executor, enforcing the stage deadline.
+        Returns None if func raises.'''
+        start = time.monotonic()
+        future = self.loop.run_in_executor(self.executor(name), func, *args)
+        try:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), self.deadlines[stage])
+            except asyncio.TimeoutError:
+                self.counters.increment('%s_overrun' % (name))
+                self.logger.warning('%s has taken more than %.1f s', name, self.deadlines[stage])
+                result = await future
+        except Exception: # pylint: disable=broad-except
+            self.counters.increment('%s_error' % (name))
+            self.logger.exception('%s failed', name)
+            result = None
+        self.latency.record(name, time.monotonic() - start)
+        return result
+
+    def put(self, sample_queue, item, name):
+        '''Queue item, dropping the oldest if the consumer has fallen behind'''
+        while True:
+            try:
+                sample_queue.put_nowait(item)
+                return
+            except asyncio.QueueFull:
+                sample_queue.get_nowait()
+                self.counters.increment('%s_dropped' % (name))
+
+    def log(self, msg):
+        '''Log an info level message to the logger and every sink'''
+        self.logger.info(msg)
+        for sink_queue, _ in self.sink_queues:
+            self.put(sink_queue, ('log', msg), 'log')
+
+    async def encoder_source(self):
+        '''Queue each encoder report with its monotonic time'''
+        while self.running:
+            report = await self.call('encoder', 'encoder', self.encoder.get_pos_change)
+            if report is None:
+                await asyncio.sleep(self.error_delay)
+                continue
+            pos, meas_change_raw = report
+            if pos is not None:
+                self.put(self.encoder_queue, (time.monotonic(), pos, meas_change_raw), 'encoder')
+
+    async def status_source(self):
+        '''Poll OctoPrint for status every status_interval seconds'''
+        while self.running:
+            start = time.monotonic()
+            stat = await self.call('status', 'status', self.octoprint.status)
+            if stat is None:
+                # Keep the last status, which ages until OctoPrint answers
+                await asyncio.sleep(self.error_delay)
+                continue
+            self.stat = stat
+            self.stat_time = time.monotonic()
+            self.status_ready.set()
+            self.logger.debug('OctoPrint status: printing=%d "%s" "%s" %.1f/%.1f %.1f/%.1f',
+                              self.stat['printing'],
+                              self.stat['summary'],
+                              self.stat['state'],
+                              self.stat['bed_target'],
+                              self.stat['bed_actual'],
+                              self.stat['tool0_target'],
+                              self.stat['tool0_actual'])
+            await asyncio.sleep(max(0.0, self.status_interval - (time.monotonic() - start)))
+
+    async def detect(self):
+        '''Run the detector on each encoder report against the latest status'''
+        await self.status_ready.wait()
+        while self.running:
+            received, pos, meas_change_raw = await self.encoder_queue.get()
+            start = time.monotonic()
+            try:
+                self.process_report(start, pos, meas_change_raw)
+            except Exception: # pylint: disable=broad-except
+                self.counters.increment('detector_error')
+                self.logger.exception('Unable to process encoder report')
+            now = time.monotonic()
+            if now - start > self.deadlines['detector']:
+                self.counters.increment('detector_overrun')
+            self.latency.record('detector', now - start)
+            # Time from the encoder report arriving to the result being queued
+            self.latency.record('detection', now - received)
+
+    def process_report(self, start, pos, meas_change_raw):
+        '''Run the detector on one encoder report and queue the result'''
+        detection = self.detector.update(pos, meas_change_raw, self.stat)
+        detection['time'] = time.time()
+        detection['status_age'] = start - self.stat_time
+        self.logger.debug('New position is %d (%+.1f)', pos, detection['meas_change_norm'])
+        if detection['started']:
+            self.log('Printing has started (%s)' % (self.stat['state']))
+        if detection['stopped']:
+            self.log('Printing has stopped (%s)' % (self.stat['state']))
+        self.logger.debug('State: printing_count=%d alarm=%d', detection['printing_count'], detection['alarm'])
+
+        stale = detection['status_age'] > self.max_status_age
+        if stale:
+            self.counters.increment('status_stale')
+            if not self.status_stale:
+                self.logger.warning('OctoPrint status is %.1f s old, not raising alarms until it is updated',
+                                    detection['status_age'])
+        elif self.status_stale:
+            self.logger.info('OctoPrint status is up to date again')
+        self.status_stale = stale
+        if stale and detection['alarm']:
+            self.counters.increment('stale_alarm_suppressed')
+            detection['alarm'] = False
+
+        if detection['alarm']:
+            self.put(self.alarm_queue, detection, 'alarm')
+        for sink_queue, _ in self.sink_queues:
+            self.put(sink_queue, ('update', detection), 'sink')
+
+    async def sink(self, sink_queue, index, sink):
+        '''Pass queued results and log messages to one sink'''
+        name = 'sink%d %s' % (index, sink.__class__.__name__)
+        while self.running:
+            kind, payload = await sink_queue.get()
+            if kind == 'update':
+                await self.call('sink', name, sink.update, payload)
+            else:
+                await self.call('sink', name, sink.log, payload)
+
+    async def dispatch_alarms(self):
+        '''Act on alarms from the detector'''
+        while self.running:
+            await self.alarm_queue.get()
+            self.logger.error('Alarm triggered - canceling job')
+            await self.call('alarm', 'alarm', self.octoprint.issue_job_cmd, self.alarm_action)
+
+    async def report_metrics(self, interval):
+        '''Log stage latencies and counters every interval seconds'''
+        while self.running:
+            await asyncio.sleep(interval)
+            self.logger.info('OctoPrint latency: %s', self.octoprint.latency.summary())
+            self.logger.info('Encoder: %s; %s', self.encoder.latency.summary(),
+                             self.encoder.counters.summary() or 'no samples dropped')
+            self.logger.info('Engine: %s; %s', self.latency.summary(),
+                             self.counters.summary() or 'no deadlines missed')
+
+    async def run(self, metrics_interval=600):
+        '''Run until the engine is cancelled. Failed calls are logged and
+        retried by their stage, so a task only finishes early on a bug in the
+        engine itself.'''
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        self.status_ready = asyncio.Event()
+        self.encoder_queue = asyncio.Queue(self.queue_length)
+        self.alarm_queue = asyncio.Queue(1)
+        self.sink_queues = [(asyncio.Queue(self.queue_length), sink) for sink in self.sinks]
+        tasks = [
+            asyncio.ensure_future(self.encoder_source()),
+            asyncio.ensure_future(self.status_source()),
+            asyncio.ensure_future(self.detect()),
+            asyncio.ensure_future(self.dispatch_alarms()),
+            asyncio.ensure_future(self.report_metrics(metrics_interval)),
+        ]
+        tasks += [asyncio.ensure_future(self.sink(sink_queue, index, sink))
+                  for index, (sink_queue, sink) in enumerate(self.sink_queues)]
+        try:
+            # Any task finishing means it has failed
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            self.running = False
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Let sinks finish writing before they are closed, but don't wait
+            # for a blocked encoder read or OctoPrint request
+            for name, executor in self.executors.items():
+                executor.shutdown(wait=name.startswith('sink'))
+            # Fresh executors if the engine is run again
+            self.executors = {}
@@ -34,31 +34,56 @@ jam, out of filament, etc.)
 #
 ##############################################################################
 
-import time
+import asyncio
 import logging
 import argparse
 import os
+import re
 import socket
+from concurrent.futures import ThreadPoolExecutor
 import yaml
 
-from .octoprint_ctl import OctoPrintAccess
+from .octoprint_ctl import OctoPrintAccess, create_session
+from .octoprint_push import OctoPrintPushStatus
 from .microcontroller_if import ArduinoInterface
 from .web_server import WebServer
+from .gcode_cache import GcodeIndexCache
+from .detector import FilamentDetector
+from .engine import MonitorEngine
+from .sinks import CsvSink, WebSink
+from .history_store import HistoryStore, HistorySink
 
 def get_config():
     '''Combine command line arguments and configuration file and return the configuration to use'''
     parser = argparse.ArgumentParser()
     parser.add_argument('--dev', help='Arduino serial device')
     parser.add_argument('--baudrate', type=int, help='Arduino baud rate')
+    parser.add_argument('--encoderrate', type=int, help='Encoder samples per second to request from Arduino firmware supporting binary samples (0 for one text sample per second)')
     parser.add_argument('--apikey', help='OctoPrint API key')
     parser.add_argument('--octoprinthost', help='Hostname of OctoPrint server')
+    parser.add_argument('--octoprintconnecttimeout', type=float, help='Seconds to wait for a connection to OctoPrint')
+    parser.add_argument('--octoprintreadtimeout', type=float, help='Seconds to wait for a response from OctoPrint')
+    parser.add_argument('--octoprintretries', type=int, help='Number of times to retry failed OctoPrint queries')
+    parser.add_argument('--octoprintconcurrent', type=int, help='Fetch printer and job status concurrently (1) or sequentially (0)')
+    parser.add_argument('--octoprintpush', type=int, help='Receive status pushed by OctoPrint (1) or only poll for it (0)')
     parser.add_argument('--csvlog', help='CSV log of filament status')
+    parser.add_argument('--csvlogflushinterval', type=float, help='Seconds to buffer CSV log rows for while printing')
+    parser.add_argument('--csvlogmaxsize', type=float, help='Rotate the CSV log once it reaches this many MB (0 to disable)')
+    parser.add_argument('--csvlogrotatehours', type=float, help='Rotate the CSV log every this many hours (0 to disable)')
+    parser.add_argument('--csvlogbackups', type=int, help='Number of compressed rotated CSV logs to keep (0 to keep none)')
     parser.add_argument('--alarmchangethreshold', type=float, help='Cancel print if filament movement falls below this threshold')
     parser.add_argument('--alarmminprinttime', type=int, help='Only cancel print after print has been running this many seconds')
     parser.add_argument('--alarmaction', help='Action to take on filament not feeding')
     parser.add_argument('--encoderscalingfactor', type=float, help='Conversion factor from encoder to mm')
     parser.add_argument('--windowduration', type=int, help='Average measurements over this number of seconds')
     parser.add_argument('--httpport', type=int, help='Port for status HTTP server')
+    parser.add_argument('--httpmaxstreams', type=int, help='Number of dashboards to push updates to at once; others poll for them (0 for all to poll)')
+    parser.add_argument('--gcodecachedir', help='Directory to cache G-code analysis in (empty to disable)')
+    parser.add_argument('--gcodecachesize', type=float, help='Maximum size of G-code analysis cache in MB')
+    parser.add_argument('--uploadsdir', help='OctoPrint uploads folder, to read G-code from directly if OctoPrint is on this computer (empty to disable)')
+    parser.add_argument('--indexprocesses', type=int, help='Number of processes to analyse G-code read from the uploads folder in (0 for one per CPU)')
+    parser.add_argument('--historydb', help='SQLite database to keep long term history in (empty to disable)')
+    parser.add_argument('--historyretentiondays', type=float, help='Days of history to keep (0 to keep everything)')
     parser.add_argument('--debug', action='store_true', help='Enable debug logs')
     parser.add_argument('--config', default=os.path.expanduser("~/.filament_watch"), help='Configuration file')
     args = parser.parse_args()
@@ -66,15 +91,32 @@ def get_config():
     default_config = {
         'dev': '/dev/serial/by-id/usb-Adafruit_Adafruit_Mini_Metro_328_ADAOFIOls-if00-port0',
         'baudrate': 115200,
+        'encoderrate': 0,
         'apikey': None,
         'octoprinthost': '127.0.0.1',
+        'octoprintconnecttimeout': 3.05,
+        'octoprintreadtimeout': 10,
+        'octoprintretries': 2,
+        'octoprintconcurrent': 1,
+        'octoprintpush': 0,
         'csvlog': None,
+        'csvlogflushinterval': 30,
+        'csvlogmaxsize': 10,
+        'csvlogrotatehours': 24,
+        'csvlogbackups': 7,
         'alarmchangethreshold': 0.1,
         'alarmminprinttime': 120,
         'alarmaction': 'cancel',
         'encoderscalingfactor': 0.040,
         'windowduration': 120,
         'httpport': None,
+        'httpmaxstreams': 20,
+        'gcodecachedir': os.path.expanduser('~/.filament_watch_cache'),
+        'gcodecachesize': 100,
+        'uploadsdir': os.path.expanduser('~/.octoprint/uploads'),
+        'indexprocesses': 1,
+        'historydb': None,
+        'historyretentiondays': 90,
     }
 
     # Load config from file, or use defaults
@@ -103,6 +145,44 @@ def get_config():
 
     return config
 
+def get_printer_configs(config):
+    '''Return the configuration of each printer to monitor. Each entry of the
+    optional printers list in the configuration file overrides the top
+    level settings for one printer, and must have a unique name. Without
+    the list, the top level settings describe the only printer. A top level
+    CSV log is split per printer by adding the printer's name to its file
+    name, and no two printers may share an encoder or a CSV log.'''
+    printers = config.get('printers')
+    if not printers:
+        printer = dict(config)
+        printer['name'] = None
+        return [printer]
+
+    printer_configs = []
+    for index, printer in enumerate(printers):
+        printer_config = dict(config)
+        del printer_config['printers']
+        printer_config.update(printer)
+        name = str(printer.get('name', 'printer%d' % (index + 1)))
+        if not re.match(r'^[A-Za-z0-9_.-]+$', name):
+            raise ValueError('Printer name "%s" may only contain letters, digits, "_", "." and "-"' % (name))
+        if name in [other['name'] for other in printer_configs]:
+            raise ValueError('Printer name "%s" is used more than once' % (name))
+        printer_config['name'] = name
+        if printer_config['csvlog'] and 'csvlog' not in printer:
+            root, ext = os.path.splitext(printer_config['csvlog'])
+            printer_config['csvlog'] = '%s.%s%s' % (root, name, ext)
+        for key, desc in (('dev', 'Encoder device'), ('csvlog', 'CSV log')):
+            if not printer_config[key]:
+                continue
+            path = os.path.realpath(os.path.expanduser(printer_config[key]))
+            for other in printer_configs:
+                if other[key] and os.path.realpath(os.path.expanduser(other[key])) == path:
+                    raise ValueError('%s %s is used by both printer "%s" and printer "%s"' % (
+                        desc, printer_config[key], other['name'], name))
+        printer_configs.append(printer_config)
+    return printer_configs
+
 def log_msg(logger, web_server, msg):
     '''Log an info level message to all logging facilities'''
     logger.info(msg)
@@ -124,14 +204,98 @@ def get_this_host_ip():
     sock.close()
     return gsn_ip
 
+class PrinterMonitor(object): # pylint: disable=too-many-instance-attributes
+    '''Encoder, OctoPrint connection, sinks and engine monitoring one printer'''
+    idle_logging_interval = 60
+    status_interval = 1.0
+
+    def __init__(self, printer, session, index_cache, web_status, executor=None, history_store=None): # pylint: disable=too-many-arguments
+        self.name = printer['name']
+        self.push_status = None
+        self.sinks = []
+        self.filament_watch = None
+        try:
+            self.build(printer, session, index_cache, web_status, executor, history_store)
+        except: # pylint: disable=bare-except
+            # Don't leave the threads of the parts already built running
+            self.stop()
+            raise
+
+    def build(self, printer, session, index_cache, web_status, executor, history_store): # pylint: disable=too-many-arguments
+        '''Open the encoder and OctoPrint connections and create the sinks
+        and engine'''
+        recent_length = printer['windowduration']
+        self.filament_watch = ArduinoInterface(printer['dev'], printer['baudrate'], recent_length,
+                                               printer['encoderrate'])
+        if printer['octoprintpush']:
+            self.push_status = OctoPrintPushStatus(printer['octoprinthost'], printer['apikey'], session,
+                                                   printer['octoprintconnecttimeout'])
+            self.push_status.start()
+        self.octoprint = OctoPrintAccess(printer['octoprinthost'], printer['apikey'], recent_length, index_cache,
+                                         session=session,
+                                         timeout=(printer['octoprintconnecttimeout'], printer['octoprintreadtimeout']),
+                                         concurrent_status=bool(printer['octoprintconcurrent']),
+                                         push_status=self.push_status,
+                                         uploads_dir=printer['uploadsdir'],
+                                         index_processes=printer['indexprocesses'] or None)
+        if web_status:
+            self.sinks.append(WebSink(web_status))
+        if printer['csvlog']:
+            self.sinks.append(CsvSink(printer['csvlog'], self.idle_logging_interval,
+                                      flush_interval=printer['csvlogflushinterval'],
+                                      max_bytes=int(printer['csvlogmaxsize'] * 1024 * 1024),
+                                      rotate_interval=printer['csvlogrotatehours'] * 3600,
+                                      backups=printer['csvlogbackups']))
+        if history_store:
+            self.sinks.append(HistorySink(history_store, self.name or ''))
+        detector = FilamentDetector(printer['alarmchangethreshold'], printer['alarmminprinttime'],
+                                    printer['encoderscalingfactor'])
+        self.engine = MonitorEngine(self.filament_watch, self.octoprint, detector, self.sinks,
+                                    printer['alarmaction'], status_interval=self.status_interval,
+                                    name=self.name, executor=executor)
+
+    def stop(self):
+        '''Close the sinks and stop background threads'''
+        for sink in self.sinks:
+            sink.close()
+        if self.push_status:
+            self.push_status.stop()
+        if self.filament_watch:
+            self.filament_watch.stop()
+
+async def supervise(engine, metrics_interval, restart_delay=10):
+    '''Run one printer's engine, restarting it if it fails, so that one
+    printer can't stop the monitoring of the others'''
+    while True:
+        try:
+            await engine.run(metrics_interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception: # pylint: disable=broad-except
+            engine.logger.exception('Monitoring failed, restarting in %g s', restart_delay)
+        await asyncio.sleep(restart_delay)
+
+async def run_engines(engines, metrics_interval):
+    '''Run the engines of every printer until cancelled'''
+    await asyncio.gather(*[supervise(engine, metrics_interval) for engine in engines])
+
+def octoprint_pool_size(printers):
+    '''Keep-alive connections needed to each OctoPrint server. Each printer
+    can have its printer and job status requests, a G-code download and an
+    alarm command in flight at once, plus the push stream if enabled.'''
+    per_host = {}
+    for printer in printers:
+        connections = 5 if printer['octoprintpush'] else 4
+        per_host[printer['octoprinthost']] = per_host.get(printer['octoprinthost'], 0) + connections
+    return max(per_host.values())
+
 def main(): # pylint: disable=too-many-locals
     """Main processing loop"""
 
     config = get_config()
 
-    recent_length = config['windowduration']
     web_history_length = 120
-    idle_logging_interval = 60
+    latency_logging_interval = 600
     log_level = logging.INFO
     if config['debug']:
         log_level = logging.DEBUG
@@ -140,125 +304,60 @@ def main(): # pylint: disable=too-many-locals
     logger = logging.getLogger(__name__)
     logging.getLogger("requests").setLevel(logging.WARNING)
 
-    if not config['apikey']:
-        logger.error('OctoPrint API key not specified!')
+    try:
+        printers = get_printer_configs(config)
+    except ValueError as err:
+        logger.error('%s', err)
         return
+    for printer in printers:
+        if not printer['apikey']:
+            logger.error('OctoPrint API key not specified!')
+            return
+
+    if config['gcodecachedir']:
+        index_cache = GcodeIndexCache(config['gcodecachedir'], int(config['gcodecachesize'] * 1024 * 1024))
+    else:
+        index_cache = None
+
+    if config['historydb']:
+        history_store = HistoryStore(os.path.expanduser(config['historydb']), config['historyretentiondays']).start()
+    else:
+        history_store = None
 
-    filament_watch = ArduinoInterface(config['dev'], config['baudrate'], recent_length)
-    octoprint = OctoPrintAccess(config['octoprinthost'], config['apikey'], recent_length)
+    # One connection pool, web server, OctoPrint thread pool and history
+    # store serve every printer
+    multiple = len(printers) > 1
+    session = create_session(config['octoprintretries'], pool_size=octoprint_pool_size(printers),
+                             hosts=len(printers))
     if config['httpport']:
-        web_server = WebServer(config['httpport'], config['debug'])
+        web_server = WebServer(config['httpport'], config['debug'], web_history_length,
+                               printer_names=[printer['name'] for printer in printers] if multiple else None,
+                               history_store=history_store, max_streams=config['httpmaxstreams'])
         logger.info('Status URL: http://%s:%d/', get_this_host_ip(), config['httpport'])
         web_server.start()
     else:
         web_server = None
+    executor = ThreadPoolExecutor(max_workers=2 * len(printers), thread_name_prefix='octoprint') if multiple else None
 
+    monitors = []
     try:
-        field_names = ['Time', 'Alarm', 'Printing', 'Valid',
-                       'Filament Position', 'Measured Change', 'GCode Change',
-                       'Summary', 'State', 'Filename', 'File Position',
-                       'File Size', 'G-code Filament Position', 'G-code Filament Total',
-                       'Bed Target', 'Bed Actual', 'Hot End Target', 'Hot End Actual']
-
-        log_msg(logger, web_server, 'Monitoring %s' % (config['dev']))
-
-        if config['csvlog']:
-            csv = open(config['csvlog'], 'w')
-            csv.write(','.join(field_names))
-            csv.write('\n')
-        else:
-            csv = None
-
-        printing_count = 0
-        skipped_log_count = idle_logging_interval
-        web_gcode_history = []
-        web_actual_history = []
-
-        while True:
-            pos, meas_change_raw = filament_watch.get_pos_change()
-            if pos != None:
-                meas_change_norm = meas_change_raw * config['encoderscalingfactor']
-                logger.debug('New position is %d (%+.1f)', pos, meas_change_norm)
-                stat = octoprint.status()
-
-                logger.debug('OctoPrint status: printing=%d "%s" "%s" %.1f/%.1f %.1f/%.1f',
-                             stat['printing'],
-                             stat['summary'],
-                             stat['state'],
-                             stat['bed_target'],
-                             stat['bed_actual'],
-                             stat['tool0_target'],
-                             stat['tool0_actual'])
-
-                if stat['printing']:
-                    if printing_count == 0:
-                        log_msg(logger, web_server, 'Printing has started (%s)' % (stat['state']))
-                    printing_count += 1
-                else:
-                    if printing_count != 0:
-                        log_msg(logger, web_server, 'Printing has stopped (%s)' % (stat['state']))
-                    printing_count = 0
-
-                valid = False
-                if printing_count >= config['alarmminprinttime']:
-                    valid = True
-
-                alarm = False
-                if valid and (meas_change_norm / stat['gcode_change']) < config['alarmchangethreshold']:
-                    alarm = True
-
-                logger.debug('State: printing_count=%d alarm=%d', printing_count, alarm)
-                chart_time = time.time() * 1000
-                if web_server:
-                    web_server.update({
-                        'gcode': [chart_time, stat['gcode_change']],
-                        'actual': [chart_time, meas_change_norm],
-                        'gcode_history': web_gcode_history,
-                        'actual_history': web_actual_history,
-                        'history_length': web_history_length,
-                        'alarm': alarm,
-                        'printing': stat['printing'],
-                        'valid': valid,
-                        'time_to_valid': config['alarmminprinttime'] - printing_count,
-                        'filament_pos': pos,
-                        'summary': stat['summary'],
-                        'file_pos': stat['file_pos'],
-                        'bed_target': stat['bed_target'],
-                        'bed_actual': stat['bed_actual'],
-                        'tool0_target': stat['tool0_target'],
-                        'tool0_actual': stat['tool0_actual'],
-                    })
-                # Make the history mirror the javascript state before it does addPoint
-                web_gcode_history.append([chart_time, stat['gcode_change']])
-                web_actual_history.append([chart_time, meas_change_norm])
-                if len(web_gcode_history) > web_history_length:
-                    web_gcode_history.pop(0)
-                    web_actual_history.pop(0)
-
-                if stat['printing'] or alarm or meas_change_raw != 0 or skipped_log_count >= (idle_logging_interval - 1):
-                    fields = [
-                        time.strftime('%H:%M:%S'), alarm, stat['printing'], valid,
-                        pos, meas_change_norm, stat['gcode_change'],
-                        stat['summary'], stat['state'], stat['file_name'], stat['file_pos'],
-                        stat['file_size'], stat['gcode_filament_pos'], stat['gcode_filament_total'],
-                        stat['bed_target'], stat['bed_actual'], stat['tool0_target'], stat['tool0_actual']]
-                    fields = [str(x) for x in fields]
-                    if csv:
-                        csv.write(','.join(fields))
-                        csv.write('\n')
-                        csv.flush()
-                    skipped_log_count = 0
-                else:
-                    skipped_log_count += 1
-
-                if alarm:
-                    logger.error('Alarm triggered - canceling job')
-                    octoprint.issue_job_cmd(config['alarmaction'])
+        for printer in printers:
+            web_status = web_server.printer(printer['name']) if web_server else None
+            try:
+                monitors.append(PrinterMonitor(printer, session, index_cache, web_status, executor, history_store))
+            except Exception: # pylint: disable=broad-except
+                # The monitors already built are stopped on the way out
+                logger.exception('Unable to start monitoring %s', printer['name'] or printer['dev'])
+                return
+            log_msg(logger, web_status, 'Monitoring %s' % (printer['dev']))
+
+        asyncio.run(run_engines([monitor.engine for monitor in monitors], latency_logging_interval))
     finally:
-        if csv:
-            csv.flush()
-            csv.close()
-            csv = None
+        for monitor in monitors:
+            monitor.stop()
         if web_server:
             web_server.stop()
-            web_server = None
+        if executor:
+            executor.shutdown(wait=False)
+        if history_store:
+            history_store.stop()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+gcode_cache.py
+
+Persistent on-disk cache of G-code extrusion indexes
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from .gcode_index import ExtrusionIndex
+
+class GcodeIndexCache(object):
+    '''Directory of extrusion indexes keyed by OctoPrint file metadata.
+
+    Each index is stored as a 16 byte header (magic, point count) followed
+    by the native byte order offsets and totals arrays, so it can be memory
+    mapped and searched in place. Files are evicted least recently used
+    first once the directory exceeds max_bytes.'''
+    magic = b'FWIDX1' + (b'LE' if sys.byteorder == 'little' else b'BE')
+    header = struct.Struct('=8sQ')
+    suffix = '.idx'
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logging.getLogger(__name__)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def file_key(file_json):
+        '''Identify a file by the metadata OctoPrint reports for it'''
+        ident = repr((file_json.get('origin'),
+                      file_json.get('path', file_json.get('name')),
+                      file_json.get('size'),
+                      file_json.get('date'),
+                      file_json.get('hash')))
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def path(self, file_json):
+        '''Path of the cache entry for the specified file'''
+        return os.path.join(self.cache_dir, self.file_key(file_json) + self.suffix)
+
+    def load(self, file_json):
+        '''Return the memory mapped index of the specified file, or None if
+        it is not cached'''
+        path = self.path(file_json)
+        try:
+            with open(path, 'rb') as idx_file:
+                mapped = mmap.mmap(idx_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        view = memoryview(mapped)
+        try:
+            magic, count = self.header.unpack_from(view)
+        except struct.error:
+            magic, count = None, 0
+        data_end = self.header.size + count * 16
+        if magic != self.magic or len(view) != data_end:
+            self.logger.warning('Discarding invalid cache entry %s', path)
+            view.release()
+            mapped.close()
+            self.remove(path)
+            return None
+
+        offsets = view[self.header.size:self.header.size + count * 8].cast('q')
+        totals = view[self.header.size + count * 8:data_end].cast('d')
+
+        # Mark as recently used. Several printers may share the cache, so the
+        # entry may already have been evicted by another.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.logger.debug('Loaded %d point index of %s from cache', count, file_json.get('name'))
+        return ExtrusionIndex(offsets, totals)
+
+    def store(self, file_json, index):
+        '''Save the index of the specified file, then evict old entries. An
+        index larger than the whole cache is not saved, as it would only be
+        evicted again along with every other entry.'''
+        size = self.header.size + len(index) * 16
+        if size > self.max_bytes:
+            self.logger.info('Not caching the %.1f MB index of %s, as the cache is limited to %.1f MB',
+                             size / 1024.0 / 1024.0, file_json.get('name'), self.max_bytes / 1024.0 / 1024.0)
+            return
+        path = self.path(file_json)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as idx_file:
+                idx_file.write(self.header.pack(self.magic, len(index)))
+                idx_file.write(index.offsets)
+                idx_file.write(index.totals)
+            os.replace(tmp_path, path)
+        except (IOError, OSError):
+            self.logger.exception('Unable to write cache entry %s', path)
+            self.remove(tmp_path)
+            return
+        self.evict()
+
+    def remove(self, path):
+        '''Delete a cache entry, ignoring errors'''
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        '''Remove least recently used entries until the cache fits in max_bytes'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if used <= self.max_bytes:
+                break
+            self.logger.debug('Evicting %s from cache', path)
+            self.remove(path)
+            used -= size
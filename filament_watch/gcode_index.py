@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+gcode_index.py
+
+Index of filament usage versus position in a G-code file
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import mmap
+import multiprocessing
+import os
+import re
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A G1 or G92 line, up to but excluding its newline
+MOVE_LINE = re.compile(rb'^G(?:1|92) [^\n]*', re.M)
+# The value of each word of a line starting with E
+E_WORD = re.compile(rb' E([^ \n]*)')
+
+class ExtrusionIndex(object):
+    '''Cumulative filament extruded versus file position, stored only at the
+    byte offsets where the cumulative amount changes'''
+    __slots__ = ('offsets', 'totals')
+
+    def __init__(self, offsets=None, totals=None):
+        self.offsets = offsets if offsets is not None else array('q')
+        self.totals = totals if totals is not None else array('d')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, file_pos, total):
+        '''Record the cumulative total reached at file_pos. Positions must be
+        added in increasing order.'''
+        if self.totals and self.totals[-1] == total:
+            return
+        if self.offsets and self.offsets[-1] == file_pos:
+            self.totals[-1] = total
+            return
+        self.offsets.append(file_pos)
+        self.totals.append(total)
+
+    def total(self):
+        '''Filament used by the whole file'''
+        if not self.totals:
+            return 0
+        return self.totals[-1]
+
+    def extend(self, offsets, totals):
+        '''Add each of a batch of cumulative totals, given as NumPy arrays'''
+        if not len(offsets):
+            return
+        if ((self.offsets and offsets[0] == self.offsets[-1]) or
+                (len(offsets) > 1 and (offsets[1:] == offsets[:-1]).any())):
+            # Several E words on one line; rare enough to add one by one
+            for file_pos, total in zip(offsets.tolist(), totals.tolist()):
+                self.add(file_pos, total)
+            return
+        # With distinct offsets, add only skips a total equal to the one
+        # before it
+        previous = numpy.empty_like(totals)
+        previous[0] = self.totals[-1] if self.totals else numpy.nan
+        previous[1:] = totals[:-1]
+        keep = totals != previous
+        self.offsets.frombytes(offsets[keep].astype(numpy.int64, copy=False).view(numpy.uint8))
+        self.totals.frombytes(totals[keep].astype(numpy.float64, copy=False).view(numpy.uint8))
+
+    def lookup(self, file_pos):
+        '''Filament used by every line ending at or before file_pos'''
+        idx = bisect_right(self.offsets, file_pos) - 1
+        if idx < 0:
+            return 0
+        return self.totals[idx]
+
+# Powers of ten that are exact doubles
+EXACT_POWERS_OF_TEN = [10.0 ** power for power in range(23)]
+
+def parse_words(data, starts, width=24):
+    '''float of each word of a NumPy byte array starting at starts and
+    ending at the next space or newline.
+
+    Plain decimals of up to 15 digits, by far the most common, are
+    converted with array arithmetic, a character column at a time: their
+    digits as an integer are exact in a double, as is a power of ten up to
+    10^22, so the quotient is correctly rounded and identical to float.
+    Anything else is left to float.'''
+    count = len(starts)
+    last = len(data) - 1
+    mantissa = numpy.zeros(count, numpy.int64)
+    digit_count = numpy.zeros(count, numpy.int8)
+    decimals = numpy.zeros(count, numpy.int8)
+    point_seen = numpy.zeros(count, bool)
+    negative = numpy.zeros(count, bool)
+    simple = numpy.ones(count, bool)
+    active = numpy.ones(count, bool)
+    ends = numpy.full(count, -1, numpy.int8)
+    for column in range(width):
+        char = data.take(starts + column, mode='clip')
+        ended = active & ((char == ord(' ')) | (char == 10))
+        ends[ended] = column
+        active &= ~ended
+        if not active.any():
+            break
+        digit = char - ord('0')
+        is_digit = active & (digit <= 9)
+        is_point = active & (char == ord('.'))
+        allowed = is_digit | is_point
+        if column == 0:
+            negative = active & (char == ord('-'))
+            allowed |= negative | (active & (char == ord('+')))
+        simple &= ~active | allowed
+        simple &= ~(is_point & point_seen)
+        # In place arithmetic rather than masked updates, which are slower
+        mantissa *= numpy.where(is_digit, 10, 1)
+        mantissa += digit * is_digit
+        digit_count += is_digit
+        decimals += is_digit & point_seen
+        point_seen |= is_point
+    simple &= (ends >= 0) & (digit_count > 0) & (digit_count <= 15)
+
+    values = mantissa / numpy.array(EXACT_POWERS_OF_TEN)[numpy.minimum(decimals, 22)]
+    values[negative] *= -1
+
+    others = numpy.flatnonzero(~simple)
+    if not len(others):
+        return values
+    if data.all() and (ends[others] > 0).all():
+        # Through byte strings, which convert like float
+        grid = data[numpy.minimum(starts[others, None] + numpy.arange(width), last)]
+        grid[numpy.arange(width) >= ends[others, None]] = 0
+        values[others] = grid.view('S%d' % (width)).ravel().astype(numpy.float64)
+        return values
+    # Empty, longer than width, or with NUL bytes, which byte strings
+    # would drop
+    buf = data.tobytes()
+    for index in others.tolist():
+        start = int(starts[index])
+        end = start
+        while end < len(buf) and buf[end] not in b' \n':
+            end += 1
+        values[index] = float(buf[start:end])
+    return values
+
+def scan_events_numpy(buf, start, end, base):
+    '''scan_events using NumPy array operations over the whole buffer'''
+    data = numpy.frombuffer(buf, numpy.uint8, end - start, start)
+    empty = numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float64), numpy.empty(0, bool)
+    # Newlines and Es in one pass, numbering each E by the line it is on
+    events = numpy.flatnonzero((data == 10) | (data == ord('E')))
+    is_newline = data[events] == 10
+    newlines = events[is_newline]
+    lines = numpy.cumsum(is_newline)[~is_newline]
+    # Words starting with E
+    words = events[~is_newline]
+    word = data[numpy.maximum(words - 1, 0)] == ord(' ')
+    words = words[word]
+    lines = lines[word]
+    if not len(words) or not len(newlines):
+        return empty
+
+    # Keep those on G1 and G92 lines. The region ends with a newline,
+    # which fails every test, so reading past the end of a short last
+    # line can stop there.
+    line_starts = numpy.where(lines > 0, newlines[lines - 1] + 1, 0)
+    last = len(data) - 1
+    first = data[line_starts] == ord('G')
+    second = data[numpy.minimum(line_starts + 1, last)]
+    third = data[numpy.minimum(line_starts + 2, last)]
+    is_g1 = first & (second == ord('1')) & (third == ord(' '))
+    is_g92 = (first & (second == ord('9')) & (third == ord('2')) &
+              (data[numpy.minimum(line_starts + 3, last)] == ord(' ')))
+    keep = is_g1 | is_g92
+    if not keep.any():
+        return empty
+
+    values = parse_words(data, words[keep] + 1)
+    offsets = newlines[lines[keep]].astype(numpy.int64) + (base + start + 1)
+    return offsets, values, is_g1[keep]
+
+def scan_events_python(buf, start, end, base):
+    '''scan_events using a regular expression to find the G1 and G92 lines'''
+    offsets = array('q')
+    values = array('d')
+    is_g1 = []
+    for match in MOVE_LINE.finditer(buf, start, end):
+        line = match.group()
+        if b' E' not in line:
+            continue
+        g1 = line[2:3] == b' '
+        file_pos = base + match.end() + 1
+        for value in E_WORD.findall(line):
+            offsets.append(file_pos)
+            values.append(float(value))
+            is_g1.append(g1)
+    return offsets, values, is_g1
+
+def scan_events(buf, start=0, end=None, base=0):
+    '''Find the E words of the G1 and G92 lines in buf[start:end], which must
+    be whole lines. Words are split on spaces, exactly as
+    GcodeExtrusionParser.parse_line splits them. Returns (offsets, values,
+    is_g1): for each E word, base plus the position in buf just after its
+    line, its value, and whether it is a G1 (rather than a G92) word.
+    These are NumPy arrays if NumPy is installed. buf may be bytes, a
+    bytearray or an mmap.'''
+    if end is None:
+        end = len(buf)
+    if numpy is not None and end > start:
+        return scan_events_numpy(buf, start, end, base)
+    return scan_events_python(buf, start, end, base)
+
+def extrusion_changes(offsets, values, is_g1):
+    '''Convert E words found by scan_events into the change in the running
+    total made by each G1 word, relative to the word before it. Returns
+    (offsets, changes, follows, last_extrude): the file positions just
+    after the G1 words, their changes, whether the first word is a G1, in
+    which case its change is still its absolute value and the E value
+    reached before these words remains to be subtracted, and the last E
+    value, or None if there are no words. A G92 word resets the E value,
+    so nothing after one depends on the words before it.'''
+    if not len(values):
+        return offsets, values, False, None
+    if numpy is None:
+        g1_offsets = array('q')
+        changes = array('d')
+        previous = 0.0
+        for file_pos, value, g1 in zip(offsets, values, is_g1):
+            if g1:
+                g1_offsets.append(file_pos)
+                changes.append(value - previous)
+            previous = value
+        return g1_offsets, changes, bool(is_g1[0]), values[-1]
+    previous = numpy.empty_like(values)
+    previous[0] = 0.0
+    previous[1:] = values[:-1]
+    changes = (values - previous)[is_g1]
+    return offsets[is_g1], changes, bool(is_g1[0]), float(values[-1])
+
+def concatenate_events(events):
+    '''Join the (offsets, values, is_g1) results of several calls to
+    scan_events'''
+    if numpy is not None:
+        return tuple(numpy.concatenate(arrays) for arrays in zip(*events))
+    offsets = array('q')
+    values = array('d')
+    is_g1 = []
+    for piece_offsets, piece_values, piece_is_g1 in events:
+        offsets.extend(piece_offsets)
+        values.extend(piece_values)
+        is_g1.extend(piece_is_g1)
+    return offsets, values, is_g1
+
+def scan_file_range(path, start, end, piece_size=1024 * 1024):
+    '''Find the extrusion changes made by bytes start to end of the file at
+    path, which must be whole lines, as extrusion_changes does. The file is
+    mapped into memory rather than read, so processes indexing different
+    ranges share its pages, and is scanned a cache sized piece at a
+    time.'''
+    # The mapping is left to close once unreferenced, as arrays viewing it
+    # may outlive this call in a traceback
+    with open(path, 'rb') as gcode:
+        mapped = mmap.mmap(gcode.fileno(), 0, access=mmap.ACCESS_READ)
+    events = []
+    pos = start
+    while pos < end:
+        piece_end = min(pos + piece_size, end)
+        if piece_end < end:
+            piece_end = mapped.find(b'\n', piece_end - 1, end) + 1 or end
+        events.append(scan_events(mapped, pos, piece_end))
+        pos = piece_end
+    if not events:
+        return extrusion_changes(array('q'), array('d'), [])
+    return extrusion_changes(*concatenate_events(events))
+
+def line_ranges(mapped, end, chunk_size):
+    '''Split the first end bytes of mapped, which end with a newline, into
+    ranges of whole lines of about chunk_size bytes'''
+    ranges = []
+    start = 0
+    while start < end:
+        chunk_end = min(start + chunk_size, end)
+        if chunk_end < end:
+            chunk_end = mapped.find(b'\n', chunk_end - 1, end) + 1 or end
+        ranges.append((start, chunk_end))
+        start = chunk_end
+    return ranges
+
+def worker_context():
+    '''multiprocessing context for indexing workers'''
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def index_file(path, processes=None, chunk_size=16 * 1024 * 1024, cancelled=None):
+    '''Extrusion index of a G-code file on disk, scanned by a pool of
+    processes (default: one per CPU). If a cancelled event is given, it is
+    checked after each chunk, and once it is set the chunks not yet started
+    are abandoned and None is returned.
+
+    The file is split at line boundaries into chunks of about chunk_size
+    bytes. Each worker maps the file into memory itself and scans a chunk
+    with scan_file_range, so only the file name and range are sent to it,
+    never the G-code. As the E value reached before a chunk is not known
+    while scanning it, workers return changes relative to the start of the
+    chunk, which are then joined in file order by a running total exactly
+    as GcodeExtrusionParser does. The result is identical to feeding it the
+    whole file.
+
+    Workers are started by a fork server (or spawned where there is none)
+    rather than forked from the caller, which may have other threads
+    holding locks that a forked child would wait on forever.'''
+    parser = GcodeExtrusionParser()
+    if not os.path.getsize(path):
+        return parser.finish()
+    if processes is None:
+        processes = os.cpu_count() or 1
+    with open(path, 'rb') as gcode:
+        mapped = mmap.mmap(gcode.fileno(), 0, access=mmap.ACCESS_READ)
+    with mapped:
+        # Whole lines; any unterminated last line is parsed on its own
+        end = mapped.rfind(b'\n') + 1
+        ranges = line_ranges(mapped, end, chunk_size)
+        processes = min(processes, len(ranges))
+        if processes <= 1:
+            for start, chunk_end in ranges:
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                parser.add_changes(*scan_file_range(path, start, chunk_end))
+        else:
+            with ProcessPoolExecutor(processes, mp_context=worker_context()) as executor:
+                futures = [executor.submit(scan_file_range, path, start, chunk_end)
+                           for start, chunk_end in ranges]
+                for future in futures:
+                    if cancelled is not None and cancelled.is_set():
+                        # Only wait for the chunks already being scanned
+                        for pending in futures:
+                            pending.cancel()
+                        return None
+                    parser.add_changes(*future.result())
+        parser.file_pos = end
+        parser.pending = bytearray(mapped[end:])
+    return parser.finish()
+
+class GcodeExtrusionParser(object):
+    '''Incrementally parse G-code as it arrives, building an index of the
+    cumulative filament extruded versus file position.
+
+    Arriving data is collected until scan_size bytes are available, then
+    all the complete lines in it are scanned by scan_events at once, and
+    the running total is computed with one cumulative sum. The result is
+    identical to passing every line to parse_line in turn.'''
+    scan_size = 1024 * 1024
+
+    def __init__(self):
+        self.index = ExtrusionIndex()
+        self.pending = bytearray()
+        self.total = 0.0
+        self.last_extrude = 0.0
+        self.file_pos = 0
+
+        # Usage at beginning of file
+        self.index.add(0, 0.0)
+
+    def parse_line(self, line):
+        '''Parse a single line of G-code, without its line ending'''
+        self.file_pos += len(line) + 1
+        if line.startswith(b'G92 '):
+            for token in line.split(b' '):
+                if token[0:1] == b'E':
+                    self.last_extrude = float(token[1:])
+        if line.startswith(b'G1 '):
+            for token in line.split(b' '):
+                if token[0:1] == b'E':
+                    dist = float(token[1:])
+                    self.total += dist - self.last_extrude
+                    self.last_extrude = dist
+                    self.index.add(self.file_pos, self.total)
+
+    def add_events(self, offsets, values, is_g1):
+        '''Apply E words found by scan_events, in file order'''
+        self.add_changes(*extrusion_changes(offsets, values, is_g1))
+
+    def add_changes(self, offsets, changes, follows, last_extrude):
+        '''Apply extrusion changes found by extrusion_changes, in file order'''
+        if last_extrude is None:
+            return
+        if follows:
+            # Each G1 adds its change from the previous E value, G1 or G92
+            changes[0] = changes[0] - self.last_extrude
+        self.last_extrude = last_extrude
+        if not len(changes):
+            return
+        if numpy is None:
+            for file_pos, change in zip(offsets, changes):
+                self.total += change
+                self.index.add(file_pos, self.total)
+            return
+        # Summed in file order from the running total, as parse_line does
+        totals = numpy.cumsum(numpy.concatenate(((self.total,), changes)))[1:]
+        self.total = float(totals[-1])
+        self.index.extend(offsets, totals)
+
+    def scan_pending(self):
+        '''Parse every complete line received so far'''
+        end = self.pending.rfind(b'\n') + 1
+        if end:
+            self.add_events(*scan_events(self.pending, 0, end, self.file_pos))
+            self.file_pos += end
+            del self.pending[:end]
+
+    def feed(self, chunk):
+        '''Parse the next chunk of the file. Only the trailing partial line
+        is retained once parsed.'''
+        self.pending += chunk
+        if len(self.pending) >= self.scan_size:
+            self.scan_pending()
+
+    def finish(self):
+        '''Parse the last line and return the completed index'''
+        self.scan_pending()
+        self.parse_line(bytes(self.pending))
+        self.pending = bytearray()
+        return self.index
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+history_store.py
+
+Long term history of detector results in SQLite
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+from .downsample import lttb, min_max
+
+class HistoryStore(object): # pylint: disable=too-many-instance-attributes
+    '''SQLite database of every detector result, grouped into prints.
+
+    Results are queued by add and written by a background thread in one
+    transaction per batch. The database is in WAL mode, so web requests
+    can query it, each thread through its own connection, while the
+    writer is busy. Results older than retention_days are deleted once an
+    hour.
+
+    The writer also keeps rollups of the G-code and actual changes: count,
+    sum, minimum and maximum (with their times) per bucket of each of
+    rollup_levels seconds. A chart series is read from the coarsest level
+    that still has the requested number of points, then downsampled, so a
+    long range costs about as much as a short one.'''
+    # Seconds per bucket of each rollup level, finest first
+    rollup_levels = (5, 20, 60, 300, 1200, 3600)
+    schema = (
+        '''CREATE TABLE IF NOT EXISTS printers (
+               id INTEGER PRIMARY KEY,
+               name TEXT NOT NULL UNIQUE)''',
+        '''CREATE TABLE IF NOT EXISTS prints (
+               id INTEGER PRIMARY KEY,
+               printer_id INTEGER NOT NULL,
+               file_name TEXT,
+               start REAL NOT NULL,
+               end REAL,
+               alarm INTEGER NOT NULL DEFAULT 0)''',
+        '''CREATE INDEX IF NOT EXISTS prints_printer_start ON prints (printer_id, start)''',
+        '''CREATE TABLE IF NOT EXISTS samples (
+               printer_id INTEGER NOT NULL,
+               time REAL NOT NULL,
+               print_id INTEGER,
+               pos INTEGER,
+               actual REAL,
+               gcode REAL,
+               alarm INTEGER,
+               file_pos INTEGER)''',
+        '''CREATE INDEX IF NOT EXISTS samples_printer_time ON samples (printer_id, time)''',
+        '''CREATE INDEX IF NOT EXISTS samples_print_time ON samples (print_id, time)
+               WHERE print_id IS NOT NULL''',
+        '''CREATE TABLE IF NOT EXISTS rollups (
+               printer_id INTEGER NOT NULL,
+               level INTEGER NOT NULL,
+               bucket INTEGER NOT NULL,
+               count INTEGER NOT NULL,
+               gcode_sum REAL,
+               gcode_min REAL,
+               gcode_min_time REAL,
+               gcode_max REAL,
+               gcode_max_time REAL,
+               actual_sum REAL,
+               actual_min REAL,
+               actual_min_time REAL,
+               actual_max REAL,
+               actual_max_time REAL,
+               PRIMARY KEY (printer_id, level, bucket)) WITHOUT ROWID''',
+    )
+
+    def __init__(self, path, retention_days=90, batch_interval=5.0, batch_size=1000, queue_length=100000): # pylint: disable=too-many-arguments
+        self.path = path
+        self.retention_days = retention_days
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.expire_interval = 3600
+        self.queue = queue.Queue(queue_length)
+        self.local = threading.local()
+        # Printer name -> id of the print in progress
+        self.current_prints = {}
+        # Printer name -> id in the printers table
+        self.printer_ids = {}
+        self.logger = logging.getLogger(__name__)
+        conn = self.connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            for statement in self.schema:
+                conn.execute(statement)
+            # Prints interrupted by a restart end at their last sample
+            conn.execute('''UPDATE prints SET end = (SELECT MAX(time) FROM samples WHERE print_id = prints.id)
+                            WHERE end IS NULL''')
+        self.thread = threading.Thread(target=self.run, name='history writer')
+        self.thread.daemon = True
+
+    def connect(self):
+        '''Connection for the calling thread'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def printer_id(self, conn, printer, create=False):
+        '''Id of the named printer, or None if it has no history'''
+        printer_id = self.printer_ids.get(printer)
+        if printer_id is None:
+            row = conn.execute('SELECT id FROM printers WHERE name = ?', (printer,)).fetchone()
+            if row is not None:
+                printer_id = row[0]
+            elif create:
+                printer_id = conn.execute('INSERT INTO printers (name) VALUES (?)', (printer,)).lastrowid
+            else:
+                return None
+            self.printer_ids[printer] = printer_id
+        return printer_id
+
+    def start(self):
+        '''Start the writer'''
+        self.thread.start()
+        return self
+
+    def stop(self):
+        '''Write everything queued and stop the writer'''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def add(self, printer, detection):
+        '''Queue one detector result of the named printer. Blocks if the
+        writer has fallen far behind.'''
+        stat = detection['stat']
+        self.queue.put((printer, detection['time'], bool(stat['printing']), stat['file_name'],
+                        detection['pos'], detection['meas_change_norm'], stat['gcode_change'],
+                        int(detection['alarm']), stat['file_pos']))
+
+    def run(self):
+        '''Writer thread'''
+        conn = self.connect()
+        try:
+            self.backfill(conn)
+        except sqlite3.Error:
+            self.logger.exception('Unable to roll up existing history')
+        last_expire = 0
+        running = True
+        while running:
+            batch = []
+            deadline = time.time() + self.batch_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            if batch:
+                try:
+                    self.write(conn, batch)
+                except sqlite3.Error:
+                    self.logger.exception('Unable to write %d samples to history', len(batch))
+            if self.retention_days and time.time() - last_expire >= self.expire_interval:
+                last_expire = time.time()
+                try:
+                    self.expire(time.time() - self.retention_days * 86400)
+                except sqlite3.Error:
+                    self.logger.exception('Unable to expire history')
+
+    def write(self, conn, batch):
+        '''Write a batch of queued results in one transaction, starting and
+        ending prints as printing starts and stops'''
+        rows = []
+        with conn:
+            for printer, timestamp, printing, file_name, pos, actual, gcode, alarm, file_pos in batch:
+                printer_id = self.printer_id(conn, printer, True)
+                print_id = self.current_prints.get(printer)
+                if printing and print_id is None:
+                    print_id = conn.execute('INSERT INTO prints (printer_id, file_name, start) VALUES (?, ?, ?)',
+                                            (printer_id, file_name, timestamp)).lastrowid
+                    self.current_prints[printer] = print_id
+                elif not printing and print_id is not None:
+                    conn.execute('UPDATE prints SET end = ? WHERE id = ?', (timestamp, print_id))
+                    del self.current_prints[printer]
+                    print_id = None
+                if alarm and print_id is not None:
+                    conn.execute('UPDATE prints SET alarm = 1 WHERE id = ?', (print_id,))
+                rows.append((printer_id, timestamp, print_id, pos, actual, gcode, alarm, file_pos))
+            conn.executemany('''INSERT INTO samples (printer_id, time, print_id, pos, actual, gcode, alarm, file_pos)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            self.roll_up(conn, ((row[0], row[1], row[5], row[4]) for row in rows))
+
+    def roll_up(self, conn, rows):
+        '''Add (printer_id, time, gcode, actual) rows to the rollups'''
+        buckets = {}
+        for printer_id, timestamp, gcode, actual in rows:
+            for level in self.rollup_levels:
+                key = (printer_id, level, int(timestamp // level) * level)
+                agg = buckets.get(key)
+                if agg is None:
+                    buckets[key] = [1, gcode, gcode, timestamp, gcode, timestamp,
+                                    actual, actual, timestamp, actual, timestamp]
+                    continue
+                agg[0] += 1
+                agg[1] += gcode
+                if gcode < agg[2]:
+                    agg[2] = gcode
+                    agg[3] = timestamp
+                elif gcode > agg[4]:
+                    agg[4] = gcode
+                    agg[5] = timestamp
+                agg[6] += actual
+                if actual < agg[7]:
+                    agg[7] = actual
+                    agg[8] = timestamp
+                elif actual > agg[9]:
+                    agg[9] = actual
+                    agg[10] = timestamp
+        # Buckets already in the table are merged; SET expressions all see
+        # the old row, so the times are chosen before the extremes change
+        conn.executemany('''INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                            ON CONFLICT (printer_id, level, bucket) DO UPDATE SET
+                            count = count + excluded.count,
+                            gcode_sum = gcode_sum + excluded.gcode_sum,
+                            gcode_min_time = CASE WHEN excluded.gcode_min < gcode_min
+                                             THEN excluded.gcode_min_time ELSE gcode_min_time END,
+                            gcode_min = MIN(gcode_min, excluded.gcode_min),
+                            gcode_max_time = CASE WHEN excluded.gcode_max > gcode_max
+                                             THEN excluded.gcode_max_time ELSE gcode_max_time END,
+                            gcode_max = MAX(gcode_max, excluded.gcode_max),
+                            actual_sum = actual_sum + excluded.actual_sum,
+                            actual_min_time = CASE WHEN excluded.actual_min < actual_min
+                                              THEN excluded.actual_min_time ELSE actual_min_time END,
+                            actual_min = MIN(actual_min, excluded.actual_min),
+                            actual_max_time = CASE WHEN excluded.actual_max > actual_max
+                                              THEN excluded.actual_max_time ELSE actual_max_time END,
+                            actual_max = MAX(actual_max, excluded.actual_max)''',
+                         (key + tuple(agg) for key, agg in buckets.items()))
+
+    def backfill(self, conn, chunk=100000):
+        '''Roll up the results of a database written before rollups were
+        kept'''
+        if conn.execute('SELECT 1 FROM rollups LIMIT 1').fetchone() is not None:
+            return
+        last_rowid = 0
+        total = 0
+        while True:
+            rows = conn.execute('''SELECT rowid, printer_id, time, gcode, actual FROM samples
+                                   WHERE rowid > ? ORDER BY rowid LIMIT ?''', (last_rowid, chunk)).fetchall()
+            if not rows:
+                break
+            with conn:
+                self.roll_up(conn, (row[1:] for row in rows))
+            last_rowid = rows[-1][0]
+            total += len(rows)
+        if total:
+            self.logger.info('Rolled up %d samples of existing history', total)
+
+    def expire(self, before, chunk=50000):
+        '''Delete results older than before, a chunk at a time so readers are
+        never blocked for long'''
+        conn = self.connect()
+        deleted = 0
+        while True:
+            with conn:
+                count = conn.execute('''DELETE FROM samples WHERE rowid IN
+                                        (SELECT rowid FROM samples WHERE time < ? LIMIT ?)''',
+                                     (before, chunk)).rowcount
+            deleted += count
+            if count < chunk:
+                break
+        with conn:
+            conn.execute('DELETE FROM prints WHERE end < ?', (before,))
+            conn.execute('DELETE FROM rollups WHERE bucket + level <= ?', (before,))
+        if deleted:
+            self.logger.info('Expired %d samples from history', deleted)
+        return deleted
+
+    def prints(self, printer, limit=50, before=None):
+        '''Most recent prints of the named printer, newest first'''
+        conn = self.connect()
+        printer_id = self.printer_id(conn, printer)
+        if before is None:
+            before = float('inf')
+        cursor = conn.execute('''SELECT id, file_name, start, end, alarm FROM prints
+                                 WHERE printer_id = ? AND start < ? ORDER BY start DESC LIMIT ?''',
+                              (printer_id, before, limit))
+        return [{'id': row[0], 'file_name': row[1], 'start': row[2], 'end': row[3], 'alarm': bool(row[4])}
+                for row in cursor]
+
+    def print_info(self, printer, print_id):
+        '''Details of one print, or None if there is no such print'''
+        conn = self.connect()
+        row = conn.execute('''SELECT id, file_name, start, end, alarm FROM prints
+                              WHERE printer_id = ? AND id = ?''',
+                           (self.printer_id(conn, printer), print_id)).fetchone()
+        if row is None:
+            return None
+        return {'id': row[0], 'file_name': row[1], 'start': row[2], 'end': row[3], 'alarm': bool(row[4])}
+
+    def samples(self, printer, print_id=None, start=None, end=None):
+        '''(time, gcode, actual) of the results of one print, or of the
+        named printer between start and end, in time order'''
+        conn = self.connect()
+        if start is None:
+            start = float('-inf')
+        if end is None:
+            end = float('inf')
+        if print_id is not None:
+            return conn.execute('''SELECT time, gcode, actual FROM samples
+                                   WHERE print_id = ? AND time >= ? AND time <= ?
+                                   ORDER BY time''', (print_id, start, end)).fetchall()
+        return conn.execute('''SELECT time, gcode, actual FROM samples
+                               WHERE printer_id = ? AND time >= ? AND time <= ?
+                               ORDER BY time''', (self.printer_id(conn, printer), start, end)).fetchall()
+
+    def series(self, printer, points, method='lttb', print_id=None, start=None, end=None): # pylint: disable=too-many-arguments,too-many-locals
+        '''(time, value) points of the G-code and actual changes of one print,
+        or of the named printer between start and end, reduced to about
+        points points by method, 'lttb' or 'minmax'. A print in progress
+        runs to now.'''
+        if print_id is not None:
+            print_range = self.connect().execute('SELECT start, end FROM prints WHERE id = ?', (print_id,)).fetchone()
+            if print_range is None:
+                return [], []
+            start = print_range[0] if start is None else max(start, print_range[0])
+            if print_range[1] is not None:
+                end = print_range[1] if end is None else min(end, print_range[1])
+        if end is None:
+            end = time.time()
+        if start is None:
+            start = end - 86400
+        span = max(end - start, 0)
+
+        # At most about five times the points are read: the levels are at
+        # most that far apart, and below the finest the raw results are used
+        level = None
+        for rollup_level in reversed(self.rollup_levels):
+            if span / rollup_level >= points:
+                level = rollup_level
+                break
+
+        if level is None:
+            rows = self.samples(printer, print_id, start, end)
+            gcode = [(row[0], row[1]) for row in rows]
+            actual = [(row[0], row[2]) for row in rows]
+        else:
+            gcode, actual = self.rollup_points(printer, level, method, start, end)
+
+        if method == 'minmax':
+            return min_max(gcode, start, end, points), min_max(actual, start, end, points)
+        return lttb(gcode, points), lttb(actual, points)
+
+    def rollup_points(self, printer, level, method, start, end): # pylint: disable=too-many-arguments
+        '''G-code and actual (time, value) points from the rollups at level
+        between start and end: the minimum and maximum of each bucket for
+        min/max downsampling, otherwise the mean at the bucket's middle'''
+        conn = self.connect()
+        args = (self.printer_id(conn, printer), level, start - level, end)
+        if method == 'minmax':
+            rows = conn.execute('''SELECT gcode_min_time, gcode_min, gcode_max_time, gcode_max,
+                                          actual_min_time, actual_min, actual_max_time, actual_max
+                                   FROM rollups WHERE printer_id = ? AND level = ? AND bucket > ? AND bucket <= ?
+                                   ORDER BY bucket''', args).fetchall()
+            gcode = []
+            actual = []
+            for row in rows:
+                if row[0] <= row[2]:
+                    gcode.extend(((row[0], row[1]), (row[2], row[3])))
+                else:
+                    gcode.extend(((row[2], row[3]), (row[0], row[1])))
+                if row[4] <= row[6]:
+                    actual.extend(((row[4], row[5]), (row[6], row[7])))
+                else:
+                    actual.extend(((row[6], row[7]), (row[4], row[5])))
+            # The first and last buckets may hold extremes outside the range
+            return ([point for point in gcode if start <= point[0] <= end],
+                    [point for point in actual if start <= point[0] <= end])
+        rows = conn.execute('''SELECT bucket, gcode_sum / count, actual_sum / count
+                               FROM rollups WHERE printer_id = ? AND level = ? AND bucket > ? AND bucket <= ?
+                               ORDER BY bucket''', args).fetchall()
+        middles = [min(max(row[0] + level / 2.0, start), end) for row in rows]
+        return ([(middle, row[1]) for middle, row in zip(middles, rows)],
+                [(middle, row[2]) for middle, row in zip(middles, rows)])
+
+class HistorySink(object):
+    '''Records one printer's detector results in a HistoryStore'''
+    def __init__(self, store, printer):
+        self.store = store
+        self.printer = printer
+
+    def update(self, detection):
+        '''Queue one detector result'''
+        self.store.add(self.printer, detection)
+
+    def log(self, msg):
+        '''Log messages are not recorded in the history'''
+        pass
+
+    def close(self):
+        '''The store is shared between printers, so it is stopped by its
+        owner'''
+        pass
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+metrics.py
+
+Lightweight performance counters
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import threading
+
+class LatencyStats(object):
+    '''Count, mean and worst case latency of named operations'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, name, seconds):
+        '''Record one sample for the named operation'''
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            stat[3] = seconds
+
+    def snapshot(self):
+        '''Return {name: {count, mean_ms, max_ms, last_ms}}'''
+        with self.lock:
+            return dict((name, {
+                'count': stat[0],
+                'mean_ms': 1000.0 * stat[1] / stat[0],
+                'max_ms': 1000.0 * stat[2],
+                'last_ms': 1000.0 * stat[3],
+            }) for name, stat in self.stats.items())
+
+    def summary(self):
+        '''One line human readable summary'''
+        return ', '.join('%s %d x %.1f ms (max %.1f)' % (name, stat['count'], stat['mean_ms'], stat['max_ms'])
+                         for name, stat in sorted(self.snapshot().items()))
+
+    def reset(self):
+        '''Discard all samples'''
+        with self.lock:
+            self.stats = {}
+
+class Counters(object):
+    '''Named event counters'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def increment(self, name, count=1):
+        '''Add count to the named counter'''
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def snapshot(self):
+        '''Return {name: count}'''
+        with self.lock:
+            return dict(self.counts)
+
+    def summary(self):
+        '''One line human readable summary'''
+        return ', '.join('%s %d' % (name, count) for name, count in sorted(self.snapshot().items()))
+
+    def reset(self):
+        '''Zero all counters'''
+        with self.lock:
+            self.counts = {}
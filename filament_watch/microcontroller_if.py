@@ -33,50 +33,302 @@ Interface to microcontroller connected to encoder
 #
 ##############################################################################
 
+import time
+import queue
+import struct
 import logging
+import binascii
+import threading
 import serial
 
-class ArduinoInterface(object):
+from .metrics import Counters, LatencyStats
+from .ring_buffer import TimeSeriesRing
+
+class FrameDecoder(object):
+    '''Decoder for the firmware's binary sample frames. Bytes are fed in as
+    they arrive; frames that fail the CRC, and any bytes between frames, are
+    skipped by searching for the next sync sequence.'''
+    sync = b'\xa5\x5a'
+    # Sequence number, micros() timestamp, position, CRC
+    frame = struct.Struct('<2sHIiH')
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        '''Add received bytes and return a list of the (sequence number,
+        timestamp, position) tuples of the complete frames'''
+        buf = self.buf
+        buf += data
+        frames = []
+        frame_size = self.frame.size
+        start = 0
+        while True:
+            sync_pos = buf.find(self.sync, start)
+            if sync_pos < 0:
+                # Keep a trailing first sync byte
+                end = len(buf) - 1 if buf.endswith(self.sync[:1]) else len(buf)
+                self.skipped_bytes += end - start
+                start = end
+                break
+            self.skipped_bytes += sync_pos - start
+            start = sync_pos
+            if len(buf) - start < frame_size:
+                break
+            _, seq, timestamp, pos, crc = self.frame.unpack_from(buf, start)
+            if binascii.crc_hqx(bytes(buf[start + 2:start + frame_size - 2]), 0xffff) != crc:
+                self.crc_errors += 1
+                self.skipped_bytes += 1
+                start += 1
+                continue
+            frames.append((seq, timestamp, pos))
+            self.frames += 1
+            start += frame_size
+        del buf[:start]
+        return frames
+
+class SerialReader(object):
+    '''Drains the serial port on a background thread so samples never wait
+    in the OS buffer while the main loop is busy. Each sample is queued as
+    (monotonic receive time, sequence number, device timestamp, position);
+    text samples have no sequence number or timestamp. When the queue is
+    full the oldest sample is dropped.'''
+    def __init__(self, port, binary, counters, queue_length): # pylint: disable=too-many-arguments
+        self.port = port
+        self.binary = binary
+        self.counters = counters
+        self.samples = queue.Queue(queue_length)
+        self.decoder = FrameDecoder()
+        self.partial_line = b''
+        self.synced = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='serial reader')
+        self.thread.daemon = True
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        '''Start reading'''
+        self.thread.start()
+
+    def stop(self):
+        '''Stop reading and wait for the thread to exit'''
+        self.stopped.set()
+        self.thread.join()
+
+    def put(self, sample):
+        '''Queue a sample, dropping the oldest if the consumer is behind'''
+        while True:
+            try:
+                self.samples.put_nowait(sample)
+                return
+            except queue.Full:
+                try:
+                    self.samples.get_nowait()
+                    self.counters.increment('dropped')
+                except queue.Empty:
+                    pass
+
+    def decode_lines(self, data, received):
+        '''Queue each complete line of text as a position. Anything before
+        the first position, such as binary frames sent before the firmware
+        switched to text and its acknowledgement, is skipped quietly.'''
+        lines = (self.partial_line + data).replace(b'\r', b'').split(b'\n')
+        self.partial_line = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self.put((received, None, None, int(line)))
+                self.synced = True
+            except ValueError:
+                if self.synced:
+                    self.logger.error('Invalid serial data: "%s"', line.decode('utf-8', 'ignore'))
+
+    def decode_frames(self, data, received):
+        '''Queue each complete binary frame'''
+        crc_errors = self.decoder.crc_errors
+        for seq, timestamp, pos in self.decoder.feed(data):
+            self.put((received, seq, timestamp, pos))
+        if self.decoder.crc_errors != crc_errors:
+            self.counters.increment('crc_errors', self.decoder.crc_errors - crc_errors)
+
+    def run(self):
+        '''Reader thread'''
+        while not self.stopped.is_set():
+            try:
+                data = self.port.read(max(1, self.port.in_waiting))
+            except serial.SerialException:
+                self.logger.exception('Error reading from encoder')
+                self.stopped.wait(1.0)
+                continue
+            if not data:
+                continue
+            received = time.monotonic()
+            if self.binary:
+                self.decode_frames(data, received)
+            else:
+                self.decode_lines(data, received)
+
+    def get(self, timeout):
+        '''Wait up to timeout for samples, then return every queued sample
+        in the order received'''
+        try:
+            samples = [self.samples.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                samples.append(self.samples.get_nowait())
+            except queue.Empty:
+                return samples
+
+class ArduinoInterface(object): # pylint: disable=too-many-instance-attributes
     '''Class to interface with Arduino running filament watch'''
-    def __init__(self, dev, baudrate, recent_length):
+    min_sample_rate = 1
+    max_sample_rate = 100
+
+    def __init__(self, dev, baudrate, recent_length, sample_rate=0, report_interval=1.0): # pylint: disable=too-many-arguments
         self.port = serial.Serial(dev, baudrate=baudrate, timeout=10.5)
         self.recent_length = recent_length
         self.recent_pos = None
         self.offset = 0
         self.logger = logging.getLogger(__name__)
+        self.report_interval = report_interval
+        self.read_timeout = 10.5
+        self.last_seq = None
+        self.last_timestamp = None
+        self.device_time = 0.0
+        self.last_report = None
+        # Serial lag is the time between receiving a sample and reporting it
+        self.latency = LatencyStats()
+        self.counters = Counters()
+        self.sample_rate = None
+        if sample_rate:
+            self.sample_rate = self.negotiate(sample_rate)
+            if self.sample_rate:
+                self.logger.info('Receiving %d binary samples per second', self.sample_rate)
+            else:
+                self.logger.info('Encoder firmware does not support binary samples, using text')
+        else:
+            # Firmware that was switched to binary frames by an earlier run
+            # keeps sending them until the board is reset
+            self.port.write(b'\nASCII\n')
+        # The reader wakes up this often to check whether it should stop
+        self.port.timeout = 0.5
+        self.reader = SerialReader(self.port, bool(self.sample_rate), self.counters,
+                                   int(10 * (self.sample_rate or 1) / report_interval) + 16)
+        self.reader.start()
+
+    def stop(self):
+        '''Stop reading and close the serial port'''
+        self.reader.stop()
+        self.port.close()
+
+    def negotiate(self, sample_rate, timeout=5.0):
+        '''Ask the firmware for binary frames at sample_rate per second.
+        Returns the rate acknowledged, or None if the firmware only sends
+        text, in which case its position lines are discarded until timeout.
+        The request is repeated since the board may still be in its
+        bootloader after the port is opened.'''
+        sample_rate = min(max(int(sample_rate), self.min_sample_rate), self.max_sample_rate)
+        deadline = time.time() + timeout
+        next_request = 0
+        self.port.timeout = 0.5
+        try:
+            while time.time() < deadline:
+                if time.time() >= next_request:
+                    self.port.write(b'\nBIN %d\n' % sample_rate)
+                    next_request = time.time() + 1.0
+                line = self.port.readline().strip()
+                if line.startswith(b'BIN '):
+                    try:
+                        return int(line[4:])
+                    except ValueError:
+                        pass
+                if line == b'ERR':
+                    return None
+        finally:
+            self.port.timeout = self.read_timeout
+        return None
 
     def get_pos_change(self):
-        '''Get current absolute position and position change'''
-        rcv = self.port.readline().decode('utf-8', 'ignore')
-        lines = rcv.replace('\r', '').split('\n')
-        lines = [l.strip() for l in lines if l.strip() != '']
-        pos = None
-
-        if len(lines) > 0:
-            if lines[-1]:
-                try:
-                    pos = int(lines[-1]) + self.offset
-                except ValueError:
-                    self.logger.error('Invalid serial data: "%s"', lines[-1])
-
-        if pos != None:
-            if self.recent_pos is None:
-                self.recent_pos = [pos] * self.recent_length
-
-            change = pos - self.recent_pos[-1]
-            if change > 32768:
-                self.offset -= 65536
-                pos -= 65536
-                self.logger.debug('New offset is %d', self.offset)
-            if change < -32768:
-                self.offset += 65536
-                pos += 65536
-                self.logger.debug('New offset is %d', self.offset)
-
-            self.recent_pos.append(pos)
-            self.recent_pos.pop(0)
-
-            change = pos - self.recent_pos[0]
-            change = abs(change) / len(self.recent_pos)
-            return [pos, change]
-        return [None, None]
+        '''Get current absolute position and position change. Samples that
+        arrived while the caller was busy are all added to the window, but
+        only the latest is reported.'''
+        deadline = time.monotonic() + self.read_timeout
+        reports = 0
+        while reports == 0:
+            samples = self.reader.get(max(0.0, deadline - time.monotonic()))
+            if not samples:
+                return [None, None]
+            for _, seq, timestamp, pos in samples:
+                if self.sample_rate:
+                    if self.add_frame(seq, timestamp, pos):
+                        reports += 1
+                else:
+                    pos = self.add_text_sample(pos)
+                    reports += 1
+        if reports > 1:
+            self.counters.increment('coalesced', reports - 1)
+        self.latency.record('serial_lag', time.monotonic() - samples[-1][0])
+
+        if self.sample_rate:
+            window = self.recent_pos.capacity
+            change = abs(self.recent_pos.rate(window)) * self.sample_rate
+        else:
+            change = abs(self.recent_pos.rate(self.recent_length))
+        return [pos, change]
+
+    def add_text_sample(self, pos):
+        '''Record one position from firmware using the text protocol, whose
+        16-bit position wraps. Returns the unwrapped position.'''
+        pos += self.offset
+        if self.recent_pos is None:
+            self.recent_pos = TimeSeriesRing(self.recent_length)
+            self.recent_pos.fill(pos)
+
+        change = pos - self.recent_pos.latest()
+        if change > 32768:
+            self.offset -= 65536
+            pos -= 65536
+            self.logger.debug('New offset is %d', self.offset)
+        if change < -32768:
+            self.offset += 65536
+            pos += 65536
+            self.logger.debug('New offset is %d', self.offset)
+
+        self.recent_pos.append(pos)
+        return pos
+
+    def add_frame(self, seq, timestamp, pos):
+        '''Record one binary sample. Samples lost in transit are replaced by
+        interpolating between their neighbours, so the window keeps covering
+        the same time. Returns True when a report interval of device time
+        has passed since the last report.'''
+        if self.recent_pos is None:
+            self.recent_pos = TimeSeriesRing(self.recent_length * self.sample_rate)
+            self.recent_pos.fill(pos, 0.0)
+            self.last_report = 0.0
+        else:
+            self.device_time += ((timestamp - self.last_timestamp) & 0xffffffff) / 1e6
+            lost = (seq - self.last_seq - 1) & 0xffff
+            if lost >= 0x8000:
+                # Repeated or reordered frame rather than a gap
+                self.logger.warning('Encoder sample %d out of sequence after %d', seq, self.last_seq)
+            elif lost:
+                self.counters.increment('lost', lost)
+                self.logger.warning('Lost %d encoder samples', lost)
+                last_pos = self.recent_pos.latest()
+                for i in range(1, min(lost, self.recent_pos.capacity) + 1):
+                    self.recent_pos.append(last_pos + (pos - last_pos) * i / (lost + 1.0), self.device_time)
+            self.recent_pos.append(pos, self.device_time)
+        self.last_seq = seq
+        self.last_timestamp = timestamp
+        if self.device_time - self.last_report >= self.report_interval:
+            self.last_report = self.device_time
+            return True
+        return False
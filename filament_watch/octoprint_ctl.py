@@ -33,86 +33,268 @@ OctoPrint control through its REST API
 #
 ##############################################################################
 
-import json
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .gcode_index import GcodeExtrusionParser, index_file
+from .metrics import LatencyStats
+from .ring_buffer import TimeSeriesRing
+
+def create_session(retries=2, backoff=0.2, pool_size=5, hosts=1):
+    '''Create a keep-alive HTTP session for talking to OctoPrint. Idempotent
+    requests are retried with exponential backoff on connection errors and
+    gateway errors. One session can be shared by every printer; it keeps up
+    to pool_size connections to each of up to hosts OctoPrint servers.'''
+    retry_args = {
+        'total': retries,
+        'connect': retries,
+        'read': retries,
+        'status': retries,
+        'backoff_factor': backoff,
+        'status_forcelist': (502, 503, 504),
+        'raise_on_status': False,
+    }
+    try:
+        retry = Retry(allowed_methods=frozenset(['GET', 'HEAD']), **retry_args)
+    except TypeError:
+        # urllib3 < 1.26
+        retry = Retry(method_whitelist=frozenset(['GET', 'HEAD']), **retry_args)
+    adapter = HTTPAdapter(pool_connections=max(pool_size, hosts), pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def print_in_progress(summary, tool0_target, gcode_filament_pos):
+    '''Whether the detector should treat a status as printing: OctoPrint's
+    summary says a print is in progress, the hot end has a target
+    temperature, and the G-code has called for some filament. While the
+    file is still being indexed there is no G-code position, so it is not
+    printing yet.'''
+    return (bool(summary) and summary.startswith('Printing ') and
+            bool(tool0_target) and gcode_filament_pos > 0)
+
+class GcodeWindow(object):
+    '''Filament the G-code has called for over the last recent_length
+    status updates of a print'''
+    def __init__(self, recent_length):
+        self.recent_length = recent_length
+        self.recent_gcode_pos = None
+
+    def clear(self):
+        '''Forget the print'''
+        self.recent_gcode_pos = None
+
+    def update(self, gcode_filament_pos):
+        '''Add the G-code filament position of the latest update and return
+        the change over the window. The window starts full of the first
+        position, so a print starts with no change.'''
+        if self.recent_gcode_pos is None:
+            self.recent_gcode_pos = TimeSeriesRing(self.recent_length)
+            self.recent_gcode_pos.fill(gcode_filament_pos)
+        self.recent_gcode_pos.append(gcode_filament_pos)
+        return self.recent_gcode_pos.rate(self.recent_length)
+
+class GcodeIndexJob(object):
+    '''Builds the extrusion index of one file on a background thread so that
+    status polling never waits on a download'''
+    def __init__(self, octoprint, filename):
+        self.octoprint = octoprint
+        self.filename = filename
+        self.progress = 0.0
+        self.index = None
+        self.finish_time = None
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='index %s' % (filename))
+        self.thread.daemon = True
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        '''Start indexing'''
+        self.thread.start()
+
+    def run(self):
+        '''Indexing thread'''
+        try:
+            index = self.octoprint.build_index(self.filename, self)
+            if index is not None:
+                self.progress = 100.0
+                self.logger.debug('Indexed %s: %d points', self.filename, len(index))
+            self.index = index
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            self.logger.exception('Error indexing %s', self.filename)
+        finally:
+            self.finish_time = time.time()
+
+    def cancel(self):
+        '''Abandon indexing at the next opportunity'''
+        self.cancelled.set()
+
+    def done(self):
+        '''True once the thread has finished, successfully or not'''
+        return self.finish_time is not None
 
 class OctoPrintAccess(object): # pylint: disable=too-many-instance-attributes
     '''Class to wrap API access to OctoPrint'''
-    def __init__(self, hostname, api_key, recent_length):
+    def __init__(self, hostname, api_key, recent_length, index_cache=None, # pylint: disable=too-many-arguments
+                 session=None, timeout=(3.05, 10), concurrent_status=True, push_status=None,
+                 uploads_dir=None, index_processes=1):
         self.hostname = hostname
         self.api_key = api_key
+        self.session = session if session is not None else create_session()
+        self.headers = {'X-Api-Key': api_key}
+        self.timeout = timeout
+        self.latency = LatencyStats()
+        self.concurrent_status = concurrent_status
+        self.status_executor = None
+        self.push_status = push_status
         self.cached_filename = None
-        self.cached_gcode = None
-        self.cached_filament_usage = None
-        self.cache_resolution = None
-        self.recent_gcode_pos = None
-        self.recent_length = recent_length
+        self.gcode_index = None
+        self.index_cache = index_cache
+        self.index_job = None
+        self.index_retry_interval = 30
+        self.download_chunk_size = 64 * 1024
+        self.uploads_dir = uploads_dir
+        self.index_processes = index_processes
+        self.gcode_window = GcodeWindow(recent_length)
         self.logger = logging.getLogger(__name__)
 
     def cache_clear(self):
         '''Clear gcode cache'''
+        if self.index_job is not None:
+            self.index_job.cancel()
+            self.index_job = None
         if self.cached_filename != None:
             self.logger.debug("Clearing cache of %s", self.cached_filename)
             self.cached_filename = None
-            self.cached_gcode = None
-            self.cached_filament_usage = None
-            self.cache_resolution = None
+            self.gcode_index = None
 
     def cache_file(self, filename):
-        '''Cache specified file from OctoPrint server'''
-        if filename == self.cached_filename and self.cached_gcode:
-            return
-        self.logger.debug("Caching %s", filename)
-        file_req = requests.get('http://%s/api/files/local/%s?apikey=%s' % (self.hostname, filename, self.api_key))
+        '''Start caching filament usage of specified file in the background.
+        Returns the indexing progress in percent, or None once the index is
+        ready.'''
+        if filename == self.cached_filename and self.gcode_index is not None:
+            return None
+
+        job = self.index_job
+        if job is not None and job.filename != filename:
+            job.cancel()
+            job = None
+
+        if job is not None and job.done():
+            self.index_job = None
+            if job.index is not None:
+                # Swap in the completed index
+                self.cached_filename = filename
+                self.gcode_index = job.index
+                return None
+            if time.time() - job.finish_time < self.index_retry_interval:
+                # Wait a while before retrying a failed download
+                self.index_job = job
+                return job.progress
+            job = None
+
+        if job is None:
+            self.logger.debug("Caching %s", filename)
+            self.cached_filename = None
+            self.gcode_index = None
+            job = GcodeIndexJob(self, filename)
+            self.index_job = job
+            job.start()
+        return job.progress
+
+    def build_index(self, filename, job):
+        '''Build the extrusion index of the specified file, from OctoPrint's
+        uploads folder if it is on this computer, otherwise by downloading
+        it. Returns None if the job is cancelled. Called from the indexing
+        thread.'''
+        file_req = self.api_get('/api/files/local/%s' % (filename), '/api/files/local')
+        file_req.raise_for_status()
         file_json = file_req.json()
+
+        if self.index_cache:
+            index = self.index_cache.load(file_json)
+            if index is not None:
+                return index
+
+        index = None
+        local_path = self.local_file(filename, file_json)
+        if local_path is not None:
+            try:
+                index = index_file(local_path, self.index_processes, cancelled=job.cancelled)
+                if index is None:
+                    return None
+                self.logger.debug('Indexed %s from %s', filename, local_path)
+            except (IOError, OSError):
+                self.logger.warning('Unable to read %s, downloading it instead', local_path, exc_info=True)
+        if index is None:
+            index = self.download_index(file_json, job)
+            if index is None:
+                return None
+
+        if self.index_cache:
+            self.index_cache.store(file_json, index)
+        return index
+
+    def local_file(self, filename, file_json):
+        '''Path of the specified file in the local uploads folder, or None if
+        it isn't there or doesn't match the file OctoPrint describes'''
+        if not self.uploads_dir or file_json.get('origin', 'local') != 'local':
+            return None
+        uploads_dir = os.path.realpath(os.path.expanduser(self.uploads_dir))
+        path = os.path.realpath(os.path.join(uploads_dir, file_json.get('path', filename)))
+        if not path.startswith(uploads_dir + os.sep):
+            return None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        # A different OctoPrint's uploads, or a file being replaced
+        if file_json.get('size') is not None and size != file_json['size']:
+            return None
+        return path
+
+    def download_index(self, file_json, job):
+        '''Download the specified file and build its extrusion index, or
+        return None if the job is cancelled. Raises an HTTPError if OctoPrint
+        refuses the download and a ValueError if it ends early, so that no
+        partial index is cached.'''
         dl_url = file_json['refs']['download']
-        gcode_req = requests.get('%s?apikey=%s' % (dl_url, self.api_key))
-        self.cached_filename = filename
-        self.cached_gcode = gcode_req.text
-        self.cache_resolution = 16
-        # Add one to length in case there's no line ending at the end of the
-        # file, then add another one since this is the position of the last
-        # element
-        self.cached_filament_usage = [None] * int((len(self.cached_gcode) + 1) / self.cache_resolution + 1)
-
-        # Measure the amount of filament used by the specified gcode
-        total = 0
-        last_extrude = 0.0
-        file_pos = 0
-
-        # Update usage at beginning of file
-        self.cached_filament_usage[int(file_pos / self.cache_resolution)] = total
-
-        # Step through each line of the file
-        for line in self.cached_gcode.split('\n'):
-            file_pos += len(line) + 1
-            if line.startswith('G92 '):
-                for token in line.split(' '):
-                    if token[0:1] == 'E':
-                        last_extrude = float(token[1:])
-            if line.startswith('G1 '):
-                for token in line.split(' '):
-                    if token[0:1] == 'E':
-                        dist = float(token[1:])
-                        total += dist - last_extrude
-                        last_extrude = dist
-                        self.cached_filament_usage[int(file_pos / self.cache_resolution)] = total
-        # Update usage at end of file
-        self.cached_filament_usage[int(file_pos / self.cache_resolution)] = total
-
-        # Fill in any gaps
-        for idx in range(len(self.cached_filament_usage)):
-            if self.cached_filament_usage[idx] is None:
-                self.cached_filament_usage[idx] = self.cached_filament_usage[idx - 1]
+        file_size = file_json.get('size')
+
+        # Parse the file as it downloads so the full text is never held in
+        # memory
+        parser = GcodeExtrusionParser()
+        gcode_req = self.request('GET', dl_url, 'download', stream=True)
+        try:
+            gcode_req.raise_for_status()
+            downloaded = 0
+            for chunk in gcode_req.iter_content(chunk_size=self.download_chunk_size):
+                if job.cancelled.is_set():
+                    return None
+                parser.feed(chunk)
+                downloaded += len(chunk)
+                if file_size:
+                    job.progress = min(100.0, 100.0 * downloaded / file_size)
+        finally:
+            gcode_req.close()
+        if file_size is not None and downloaded != file_size:
+            raise ValueError('Downloaded %d of %d bytes' % (downloaded, file_size))
+        return parser.finish()
 
     def measure_filament(self, file_pos):
         '''Determine how much filament has been used at the specified point in the file'''
-        if not self.cached_filament_usage:
+        if self.gcode_index is None:
             return 0
         if file_pos < 0:
-            return self.cached_filament_usage[-1]
-        return self.cached_filament_usage[int(file_pos / self.cache_resolution)]
+            return self.gcode_index.total()
+        return self.gcode_index.lookup(file_pos)
 
     def status_summary(self, printer_json, job_json): # pylint: disable=no-self-use
         """Convert print and job JSON to a meaningful human readable status"""
@@ -161,61 +343,93 @@ class OctoPrintAccess(object): # pylint: disable=too-many-instance-attributes
 
         return state
 
-    def status(self):
-        """Extract various status parameters from OctoPrint"""
-        stat = {}
-        stat['printing'] = False
-        stat['summary'] = None
-        stat['state'] = None
-        stat['bed_actual'] = -1
-        stat['bed_target'] = -1
-        stat['tool0_actual'] = -1
-        stat['tool0_target'] = -1
-        stat['file_pos'] = -1
-        stat['file_name'] = ''
-        stat['file_size'] = -1
-        stat['gcode_filament_pos'] = -1
-        stat['gcode_filament_total'] = -1
-        stat['gcode_change'] = 0
+    def fetch_job(self):
+        '''Fetch the current job from OctoPrint'''
+        return self.api_get('/api/job').json()
+
+    def poll_status(self, stat):
+        '''Fetch printer and job status over the REST API. Returns
+        (printer_json, job_json), or None after setting stat['summary'] if
+        either is unavailable.'''
+        # Fetch the job in parallel with the printer status. Its result is only
+        # used if the printer status is valid, exactly as if fetched afterwards.
+        job_future = None
+        if self.concurrent_status:
+            if self.status_executor is None:
+                self.status_executor = ThreadPoolExecutor(max_workers=1)
+            job_future = self.status_executor.submit(self.fetch_job)
 
         printer_req = None
         printer_req_text = None
         try:
-            printer_req = requests.get('http://%s/api/printer?apikey=%s' % (self.hostname, self.api_key))
+            printer_req = self.api_get('/api/printer')
             printer_req_text = printer_req.text
             if printer_req.status_code == 200:
                 printer_json = printer_req.json()
             else:
                 self.logger.debug('Status code %d querying /api/printer', printer_req.status_code)
                 printer_json = None
-        except requests.exceptions.ConnectionError:
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
             stat['summary'] = 'OctoPrint down'
-            return stat
+            return None
         except ValueError:
             self.logger.exception('ValueError processing printer status')
             stat['summary'] = 'ValueError processing printer status'
-            return stat
+            return None
 
         if printer_json is None:
             if printer_req_text.lower() == 'printer is not operational':
                 stat['summary'] = 'Offline'
-                return stat
+                return None
             stat['summary'] = printer_req_text
-            return stat
+            return None
 
         job_json = None
         try:
-            job_req = requests.get('http://%s/api/job?apikey=%s' % (self.hostname, self.api_key))
-            job_json = job_req.json()
-        except (requests.exceptions.ConnectionError, ValueError):
+            if job_future is not None:
+                job_json = job_future.result()
+            else:
+                job_json = self.fetch_job()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, ValueError):
             self.logger.exception('Connection error')
             stat['summary'] = 'Connection error'
-            return stat
+            return None
+
+        return printer_json, job_json
+
+    def status(self):
+        """Extract various status parameters from OctoPrint"""
+        stat = {}
+        stat['printing'] = False
+        stat['summary'] = None
+        stat['state'] = None
+        stat['bed_actual'] = -1
+        stat['bed_target'] = -1
+        stat['tool0_actual'] = -1
+        stat['tool0_target'] = -1
+        stat['file_pos'] = -1
+        stat['file_name'] = ''
+        stat['file_size'] = -1
+        stat['gcode_filament_pos'] = -1
+        stat['gcode_filament_total'] = -1
+        stat['gcode_change'] = 0
+        stat['indexing'] = False
+        stat['index_progress'] = -1
+
+        status_json = None
+        if self.push_status is not None:
+            status_json = self.push_status.snapshot()
+            if status_json is not None and status_json[0] is None:
+                stat['summary'] = 'Offline'
+                return stat
+        if status_json is None:
+            status_json = self.poll_status(stat)
+            if status_json is None:
+                return stat
+        printer_json, job_json = status_json
 
         try:
             stat['summary'] = self.status_summary(printer_json, job_json)
-            if stat['summary'].startswith('Printing '):
-                stat['printing'] = True
 
             if printer_json:
                 stat['bed_actual'] = float(printer_json['temperature']['bed']['actual'])
@@ -228,11 +442,10 @@ class OctoPrintAccess(object): # pylint: disable=too-many-instance-attributes
                     stat['tool0_target'] = float(printer_json['temperature']['tool0']['target'])
                 else:
                     stat['tool0_target'] = 0
-                    stat['printing'] = False
                 stat['state'] = job_json['state']
                 if stat['state'] != 'Printing':
                     self.cache_clear()
-                    self.recent_gcode_pos = None
+                    self.gcode_window.clear()
 
             if job_json:
                 if job_json['progress']['filepos']:
@@ -241,17 +454,15 @@ class OctoPrintAccess(object): # pylint: disable=too-many-instance-attributes
                     stat['file_name'] = job_json['job']['file']['name']
 
             if stat['file_name'] and stat['state'] == 'Printing':
-                self.cache_file(stat['file_name'])
-                if self.cached_gcode:
+                index_progress = self.cache_file(stat['file_name'])
+                if index_progress is not None:
+                    stat['indexing'] = True
+                    stat['index_progress'] = index_progress
+                    stat['summary'] = 'Indexing %s - %.0f%%' % (stat['file_name'], index_progress)
+                if self.gcode_index is not None:
                     stat['gcode_filament_pos'] = self.measure_filament(stat['file_pos'])
                     stat['gcode_filament_total'] = self.measure_filament(-1)
-
-                    if self.recent_gcode_pos is None:
-                        self.recent_gcode_pos = [stat['gcode_filament_pos']] * self.recent_length
-
-                    self.recent_gcode_pos.append(stat['gcode_filament_pos'])
-                    self.recent_gcode_pos.pop(0)
-                    stat['gcode_change'] = (self.recent_gcode_pos[-1] - self.recent_gcode_pos[0]) / len(self.recent_gcode_pos)
+                    stat['gcode_change'] = self.gcode_window.update(stat['gcode_filament_pos'])
 
         except KeyError:
             self.logger.exception('Key error processing status')
@@ -259,34 +470,49 @@ class OctoPrintAccess(object): # pylint: disable=too-many-instance-attributes
         except TypeError:
             self.logger.exception('Type error processing status')
             stat['summary'] = 'Type error processing status'
-        if stat['gcode_filament_pos'] <= 0:
-            stat['printing'] = False
+        stat['printing'] = print_in_progress(stat['summary'], stat['tool0_target'], stat['gcode_filament_pos'])
 
         return stat
 
+    def request(self, method, url, endpoint, **kwargs):
+        '''Issue a request through the pooled session, recording its latency
+        under the endpoint name'''
+        start = time.time()
+        try:
+            return self.session.request(method, url, headers=self.headers, timeout=self.timeout, **kwargs)
+        finally:
+            self.latency.record(endpoint, time.time() - start)
+
+    def api_get(self, path, endpoint=None):
+        '''GET an OctoPrint API path'''
+        return self.request('GET', 'http://%s%s' % (self.hostname, path), endpoint or path)
+
+    def api_post(self, path, payload):
+        '''POST a JSON command to an OctoPrint API path. Returns None if
+        OctoPrint could not be reached.'''
+        try:
+            return self.request('POST', 'http://%s%s' % (self.hostname, path), path, json=payload)
+        except requests.exceptions.RequestException as exc:
+            self.logger.error('Error posting %s to %s: %s', payload['command'], path, exc)
+            return None
+
     def issue_job_cmd(self, cmd):
         """Issue a job command like start or cancel"""
         payload = {'command': cmd}
-        url = 'http://%s/api/job' % (self.hostname)
-        headers = {'Content-Type': 'application/json', 'X-Api-Key': self.api_key}
-        req = requests.post(url, data=json.dumps(payload), headers=headers)
-        if req.status_code != 204:
+        req = self.api_post('/api/job', payload)
+        if req is not None and req.status_code != 204:
             self.logger.error('Received status code %d trying to issue job command "%s": %s', req.status_code, cmd, req.text)
 
     def jog(self, jog_x, jog_y, jog_z):
         """Job the print head"""
         payload = {'command': 'jog', 'x': jog_x, 'y': jog_y, 'z': jog_z}
-        url = 'http://%s/api/printer/printhead' % (self.hostname)
-        headers = {'Content-Type': 'application/json', 'X-Api-Key': self.api_key}
-        req = requests.post(url, data=json.dumps(payload), headers=headers)
-        if req.status_code != 204:
+        req = self.api_post('/api/printer/printhead', payload)
+        if req is not None and req.status_code != 204:
             self.logger.error('Received status code %d trying to jog head: %s', req.status_code, req.text)
 
     def home_head_xy(self):
         """Home the print head in xy plane"""
         payload = {'command': 'home', 'axes': ['x', 'y']}
-        url = 'http://%s/api/printer/printhead' % (self.hostname)
-        headers = {'Content-Type': 'application/json', 'X-Api-Key': self.api_key}
-        req = requests.post(url, data=json.dumps(payload), headers=headers)
-        if req.status_code != 204:
+        req = self.api_post('/api/printer/printhead', payload)
+        if req is not None and req.status_code != 204:
             self.logger.error('Received status code %d trying to home head: %s', req.status_code, req.text)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+octoprint_push.py
+
+OctoPrint status pushed over its SockJS socket
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import json
+import logging
+import random
+import string
+import threading
+import time
+import requests
+
+class OctoPrintPushStatus(object): # pylint: disable=too-many-instance-attributes
+    '''Subscribe to the "current" messages OctoPrint pushes over its SockJS
+    socket, using the plain HTTP xhr_streaming transport, and keep the
+    latest status in memory.
+
+    snapshot() returns the status in the same (printer_json, job_json) form
+    as the /api/printer and /api/job responses, or None if the stream is
+    not connected and the caller should poll instead.'''
+    def __init__(self, hostname, api_key, session, connect_timeout=3.05, heartbeat_timeout=35):
+        self.hostname = hostname
+        self.api_key = api_key
+        self.session = session
+        self.headers = {'X-Api-Key': api_key}
+        self.connect_timeout = connect_timeout
+        # SockJS sends a heartbeat every 25 seconds, so a longer silence
+        # means the connection is dead
+        self.heartbeat_timeout = heartbeat_timeout
+        self.reconnect_delay = 5
+        self.current = None
+        self.temps = None
+        self.last_frame_time = 0
+        self.connected = False
+        self.stop_event = threading.Event()
+        self.session_url = None
+        self.response = None
+        self.thread = None
+        self.logger = logging.getLogger(__name__)
+
+    def start(self):
+        '''Start the subscription thread'''
+        self.thread = threading.Thread(target=self.run, name='octoprint push')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Stop the subscription thread'''
+        self.stop_event.set()
+        response = self.response
+        if response is not None:
+            response.close()
+        if self.thread is not None:
+            self.thread.join(self.connect_timeout + 1)
+            self.thread = None
+
+    def snapshot(self):
+        '''Latest status as (printer_json, job_json), (None, None) if the
+        printer is not operational, or None if no fresh status is available'''
+        current = self.current
+        temps = self.temps
+        if not self.connected or current is None or temps is None:
+            return None
+        if time.time() - self.last_frame_time > self.heartbeat_timeout:
+            return None
+
+        state = current.get('state') or {}
+        if not (state.get('flags') or {}).get('operational', True):
+            return None, None
+        printer_json = {
+            'temperature': temps,
+            'state': state,
+        }
+        job_json = {
+            'job': current.get('job'),
+            'progress': current.get('progress'),
+            'state': state.get('text'),
+        }
+        return printer_json, job_json
+
+    def handle_message(self, message):
+        '''Process one message from OctoPrint'''
+        for msg_type in ('history', 'current'):
+            if msg_type not in message:
+                continue
+            current = message[msg_type]
+            temps = current.get('temps')
+            if temps:
+                latest = temps[-1]
+                self.temps = dict((dev, latest[dev]) for dev in latest if dev != 'time')
+            self.current = current
+
+    def handle_frame(self, frame):
+        '''Process one SockJS frame. Returns False if the server closed the
+        session.'''
+        self.last_frame_time = time.time()
+        if frame.startswith(b'a'):
+            for message in json.loads(frame[1:].decode('utf-8')):
+                if not isinstance(message, dict):
+                    message = json.loads(message)
+                self.handle_message(message)
+        elif frame.startswith(b'o'):
+            self.connected = True
+            self.authenticate()
+        elif frame.startswith(b'c'):
+            self.logger.info('OctoPrint closed push connection: %s', frame[1:].decode('utf-8', 'replace'))
+            return False
+        # Anything else is a heartbeat or the streaming prelude
+        return True
+
+    def authenticate(self):
+        '''Authenticate the socket so OctoPrint will send status to it'''
+        try:
+            login_req = self.session.post('http://%s/api/login' % (self.hostname), json={'passive': True},
+                                          headers=self.headers, timeout=self.connect_timeout)
+            login_json = login_req.json()
+            auth = json.dumps({'auth': '%s:%s' % (login_json['name'], login_json['session'])})
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            # Older versions of OctoPrint send status without authentication
+            self.logger.debug('Unable to get session for push authentication')
+            return
+        self.send(auth)
+
+    def send(self, message):
+        '''Send a message to OctoPrint over the socket'''
+        try:
+            self.session.post('%s/xhr_send' % (self.session_url), data=json.dumps([message]),
+                              headers=dict(self.headers, **{'Content-Type': 'text/plain'}),
+                              timeout=self.connect_timeout)
+        except requests.exceptions.RequestException:
+            self.logger.exception('Error sending push message')
+
+    def run(self):
+        '''Subscription thread: connect, stream frames, reconnect on error'''
+        while not self.stop_event.is_set():
+            server_id = '%03d' % (random.randint(0, 999))
+            session_id = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(8))
+            self.session_url = 'http://%s/sockjs/%s/%s' % (self.hostname, server_id, session_id)
+            try:
+                self.response = self.session.post('%s/xhr_streaming' % (self.session_url), headers=self.headers,
+                                                  stream=True, timeout=(self.connect_timeout, self.heartbeat_timeout))
+                if self.response.status_code != 200:
+                    self.logger.error('Status code %d opening OctoPrint push connection', self.response.status_code)
+                else:
+                    self.logger.info('Subscribed to OctoPrint push status')
+                    for frame in self.response.iter_lines(chunk_size=None):
+                        if self.stop_event.is_set() or not self.handle_frame(frame):
+                            break
+            except (requests.exceptions.RequestException, ValueError, AttributeError) as exc:
+                if not self.stop_event.is_set():
+                    self.logger.info('OctoPrint push connection lost: %s', exc)
+            finally:
+                self.connected = False
+                if self.response is not None:
+                    self.response.close()
+                    self.response = None
+            self.stop_event.wait(self.reconnect_delay)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+replay.py
+
+Replay recorded prints through the filament detector offline
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import argparse
+import csv
+import gzip
+import itertools
+import json
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+
+from .detector import FilamentDetector
+from .gcode_index import index_file
+from .octoprint_ctl import GcodeWindow, print_in_progress
+from .ring_buffer import TimeSeriesRing
+
+# Settings that change what the detector decides, and their types
+TUNABLE_SETTINGS = (
+    ('alarmchangethreshold', float),
+    ('alarmminprinttime', int),
+    ('windowduration', int),
+    ('encoderscalingfactor', float),
+)
+
+def parse_field(text, convert, default):
+    '''Convert one CSV field, or return default if it is empty or 'None'.
+    Raises ValueError if it is malformed.'''
+    if text is None or text == '' or text == 'None':
+        return default
+    return convert(text)
+
+def read_csv_log(path):
+    '''Yield one record per row of a CSV log written by CsvSink, which may be
+    gzip compressed. The log only has the time of day, so times count from
+    midnight before the first row, and a day is added whenever the time of
+    day goes backwards. Malformed rows, e.g. one cut short by a power cut,
+    are skipped.'''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='') as log:
+        day = 0
+        last_time = None
+        for row in csv.DictReader(log):
+            try:
+                hours, minutes, seconds = row['Time'].split(':')
+                timestamp = day * 86400 + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+                if last_time is not None and timestamp < last_time:
+                    day += 1
+                    timestamp += 86400
+                record = {
+                    'time': timestamp,
+                    'alarm': row['Alarm'] == 'True',
+                    'printing': row['Printing'] == 'True',
+                    'pos': int(parse_field(row['Filament Position'], float, None)),
+                    'summary': parse_field(row['Summary'], str, ''),
+                    'state': parse_field(row['State'], str, None),
+                    'file_name': parse_field(row['Filename'], str, ''),
+                    'file_pos': parse_field(row['File Position'], int, -1),
+                    'gcode_filament_pos': parse_field(row['G-code Filament Position'], float, -1),
+                    'tool0_target': parse_field(row['Hot End Target'], float, -1),
+                }
+            except (AttributeError, KeyError, TypeError, ValueError):
+                continue
+            last_time = timestamp
+            yield record
+
+class Replay(object):
+    '''Feeds recorded reports through a FilamentDetector, averaging encoder
+    and G-code positions over the same windows as ArduinoInterface and
+    OctoPrintAccess do live.
+
+    indexes maps G-code file names to extrusion indexes. Reports of a file
+    with an index get their G-code filament position from it; otherwise
+    the recorded position is used. The encoder window is one report per
+    second, as in the text protocol.'''
+    def __init__(self, settings, indexes=None):
+        self.window = settings['windowduration']
+        self.detector = FilamentDetector(settings['alarmchangethreshold'], settings['alarmminprinttime'],
+                                         settings['encoderscalingfactor'])
+        self.indexes = indexes or {}
+        self.recent_pos = None
+        self.gcode_window = GcodeWindow(self.window)
+
+    def status(self, record):
+        '''Status of one recorded report as OctoPrintAccess.status would
+        have returned it'''
+        stat = {
+            'printing': record['printing'],
+            'state': record['state'],
+            'file_name': record['file_name'],
+            'file_pos': record['file_pos'],
+            'gcode_filament_pos': record['gcode_filament_pos'],
+            'gcode_change': 0,
+        }
+        if stat['state'] != 'Printing':
+            self.gcode_window.clear()
+            return stat
+
+        index = self.indexes.get(stat['file_name'])
+        if index is not None:
+            # Indexed at once, where the live run may have been waiting for
+            # its download
+            if stat['file_pos'] < 0:
+                stat['gcode_filament_pos'] = index.total()
+            else:
+                stat['gcode_filament_pos'] = index.lookup(stat['file_pos'])
+            stat['printing'] = print_in_progress(record['summary'], record['tool0_target'],
+                                                 stat['gcode_filament_pos'])
+        if stat['file_name'] and stat['gcode_filament_pos'] >= 0:
+            stat['gcode_change'] = self.gcode_window.update(stat['gcode_filament_pos'])
+        return stat
+
+    def update(self, record):
+        '''Process one recorded report. Returns the detector result.'''
+        pos = record['pos']
+        if self.recent_pos is None:
+            self.recent_pos = TimeSeriesRing(self.window)
+            self.recent_pos.fill(pos)
+        self.recent_pos.append(pos)
+        change = abs(self.recent_pos.rate(self.window))
+        return self.detector.update(pos, change, self.status(record))
+
+def format_time(timestamp):
+    '''Time of a replayed report, as day and time of day'''
+    day, seconds = divmod(int(timestamp), 86400)
+    return 'day %d %02d:%02d:%02d' % (day + 1, seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def replay_records(records, settings, indexes=None):
+    '''Replay recorded reports with one set of settings. Returns a list of
+    the prints seen, each with the time the alarm would first have fired,
+    if it would, and whether it fired when recorded.'''
+    replay = Replay(settings, indexes)
+    prints = []
+    current = None
+    for record in records:
+        detection = replay.update(record)
+        if detection['started']:
+            current = {'file_name': record['file_name'], 'start': record['time'], 'end': None,
+                       'alarm': None, 'recorded_alarm': False}
+            prints.append(current)
+        elif detection['stopped'] and current is not None:
+            current['end'] = record['time']
+            current = None
+        if current is not None:
+            current['recorded_alarm'] = current['recorded_alarm'] or record['alarm']
+            if detection['alarm'] and current['alarm'] is None:
+                current['alarm'] = record['time']
+    return prints
+
+# Per process cache of the most recently read log, so a worker given
+# several settings for the same log reads it once
+WORKER_STATE = {'indexes': {}, 'path': None, 'records': None}
+
+def init_worker(indexes):
+    '''Set up a replay worker process'''
+    WORKER_STATE['indexes'] = indexes
+
+def replay_task(task):
+    '''Replay one log with one set of settings in a worker process'''
+    path, settings = task
+    if WORKER_STATE['path'] != path:
+        WORKER_STATE['records'] = list(read_csv_log(path))
+        WORKER_STATE['path'] = path
+    records = WORKER_STATE['records']
+    return {
+        'log': path,
+        'settings': settings,
+        'reports': len(records),
+        'prints': replay_records(records, settings, WORKER_STATE['indexes']),
+    }
+
+def replay_grid(logs, grid, indexes=None, processes=None):
+    '''Replay every log with every set of settings in grid across a pool
+    of processes. Yields results in order: every set of settings for the
+    first log, then the second, and so on.'''
+    tasks = [(path, settings) for path in logs for settings in grid]
+    if not tasks:
+        return
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(tasks))
+    if processes <= 1:
+        init_worker(indexes or {})
+        for task in tasks:
+            yield replay_task(task)
+        return
+    # Consecutive tasks share a log, so larger chunks mean fewer reads,
+    # but each worker should still get several chunks to balance the load
+    chunk_size = max(1, int(math.ceil(len(tasks) / (processes * 4.0))))
+    with ProcessPoolExecutor(processes, initializer=init_worker, initargs=(indexes or {},)) as executor:
+        for result in executor.map(replay_task, tasks, chunksize=chunk_size):
+            yield result
+
+def parse_values(text, convert):
+    '''Convert a comma separated list of setting values'''
+    return [convert(value) for value in text.split(',') if value.strip()]
+
+def get_args():
+    '''Parse command line arguments'''
+    parser = argparse.ArgumentParser(description='Replay CSV logs of past prints through the filament detector '
+                                                 'and report when the alarm would have fired. Settings not given '
+                                                 'are read from the configuration file.')
+    parser.add_argument('logs', nargs='+', help='CSV logs written with --csvlog, optionally gzip compressed')
+    parser.add_argument('--gcode', action='append', default=[],
+                        help='G-code file printed in the logs, matched by file name (may be repeated)')
+    for name, _ in TUNABLE_SETTINGS:
+        parser.add_argument('--%s' % (name), help='Comma separated values of %s to try' % (name))
+    parser.add_argument('--processes', type=int, help='Number of processes to index and replay in (default: one per CPU)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--config', default=os.path.expanduser("~/.filament_watch"), help='Configuration file')
+    return parser.parse_args()
+
+def main():
+    '''Replay logs with each combination of settings and summarise the
+    alarms'''
+    args = get_args()
+
+    config = {'alarmchangethreshold': 0.1, 'alarmminprinttime': 120, 'windowduration': 120,
+              'encoderscalingfactor': 0.040}
+    if os.path.isfile(args.config):
+        with open(args.config) as cfg_file:
+            config.update(yaml.safe_load(cfg_file) or {})
+
+    values = []
+    for name, convert in TUNABLE_SETTINGS:
+        if vars(args)[name] is not None:
+            values.append(parse_values(vars(args)[name], convert))
+        else:
+            values.append([convert(config[name])])
+    names = [name for name, _ in TUNABLE_SETTINGS]
+    grid = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+    indexes = {}
+    for path in args.gcode:
+        indexes[os.path.basename(path)] = index_file(path, args.processes)
+
+    start = time.time()
+    results = list(replay_grid(args.logs, grid, indexes, args.processes))
+    elapsed = time.time() - start
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+        return
+
+    reports = 0
+    for settings in grid:
+        print(', '.join('%s=%s' % (name, settings[name]) for name in names))
+        alarms = 0
+        prints = 0
+        for result in results:
+            if result['settings'] != settings:
+                continue
+            reports += result['reports']
+            for print_info in result['prints']:
+                prints += 1
+                if print_info['alarm'] is None and not print_info['recorded_alarm']:
+                    continue
+                if print_info['alarm'] is not None:
+                    alarms += 1
+                    outcome = 'alarm after %d s' % (print_info['alarm'] - print_info['start'])
+                else:
+                    outcome = 'no alarm'
+                print('  %s: %s started %s: %s%s' % (
+                    os.path.basename(result['log']), print_info['file_name'] or 'print',
+                    format_time(print_info['start']), outcome,
+                    ' (alarm when recorded)' if print_info['recorded_alarm'] else ''))
+        print('  %d of %d prints would have raised the alarm' % (alarms, prints))
+    print('Replayed %d reports in %.1f s (%.0f reports/s)' % (reports, elapsed, reports / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ring_buffer.py
+
+Fixed capacity time series for sliding window measurements
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import time
+from array import array
+
+class TimeSeriesRing(object):
+    '''Ring buffer of timestamped samples. Appending and querying the change
+    over the last n samples are O(1), so several window lengths up to the
+    capacity can be served from one buffer.'''
+    __slots__ = ('capacity', 'times', 'values', 'head', 'count')
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('Capacity must be at least 1')
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        # Index the next sample will be written to
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value, timestamp=None):
+        '''Add a sample, overwriting the oldest once full'''
+        if timestamp is None:
+            timestamp = time.time()
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        if self.count < self.capacity:
+            self.count += 1
+
+    def fill(self, value, timestamp=None):
+        '''Replace the contents with capacity copies of one sample'''
+        if timestamp is None:
+            timestamp = time.time()
+        self.times = array('d', [timestamp]) * self.capacity
+        self.values = array('d', [value]) * self.capacity
+        self.head = 0
+        self.count = self.capacity
+
+    def clear(self):
+        '''Discard all samples'''
+        self.head = 0
+        self.count = 0
+
+    def index(self, ago):
+        '''Buffer index of the sample ago samples before the latest'''
+        if ago < 0 or ago >= self.count:
+            raise IndexError('Only %d samples available' % (self.count))
+        return (self.head - 1 - ago) % self.capacity
+
+    def latest(self):
+        '''Most recent value'''
+        return self.values[self.index(0)]
+
+    def value(self, ago):
+        '''Value ago samples before the latest'''
+        return self.values[self.index(ago)]
+
+    def timestamp(self, ago):
+        '''Timestamp of the sample ago samples before the latest'''
+        return self.times[self.index(ago)]
+
+    def delta(self, window):
+        '''Change in value across the last window samples (the latest minus
+        the sample window - 1 before it)'''
+        count = self.count
+        if count == 0:
+            raise IndexError('No samples available')
+        if window > count:
+            window = count
+        head = self.head
+        values = self.values
+        return values[head - 1] - values[head - window]
+
+    def rate(self, window):
+        '''Average change per sample across the last window samples'''
+        return self.delta(window) / float(window)
+
+    def duration(self, window):
+        '''Time spanned by the last window samples'''
+        count = self.count
+        if count == 0:
+            raise IndexError('No samples available')
+        if window > count:
+            window = count
+        return self.times[self.head - 1] - self.times[self.head - window]
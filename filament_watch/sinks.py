@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+sinks.py
+
+Destinations for detector results
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import os
+import io
+import csv
+import glob
+import gzip
+import time
+import shutil
+import logging
+import threading
+
+class WebSink(object):
+    '''Feeds detector results and log messages to one printer's dashboard,
+    a WebServer or the PrinterStatus of one of its printers'''
+    def __init__(self, web_status):
+        self.web_status = web_status
+
+    def update(self, detection):
+        '''Publish one detector result'''
+        stat = detection['stat']
+        chart_time = detection['time'] * 1000
+        self.web_status.update({
+            'gcode': [chart_time, stat['gcode_change']],
+            'actual': [chart_time, detection['meas_change_norm']],
+            'alarm': detection['alarm'],
+            'printing': stat['printing'],
+            'valid': detection['valid'],
+            'time_to_valid': detection['time_to_valid'],
+            'filament_pos': detection['pos'],
+            'summary': stat['summary'],
+            'file_pos': stat['file_pos'],
+            'bed_target': stat['bed_target'],
+            'bed_actual': stat['bed_actual'],
+            'tool0_target': stat['tool0_target'],
+            'tool0_actual': stat['tool0_actual'],
+        })
+
+    def log(self, msg):
+        '''Append a log message'''
+        self.web_status.log(msg)
+
+    def close(self):
+        '''The web server may be shared between printers, so it is stopped
+        by its owner'''
+        pass
+
+class CsvSink(object): # pylint: disable=too-many-instance-attributes
+    '''CSV log of detector results. While idle, only one row is written per
+    idle_logging_interval results.
+
+    While printing, rows are buffered and written in one go every
+    flush_interval seconds, or at once (and synced to disk) when the alarm
+    is set, so an SD card sees one write per batch rather than per row.
+
+    The log is appended to across restarts. It is rotated once it reaches
+    max_bytes or crosses a rotate_interval boundary; rotated logs are gzip
+    compressed in the background and only the newest backups of them are
+    kept, none if backups is 0.'''
+    field_names = ['Time', 'Alarm', 'Printing', 'Valid',
+                   'Filament Position', 'Measured Change', 'GCode Change',
+                   'Summary', 'State', 'Filename', 'File Position',
+                   'File Size', 'G-code Filament Position', 'G-code Filament Total',
+                   'Bed Target', 'Bed Actual', 'Hot End Target', 'Hot End Actual']
+
+    def __init__(self, path, idle_logging_interval=60, flush_interval=30, # pylint: disable=too-many-arguments
+                 max_bytes=10 * 1024 * 1024, rotate_interval=24 * 3600, backups=7):
+        self.path = path
+        self.idle_logging_interval = idle_logging_interval
+        self.skipped_log_count = idle_logging_interval
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.last_flush = None
+        self.csv = None
+        self.size = 0
+        self.period = None
+        self.compressors = []
+        self.logger = logging.getLogger(__name__)
+        self.open()
+
+    def open(self):
+        '''Open the log for appending, writing the header if it is new'''
+        self.csv = open(self.path, 'a', newline='')
+        self.size = self.csv.tell()
+        if self.size == 0:
+            self.period = self.rotation_period(time.time())
+            self.writer.writerow(self.field_names)
+        else:
+            self.period = self.rotation_period(os.path.getmtime(self.path))
+
+    def rotation_period(self, timestamp):
+        '''Index of the rotate_interval long period containing timestamp'''
+        if not self.rotate_interval:
+            return 0
+        return int(timestamp // self.rotate_interval)
+
+    def update(self, detection):
+        '''Log one detector result'''
+        stat = detection['stat']
+        if (stat['printing'] or detection['alarm'] or detection['meas_change_raw'] != 0 or
+                self.skipped_log_count >= (self.idle_logging_interval - 1)):
+            if self.rotation_period(detection['time']) != self.period:
+                self.rotate(detection['time'])
+            fields = [
+                time.strftime('%H:%M:%S', time.localtime(detection['time'])),
+                detection['alarm'], stat['printing'], detection['valid'],
+                detection['pos'], detection['meas_change_norm'], stat['gcode_change'],
+                stat['summary'], stat['state'], stat['file_name'], stat['file_pos'],
+                stat['file_size'], stat['gcode_filament_pos'], stat['gcode_filament_total'],
+                stat['bed_target'], stat['bed_actual'], stat['tool0_target'], stat['tool0_actual']]
+            # csv writes None as an empty field; keep the original 'None'
+            self.writer.writerow(['None' if x is None else x for x in fields])
+            self.skipped_log_count = 0
+            if self.last_flush is None:
+                self.last_flush = detection['time']
+            if detection['alarm']:
+                self.flush(sync=True)
+            elif not stat['printing'] or detection['time'] - self.last_flush >= self.flush_interval:
+                # Idle rows are already infrequent
+                self.flush()
+            if self.max_bytes and self.size >= self.max_bytes:
+                self.rotate(detection['time'])
+        else:
+            self.skipped_log_count += 1
+
+    def flush(self, sync=False):
+        '''Write buffered rows to the log'''
+        data = self.buffer.getvalue()
+        if data:
+            self.csv.write(data)
+            self.csv.flush()
+            self.size = self.csv.tell()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        if sync:
+            os.fsync(self.csv.fileno())
+        self.last_flush = None
+
+    def rotate(self, timestamp):
+        '''Close the log, compress it in the background and start a new one.
+        If the log can't be renamed, logging carries on in the current file.'''
+        self.flush()
+        self.csv.close()
+        suffix = time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))
+        rotated = '%s.%s' % (self.path, suffix)
+        count = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            rotated = '%s.%s-%d' % (self.path, suffix, count)
+            count += 1
+        try:
+            os.rename(self.path, rotated)
+        except OSError:
+            self.logger.exception('Unable to rotate %s', self.path)
+            self.open()
+            self.period = self.rotation_period(timestamp)
+            return
+        self.logger.info('Rotated %s to %s', self.path, rotated)
+        self.compressors = [thread for thread in self.compressors if thread.is_alive()]
+        compressor = threading.Thread(target=self.compress, args=(rotated,), name='compress %s' % (rotated))
+        compressor.daemon = True
+        compressor.start()
+        self.compressors.append(compressor)
+        self.open()
+        self.period = self.rotation_period(timestamp)
+
+    def compress(self, path):
+        '''Replace a rotated log with a gzip compressed copy, then delete the
+        oldest backups'''
+        if not self.backups:
+            try:
+                os.remove(path)
+            except OSError:
+                self.logger.exception('Unable to delete %s', path)
+            return
+        try:
+            with open(path, 'rb') as src, gzip.open(path + '.gz.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.rename(path + '.gz.tmp', path + '.gz')
+            os.remove(path)
+        except (IOError, OSError):
+            self.logger.exception('Unable to compress %s', path)
+            return
+        backups = []
+        for backup in glob.glob(glob.escape(self.path) + '.*.gz'):
+            # Another compressor may delete a backup while this one looks
+            try:
+                backups.append((os.path.getmtime(backup), backup))
+            except OSError:
+                pass
+        for _, backup in sorted(backups)[:-self.backups]:
+            try:
+                os.remove(backup)
+            except OSError:
+                pass
+
+    def log(self, msg):
+        '''Log messages are not recorded in the CSV log'''
+        pass
+
+    def close(self):
+        '''Flush and close the log, waiting for compression to finish'''
+        if self.csv:
+            self.flush()
+            self.csv.close()
+            self.csv = None
+        for compressor in self.compressors:
+            compressor.join()
@@ -1,63 +1,111 @@
 /*jslint browser: true, devel: true*/
-/*global $,Highcharts*/
+/*global $,Highcharts,EventSource*/
 
 var chg_chart;
+var last_seq = null;
+var last_log_seq = null;
+var log_msgs = [];
+var last_etag = null;
+var prints = {};
 
 /**
- * Request data from the server, add it to the graph and set a timeout
- * to request again
+ * Merge a state update from the server into the chart. Only new points are
+ * sent unless the server indicates a full resync.
  */
-function requestData() {
+function applyHistory(state) {
     "use strict";
-    $.ajax({
-        url: 'gen_change',
-        success: function (state) {
-            if (state.hasOwnProperty('printing')) {
-                // If the server has more history, or the first point of the
-                // client history is more than 10 sec off from the server
-                // history (e.g. tablet suspended then woke up with web page)
-                // then reload the data
-                if (chg_chart.series[0].data.length < state.gcode_history.length
-                        || chg_chart.series[1].data.length < state.actual_history.length
-                        || Math.abs(chg_chart.series[0].data[0].x - state.gcode_history[0][0]) > 10 * 1000
-                        || Math.abs(chg_chart.series[1].data[0].x - state.actual_history[0][0]) > 10 * 1000) {
-                    console.log('Reloading data from server');
-                    chg_chart.series[0].setData(state.gcode_history);
-                    chg_chart.series[1].setData(state.actual_history);
-                }
-
-                var shift = chg_chart.series[0].data.length >= state.history_length;
+    var i, shift;
+    if (state.reset) {
+        console.log('Reloading data from server');
+        chg_chart.series[0].setData(state.gcode_points, false);
+        chg_chart.series[1].setData(state.actual_points, false);
+    } else {
+        for (i = 0; i < state.gcode_points.length; i += 1) {
+            shift = chg_chart.series[0].data.length >= state.history_length;
+            chg_chart.series[0].addPoint(state.gcode_points[i], false, shift);
+            chg_chart.series[1].addPoint(state.actual_points[i], false, shift);
+        }
+    }
+    chg_chart.redraw();
+    last_seq = state.seq;
 
-                // append point, shifting if more than 300 points
-                chg_chart.series[0].addPoint(state.gcode, true, shift);
-                chg_chart.series[1].addPoint(state.actual, true, shift);
+    if (state.log_reset) {
+        log_msgs = state.log_msgs;
+    } else {
+        log_msgs = log_msgs.concat(state.log_msgs);
+    }
+    last_log_seq = state.log_seq;
+}
 
-                var armed_html = 'Yes';
-                if (!state.valid) {
-                    if (state.printing) {
-                        armed_html = 'No (valid in ' + state.time_to_valid + ' sec)';
-                    } else {
-                        armed_html = 'No';
-                    }
-                }
+/**
+ * Display a state update from the server
+ */
+function showState(state) {
+    "use strict";
+    if (state.hasOwnProperty('printing')) {
+        applyHistory(state);
 
-                $('#printing').html(state.printing ? 'Yes' : 'No');
-                $('#alarm').html(state.alarm ? 'Yes' : 'No');
-                $('#armed').html(armed_html);
-                $('#summary').html(state.summary);
-                $('#filament_pos').html(state.filament_pos);
-                $('#file_pos').html(state.file_pos);
-                //$('#bed_target').html(state.bed_target);
-                //$('#bed_actual').html(state.bed_actual);
-                $('#bed').html(state.bed_actual + ' / ' + state.bed_target);
-                //$('#tool0_target').html(state.tool0_target);
-                //$('#tool0_actual').html(state.tool0_actual);
-                $('#tool0').html(state.tool0_actual + ' / ' + state.tool0_target);
-                $('#log_msgs').html(state.log_msgs);
-                console.log(state);
+        var armed_html = 'Yes';
+        if (!state.valid) {
+            if (state.printing) {
+                armed_html = 'No (valid in ' + state.time_to_valid + ' sec)';
             } else {
-                $('#summary').html('Invalid state received from server');
-                console.log('Invalid state: ' + state);
+                armed_html = 'No';
+            }
+        }
+
+        $('#printing').html(state.printing ? 'Yes' : 'No');
+        $('#alarm').html(state.alarm ? 'Yes' : 'No');
+        $('#armed').html(armed_html);
+        $('#summary').html(state.summary);
+        $('#filament_pos').html(state.filament_pos);
+        $('#file_pos').html(state.file_pos);
+        //$('#bed_target').html(state.bed_target);
+        //$('#bed_actual').html(state.bed_actual);
+        $('#bed').html(state.bed_actual + ' / ' + state.bed_target);
+        //$('#tool0_target').html(state.tool0_target);
+        //$('#tool0_actual').html(state.tool0_actual);
+        $('#tool0').html(state.tool0_actual + ' / ' + state.tool0_target);
+        $('#log_msgs').html(log_msgs.join('\n'));
+        console.log(state);
+    } else {
+        $('#summary').html('Invalid state received from server');
+        console.log('Invalid state: ' + state);
+    }
+}
+
+/**
+ * Parameters telling the server which updates have already been received
+ */
+function sinceParams() {
+    "use strict";
+    var params = {};
+    if (last_seq !== null) {
+        params.since = last_seq;
+        params.log_since = last_log_seq;
+    }
+    return params;
+}
+
+/**
+ * Request data from the server, add it to the graph and set a timeout
+ * to request again. Used by browsers without EventSource.
+ */
+function requestData() {
+    "use strict";
+    var headers = {};
+    if (last_etag !== null) {
+        headers['If-None-Match'] = last_etag;
+    }
+    $.ajax({
+        url: 'gen_change',
+        data: sinceParams(),
+        headers: headers,
+        success: function (state, textStatus, jqXHR) {
+            // Nothing new since the last poll if the server replied 304
+            if (jqXHR.status !== 304) {
+                last_etag = jqXHR.getResponseHeader('ETag');
+                showState(state);
             }
 
             // call it again after one second
@@ -73,6 +121,115 @@ function requestData() {
     });
 }
 
+/**
+ * Subscribe to the server's event stream. The browser reconnects on its
+ * own and the server backfills from the last event ID. If the browser
+ * gives up, as it does when the server has no stream to spare, poll for
+ * updates instead, asking for everything missed.
+ */
+function streamData() {
+    "use strict";
+    var source = new EventSource('gen_stream?' + $.param(sinceParams()));
+    source.onmessage = function (event) {
+        showState(JSON.parse(event.data));
+    };
+    source.onerror = function () {
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(requestData, 1000);
+        }
+    };
+}
+
+/**
+ * Format a time in milliseconds for the print list
+ */
+function formatTime(time) {
+    "use strict";
+    var date = new Date(time);
+    return date.toLocaleDateString() + ' ' + date.toLocaleTimeString();
+}
+
+/**
+ * Fill the history list with the prints recorded by the server. Servers
+ * without a history store reply 404 and the list stays hidden.
+ */
+function loadPrints() {
+    "use strict";
+    $.ajax({
+        url: 'gen_prints',
+        success: function (print_list) {
+            var i, print_info, label, selected = $('#history').val();
+            $('#history option[value!=""]').remove();
+            prints = {};
+            for (i = 0; i < print_list.length; i += 1) {
+                print_info = print_list[i];
+                prints[print_info.id] = print_info;
+                label = formatTime(print_info.start) + ' ' + (print_info.file_name || '');
+                if (print_info.end === null) {
+                    label += ' (printing)';
+                } else if (print_info.alarm) {
+                    label += ' (alarm)';
+                }
+                $('#history').append($('<option/>').attr('value', print_info.id).text(label));
+            }
+            $('#history').val(selected);
+            $('#history_select').show();
+            setTimeout(loadPrints, 60000);
+        },
+        cache: false
+    });
+}
+
+/**
+ * Show a past print from the history, or the live data if print_id is
+ * empty. Live updates continue in the hidden series meanwhile.
+ */
+function showPrint(print_id) {
+    "use strict";
+    if (!print_id) {
+        chg_chart.series[2].hide();
+        chg_chart.series[3].hide();
+        chg_chart.series[0].show();
+        chg_chart.series[1].show();
+        chg_chart.setTitle({text: 'Filament change vs. time'});
+        return;
+    }
+    $.ajax({
+        url: 'gen_print_history',
+        // One point per pixel is all the chart can show
+        data: {print_id: print_id, points: Math.max(2, Math.round(chg_chart.plotWidth)), method: 'minmax'},
+        success: function (history) {
+            chg_chart.series[0].hide();
+            chg_chart.series[1].hide();
+            chg_chart.series[2].setData(history.gcode_points, false);
+            chg_chart.series[3].setData(history.actual_points, false);
+            chg_chart.series[2].show();
+            chg_chart.series[3].show();
+            chg_chart.setTitle({text: (history.print.file_name || 'Print') + ' at ' + formatTime(history.print.start)});
+        },
+        error: function (jqXHR) {
+            console.log(jqXHR);
+            $('#history').val('');
+        }
+    });
+}
+
+/**
+ * Start receiving updates from the server
+ */
+function startUpdates() {
+    "use strict";
+    loadPrints();
+    $('#history').change(function () {
+        showPrint($(this).val());
+    });
+    if (window.EventSource) {
+        streamData();
+    } else {
+        requestData();
+    }
+}
+
 $(document).ready(function () {
     "use strict";
     Highcharts.setOptions({
@@ -86,7 +243,7 @@ $(document).ready(function () {
             renderTo: 'chg_chart',
             defaultSeriesType: 'spline',
             events: {
-                load: requestData
+                load: startUpdates
             }
         },
         plotOptions: {
@@ -118,6 +275,16 @@ $(document).ready(function () {
             {
                 name: 'Actual',
                 data: []
+            },
+            {
+                name: 'GCode (past print)',
+                data: [],
+                visible: false
+            },
+            {
+                name: 'Actual (past print)',
+                data: [],
+                visible: false
             }
         ]
     });
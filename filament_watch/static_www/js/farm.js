@@ -0,0 +1,81 @@
+/*jslint browser: true, devel: true*/
+/*global $*/
+
+var last_etag = null;
+
+/**
+ * Format a number for display, or a dash if it is not available
+ */
+function formatValue(value) {
+    "use strict";
+    if (value === null || value === undefined) {
+        return '-';
+    }
+    if (typeof value === 'number') {
+        return value.toFixed(1);
+    }
+    return value;
+}
+
+/**
+ * Replace the table rows with the state of each printer
+ */
+function showPrinters(farm) {
+    "use strict";
+    var i, printer, armed, row;
+    $('#printers tr.printer').remove();
+    for (i = 0; i < farm.printers.length; i += 1) {
+        printer = farm.printers[i];
+        armed = 'Yes';
+        if (!printer.valid) {
+            armed = printer.printing ? 'No (valid in ' + printer.time_to_valid + ' sec)' : 'No';
+        }
+        row = $('<tr class="printer"/>');
+        if (printer.alarm) {
+            row.addClass('alarm');
+        }
+        row.append($('<td/>').append($('<a/>').attr('href', 'printer/' + encodeURIComponent(printer.name) + '/').text(printer.name)));
+        row.append($('<td/>').html(printer.summary || ''));
+        row.append($('<td/>').text(printer.printing ? 'Yes' : 'No'));
+        row.append($('<td/>').text(armed));
+        row.append($('<td/>').text(printer.alarm ? 'Yes' : 'No'));
+        row.append($('<td/>').text(formatValue(printer.gcode)));
+        row.append($('<td/>').text(formatValue(printer.actual)));
+        row.append($('<td/>').text(formatValue(printer.bed_actual) + ' / ' + formatValue(printer.bed_target)));
+        row.append($('<td/>').text(formatValue(printer.tool0_actual) + ' / ' + formatValue(printer.tool0_target)));
+        $('#printers').append(row);
+    }
+}
+
+/**
+ * Poll the server for the state of every printer
+ */
+function requestFarm() {
+    "use strict";
+    var headers = {};
+    if (last_etag !== null) {
+        headers['If-None-Match'] = last_etag;
+    }
+    $.ajax({
+        url: 'gen_farm',
+        headers: headers,
+        success: function (farm, textStatus, jqXHR) {
+            if (jqXHR.status !== 304) {
+                last_etag = jqXHR.getResponseHeader('ETag');
+                showPrinters(farm);
+            }
+            $('#status').html('');
+            setTimeout(requestFarm, 1000);
+        },
+        error: function (jqXHR) {
+            $('#status').html('Error retrieving state: ' + jqXHR.status);
+            setTimeout(requestFarm, 1000);
+        },
+        cache: false
+    });
+}
+
+$(document).ready(function () {
+    "use strict";
+    requestFarm();
+});
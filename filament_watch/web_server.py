@@ -34,49 +34,545 @@ Web server to serve filament_watch status
 ##############################################################################
 
 import os
+import re
+import gzip
 import json
+import hashlib
+import mimetypes
 import time
+import threading
 import cherrypy
 
+class StateSnapshot(object): # pylint: disable=too-many-instance-attributes
+    '''One published dashboard state. Snapshots are immutable once
+    published, so request threads can read them without locking while the
+    monitoring loop publishes the next one.
+
+    The chart history is shared between snapshots rather than copied: it is
+    the slice [start:end] of an append-only list that is never modified
+    below end. Encoded replies are built on first use and cached; two
+    threads racing to build one produce identical bytes.'''
+    __slots__ = ('seq', 'log_seq', 'state', 'history_length', 'points', 'start', 'end',
+                 'log_msgs', 'prev', 'etag', 'full', 'full_gzip', 'delta', 'superseded')
+
+    def __init__(self, seq, log_seq, state, history, log_msgs, prev): # pylint: disable=too-many-arguments
+        self.seq = seq
+        self.log_seq = log_seq
+        self.state = state
+        # (history_length, points list, start, end); each point is
+        # (seq, gcode point, actual point)
+        self.history_length, self.points, self.start, self.end = history
+        # Tuple of (seq, html)
+        self.log_msgs = log_msgs
+        # (seq, log_seq) a client must have seen for delta to apply
+        self.prev = prev
+        self.etag = '"%d.%d"' % (seq, log_seq)
+        self.full = None
+        self.full_gzip = None
+        self.delta = None
+        # Set once a newer snapshot has been published
+        self.superseded = threading.Event()
+
+    def history(self):
+        '''Chart points in this snapshot'''
+        return self.points[self.start:self.end]
+
+    def points_since(self, since):
+        '''Return (reset, points newer than since). reset is True, and all
+        points are returned, if the client has no history, has missed
+        points that are no longer retained, or is ahead of the server.'''
+        if since is None or since > self.seq:
+            return True, self.history()
+        if self.end > self.start and since < self.points[self.start][0] - 1:
+            return True, self.history()
+        return False, self.points[max(self.start, self.end - (self.seq - since)):self.end]
+
+    def logs_since(self, log_since):
+        '''Return (reset, log messages newer than log_since)'''
+        if log_since is None or log_since > self.log_seq:
+            return True, self.log_msgs
+        if self.log_msgs and log_since < self.log_msgs[0][0] - 1:
+            return True, self.log_msgs
+        return False, tuple(msg for msg in self.log_msgs if msg[0] > log_since)
+
+    def changes_since(self, since, log_since):
+        '''Build the reply for a client that has seen samples up to since and
+        log messages up to log_since'''
+        reply = dict(self.state)
+        reply['seq'] = self.seq
+        reply['history_length'] = self.history_length
+        reply['reset'], points = self.points_since(since)
+        reply['log_seq'] = self.log_seq
+        reply['log_reset'], log_msgs = self.logs_since(log_since)
+        reply['gcode_points'] = [point[1] for point in points]
+        reply['actual_points'] = [point[2] for point in points]
+        reply['log_msgs'] = [msg[1] for msg in log_msgs]
+        return reply
+
+    def encoded(self, since, log_since):
+        '''Encoded reply for a client that has seen since and log_since. The
+        full resync and the delta from the previous snapshot, which between
+        them cover almost every request, are encoded once.'''
+        if since is None and log_since is None:
+            if self.full is None:
+                self.full = json.dumps(self.changes_since(None, None)).encode('utf-8')
+            return self.full
+        if (since, log_since) == self.prev:
+            if self.delta is None:
+                self.delta = json.dumps(self.changes_since(since, log_since)).encode('utf-8')
+            return self.delta
+        return json.dumps(self.changes_since(since, log_since)).encode('utf-8')
+
+    def gzipped_full(self):
+        '''Full reply, gzip compressed on first use'''
+        if self.full_gzip is None:
+            self.full_gzip = gzip.compress(self.encoded(None, None), 6)
+        return self.full_gzip
+
+class StaticAssets(object):
+    '''Dashboard scripts and stylesheets, served from memory under
+    content-hashed names so browsers can cache them indefinitely. The pages
+    are rewritten to refer to the hashed names and are revalidated on every
+    visit, so a repeat visit costs one conditional request.'''
+    compress_types = ('text/css', 'text/html', 'application/javascript', 'text/javascript')
+    max_age = 365 * 24 * 3600
+
+    def __init__(self, root, pages=('index.html', 'farm.html'), prefix='static'):
+        self.root = root
+        self.prefix = prefix
+        # Hashed path -> (content type, etag, body, gzipped body or None)
+        self.assets = {}
+        # Original relative path -> hashed URL
+        self.urls = {}
+        # Page name -> source; (page name, base URL) -> encoded page
+        self.pages = {}
+        self.rendered = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                rel_path = os.path.relpath(os.path.join(dirpath, filename), root)
+                rel_path = rel_path.replace(os.sep, '/')
+                if rel_path not in pages:
+                    self.add(rel_path)
+        for page in pages:
+            with open(os.path.join(root, page), 'rb') as page_file:
+                self.pages[page] = page_file.read().decode('utf-8')
+
+    def encode(self, content_type, body):
+        '''Return (content type, etag, body, gzipped body or None). Assets
+        are compressed once, at the highest level, when they are loaded.'''
+        body_gzip = None
+        if content_type in self.compress_types:
+            body_gzip = gzip.compress(body, 9)
+            if len(body_gzip) >= len(body):
+                body_gzip = None
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        return content_type, etag, body, body_gzip
+
+    def add(self, rel_path):
+        '''Load one asset and assign it a content-hashed name'''
+        with open(os.path.join(self.root, rel_path), 'rb') as asset_file:
+            body = asset_file.read()
+        content_type = mimetypes.guess_type(rel_path)[0] or 'application/octet-stream'
+        base, ext = os.path.splitext(rel_path)
+        hashed_path = '%s.%s%s' % (base, hashlib.sha1(body).hexdigest()[:10], ext)
+        self.assets[hashed_path] = self.encode(content_type, body)
+        self.urls[rel_path] = '%s/%s' % (self.prefix, hashed_path)
+
+    def render(self, page, base):
+        '''Encode a page with its src and href attributes pointing at the
+        hashed asset names. base is the relative URL of the server root from
+        the page.'''
+        def replace(match):
+            '''Substitute the hashed URL for a local asset'''
+            url = match.group(2)
+            if url in self.urls:
+                url = base + self.urls[url]
+            return '%s="%s"' % (match.group(1), url)
+        body = re.sub(r'\b(src|href)="([^":]+)"', replace, self.pages[page])
+        return self.encode('text/html', body.encode('utf-8'))
+
+    @staticmethod
+    def serve(asset, cache_control):
+        '''Send an encoded asset, or 304 if the client already has it'''
+        content_type, etag, body, body_gzip = asset
+        cherrypy.response.headers['Content-Type'] = content_type
+        cherrypy.response.headers['Cache-Control'] = cache_control
+        cherrypy.response.headers['ETag'] = etag
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return b''
+        if body_gzip is not None:
+            cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in cherrypy.request.headers.get('Accept-Encoding', ''):
+                cherrypy.response.headers['Content-Encoding'] = 'gzip'
+                return body_gzip
+        return body
+
+    @cherrypy.expose
+    def default(self, *path):
+        '''Serve a content-hashed asset. Its name changes whenever its
+        content does, so it never needs revalidating.'''
+        asset = self.assets.get('/'.join(path))
+        if asset is None:
+            raise cherrypy.NotFound()
+        return self.serve(asset, 'public, max-age=%d, immutable' % self.max_age)
+
+    def serve_page(self, page, base=''):
+        '''Serve a page, which browsers must revalidate'''
+        key = (page, base)
+        encoded = self.rendered.get(key)
+        if encoded is None:
+            encoded = self.rendered[key] = self.render(page, base)
+        return self.serve(encoded, 'no-cache')
+
 class WebGen(object):
-    '''CherryPy generator for web server'''
-    def __init__(self):
-        self.state = {}
-        self.log_msgs = ''
+    '''CherryPy generator for web server. update and add_log must only be
+    called from one thread; request threads only read the published
+    snapshot and never block it. Each event stream holds a request thread
+    for as long as it is open, so if streams, a semaphore shared by every
+    dashboard, is given, a stream is only opened while it can be
+    acquired.'''
+    def __init__(self, history_length, log_length, static=None, base='', # pylint: disable=too-many-arguments
+                 history_store=None, printer='', streams=None):
+        self.running = True
+        self.streams = streams
+        self.static = static
+        # Relative URL of the server root from the dashboard
+        self.base = base
+        # Long term history, if recorded, and this printer's name in it
+        self.history_store = history_store
+        self.printer = printer
+        # Largest downsampled series a client may ask for
+        self.max_points = 10000
+        self.keepalive_interval = 15
+        self.history_length = history_length
+        self.log_length = log_length
+        # Append-only list of chart points. Once it holds twice the history
+        # length it is replaced, rather than trimmed, so published snapshots
+        # never see it change.
+        self.points = []
+        self.start = 0
+        self.snapshot = StateSnapshot(0, 0, {}, (history_length, self.points, 0, 0), (), None)
+
+    def publish(self, state, log_msgs, seq, log_seq):
+        '''Atomically replace the published snapshot'''
+        old = self.snapshot
+        self.snapshot = StateSnapshot(seq, log_seq, state,
+                                      (self.history_length, self.points, self.start, len(self.points)),
+                                      log_msgs, (old.seq, old.log_seq))
+        old.superseded.set()
+
+    def update(self, state, gcode_point, actual_point):
+        '''Record a new sample. state must not be modified afterwards.'''
+        old = self.snapshot
+        self.points.append((old.seq + 1, gcode_point, actual_point))
+        if len(self.points) - self.start > self.history_length:
+            self.start += 1
+        if self.start >= self.history_length:
+            self.points = self.points[self.start:]
+            self.start = 0
+        self.publish(state, old.log_msgs, old.seq + 1, old.log_seq)
+
+    def add_log(self, msg_html):
+        '''Record a new log message'''
+        old = self.snapshot
+        log_msgs = (old.log_msgs + ((old.log_seq + 1, msg_html),))[-self.log_length:]
+        self.publish(old.state, log_msgs, old.seq, old.log_seq + 1)
+
+    def stop(self):
+        '''Release any streaming clients'''
+        self.running = False
+        self.snapshot.superseded.set()
+
+    @staticmethod
+    def parse_seq(seq):
+        '''Convert a sequence number query parameter to an int, or None'''
+        try:
+            return int(seq)
+        except (TypeError, ValueError):
+            return None
+
+    @cherrypy.expose
+    def index(self):
+        '''Dashboard page'''
+        return self.static.serve_page('index.html', self.base)
+
+    @staticmethod
+    def chart_times(print_info):
+        '''Convert the times of a print from the history store to the
+        milliseconds used by the chart'''
+        print_info = dict(print_info)
+        print_info['start'] *= 1000
+        if print_info['end'] is not None:
+            print_info['end'] *= 1000
+        return print_info
 
     @cherrypy.expose
-    def gen_change(self, _=None):
-        '''Dynamically updating data'''
+    def gen_prints(self, _=None, before=None):
+        '''Most recent prints in the long term history, newest first'''
+        if self.history_store is None:
+            raise cherrypy.NotFound()
+        try:
+            before = float(before) / 1000 if before is not None else None
+        except ValueError:
+            raise cherrypy.HTTPError(400, 'Invalid time')
+        prints = [self.chart_times(print_info) for print_info in self.history_store.prints(self.printer, before=before)]
         cherrypy.response.headers['Content-Type'] = 'text/json'
-        self.state['log_msgs'] = self.log_msgs
-        return json.dumps(self.state)
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return json.dumps(prints).encode('utf-8')
 
-class WebServer(object):
-    '''Main interface to web server'''
-    def __init__(self, port, show_cherrypy_logs):
+    @cherrypy.expose
+    def gen_print_history(self, print_id=None, _=None, points=None, method='lttb'):
+        '''Chart points of one print from the long term history. With points,
+        each series is downsampled to about that many points by method,
+        'lttb' or 'minmax'.'''
+        if self.history_store is None:
+            raise cherrypy.NotFound()
+        try:
+            print_id = int(print_id)
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, 'Invalid print')
+        if points is not None:
+            try:
+                points = int(points)
+            except ValueError:
+                raise cherrypy.HTTPError(400, 'Invalid point count')
+            if points < 2 or points > self.max_points:
+                raise cherrypy.HTTPError(400, 'Point count must be from 2 to %d' % (self.max_points))
+        if method not in ('lttb', 'minmax'):
+            raise cherrypy.HTTPError(400, 'Invalid downsampling method')
+        print_info = self.history_store.print_info(self.printer, print_id)
+        if print_info is None:
+            raise cherrypy.NotFound()
+        if points is None:
+            samples = self.history_store.samples(self.printer, print_id)
+            gcode_points = [[sample[0] * 1000, sample[1]] for sample in samples]
+            actual_points = [[sample[0] * 1000, sample[2]] for sample in samples]
+        else:
+            gcode, actual = self.history_store.series(self.printer, points, method, print_id)
+            gcode_points = [[point[0] * 1000, point[1]] for point in gcode]
+            actual_points = [[point[0] * 1000, point[1]] for point in actual]
+        reply = {
+            'print': self.chart_times(print_info),
+            'gcode_points': gcode_points,
+            'actual_points': actual_points,
+        }
+        cherrypy.response.headers['Content-Type'] = 'text/json'
+        # A finished print never changes
+        if print_info['end'] is None:
+            cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        else:
+            cherrypy.response.headers['Cache-Control'] = 'private, max-age=86400'
+        body = json.dumps(reply).encode('utf-8')
+        if 'gzip' in cherrypy.request.headers.get('Accept-Encoding', ''):
+            cherrypy.response.headers['Content-Encoding'] = 'gzip'
+            cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+            return gzip.compress(body, 6)
+        return body
+
+    @cherrypy.expose
+    def gen_change(self, _=None, since=None, log_since=None):
+        '''Dynamically updating data. Only samples newer than since and log
+        messages newer than log_since are sent, unless the client needs a
+        full resync. Polls made with the ETag of the current state get 304.'''
+        snapshot = self.snapshot
+        cherrypy.response.headers['Content-Type'] = 'text/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['ETag'] = snapshot.etag
+        if cherrypy.request.headers.get('If-None-Match') == snapshot.etag:
+            cherrypy.response.status = 304
+            return b''
+
+        since = self.parse_seq(since)
+        log_since = self.parse_seq(log_since)
+        if since is None and log_since is None:
+            cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+            if 'gzip' in cherrypy.request.headers.get('Accept-Encoding', ''):
+                cherrypy.response.headers['Content-Encoding'] = 'gzip'
+                return snapshot.gzipped_full()
+        return snapshot.encoded(since, log_since)
+
+    @cherrypy.expose
+    def gen_stream(self, since=None, log_since=None):
+        '''Server-sent event stream of the same data as gen_change, pushed as
+        soon as each sample or log message arrives. A reconnecting
+        EventSource resumes from its Last-Event-ID. When too many streams
+        are open the reply is 503, and the dashboard polls gen_change
+        instead.'''
+        if self.streams is not None and not self.streams.acquire(False):
+            cherrypy.response.status = 503
+            cherrypy.response.headers['Retry-After'] = '60'
+            return b''
+
+        last_event_id = cherrypy.request.headers.get('Last-Event-ID')
+        if last_event_id and ':' in last_event_id:
+            since, log_since = last_event_id.split(':', 1)
+        since = self.parse_seq(since)
+        log_since = self.parse_seq(log_since)
+
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        # Stop proxies such as nginx from buffering the stream
+        cherrypy.response.headers['X-Accel-Buffering'] = 'no'
+
+        def stream(since, log_since):
+            '''Yield an event for every change until the server stops or the
+            client goes away'''
+            try:
+                yield b'retry: 1000\n\n'
+                while True:
+                    snapshot = self.snapshot
+                    if (since, log_since) == (snapshot.seq, snapshot.log_seq):
+                        if not snapshot.superseded.wait(self.keepalive_interval):
+                            # Comment line to detect clients that have gone away
+                            yield b': keepalive\n\n'
+                        if not self.running:
+                            return
+                        continue
+                    body = snapshot.encoded(since, log_since)
+                    since = snapshot.seq
+                    log_since = snapshot.log_seq
+                    yield b'id: %d:%d\ndata: %s\n\n' % (since, log_since, body)
+            finally:
+                if self.streams is not None:
+                    self.streams.release()
+        events = stream(since, log_since)
+        # Start the stream now, so it gives up its slot however it is closed
+        first = next(events)
+        def resume():
+            '''The events of the started stream, from the first on'''
+            yield first
+            yield from events
+        return resume()
+    gen_stream._cp_config = {'response.stream': True}
+
+class FarmOverview(object):
+    '''Root of the web server when several printers are monitored: a page
+    summarizing every printer, linking to each printer's dashboard'''
+    summary_fields = ('summary', 'printing', 'alarm', 'valid', 'time_to_valid', 'filament_pos',
+                      'file_pos', 'bed_target', 'bed_actual', 'tool0_target', 'tool0_actual')
+
+    def __init__(self, webgens, static):
+        self.webgens = webgens
+        self.static = static
+        # (ETag, encoded reply) for the latest printer snapshots
+        self.encoded = (None, None)
+
+    @cherrypy.expose
+    def index(self):
+        '''Farm overview page'''
+        return self.static.serve_page('farm.html')
+
+    @cherrypy.expose
+    def gen_farm(self, _=None):
+        '''Latest state of every printer'''
+        snapshots = [(name, webgen.snapshot) for name, webgen in self.webgens.items()]
+        etag = '"%s"' % '.'.join('%d-%d' % (snapshot.seq, snapshot.log_seq) for _, snapshot in snapshots)
+        cherrypy.response.headers['Content-Type'] = 'text/json'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['ETag'] = etag
+        if cherrypy.request.headers.get('If-None-Match') == etag:
+            cherrypy.response.status = 304
+            return b''
+
+        encoded_etag, body = self.encoded
+        if encoded_etag != etag:
+            printers = []
+            for name, snapshot in snapshots:
+                printer = dict((field, snapshot.state.get(field)) for field in self.summary_fields)
+                printer['name'] = name
+                printer['actual'] = snapshot.state['actual'][1] if 'actual' in snapshot.state else None
+                printer['gcode'] = snapshot.state['gcode'][1] if 'gcode' in snapshot.state else None
+                printers.append(printer)
+            body = json.dumps({'printers': printers}).encode('utf-8')
+            self.encoded = (etag, body)
+        return body
+
+class PrinterStatus(object):
+    '''Interface to the dashboard of one printer'''
+    def __init__(self, webgen):
+        self.webgen = webgen
+
+    def update(self, state):
+        '''Update dynamic data. state['gcode'] and state['actual'] are the
+        new [time, value] chart points.'''
+        self.webgen.update(state, state['gcode'], state['actual'])
+
+    def log(self, msg):
+        '''Append a log message'''
+        timestamp = time.strftime('%H:%M:%S', time.localtime())
+        self.webgen.add_log('%s: %s<br/>\n' % (timestamp, msg))
+
+class WebServer(object): # pylint: disable=too-many-instance-attributes
+    '''Main interface to web server. With a single printer its dashboard is
+    served at the root; with several, each printer's dashboard is served
+    at /printer/<name>/ and the root shows an overview of them all.
+
+    At most max_streams dashboards, across all printers, receive updates
+    over an event stream; any more poll for them. The thread pool has
+    room for every stream plus the requests of the pages themselves.'''
+    def __init__(self, port, show_cherrypy_logs, history_length=120, log_length=5, # pylint: disable=too-many-arguments
+                 printer_names=None, history_store=None, max_streams=20):
         self.webgen = None
+        self.history_store = history_store
+        self.webgens = {}
+        self.printers = {}
         self.port = port
-        self.log_msgs = []
+        self.history_length = history_length
+        self.log_length = log_length
         self.show_cherrypy_logs = show_cherrypy_logs
+        self.printer_names = printer_names or [None]
+        # Each event stream holds a thread open while it is connected
+        self.streams = threading.BoundedSemaphore(max_streams)
+        self.thread_pool = max_streams + 20
 
     def start(self):
         '''Start web server'''
         script_dir = os.path.dirname(os.path.abspath(__file__))
         http_config = {
             'server.socket_host': '0.0.0.0',
-            'server.socket_port': self.port
+            'server.socket_port': self.port,
+            'server.thread_pool': self.thread_pool,
         }
+        # The pages link to the content-hashed copies under /static; the
+        # original names remain available through staticdir for anything
+        # that refers to them directly.
         mount_config = {
             '/': {
                 'tools.staticdir.on': True,
                 'tools.staticdir.root': script_dir,
                 'tools.staticdir.dir': './static_www',
-                'tools.staticdir.index': 'index.html'
+            },
+            '/css': {
+                'tools.gzip.on': True,
+                'tools.gzip.mime_types': list(StaticAssets.compress_types),
+            },
+            '/js': {
+                'tools.gzip.on': True,
+                'tools.gzip.mime_types': list(StaticAssets.compress_types),
+            },
+            '/static': {
+                'tools.staticdir.on': False,
             }
         }
-        self.webgen = WebGen()
+        static = StaticAssets(os.path.join(script_dir, 'static_www'))
+        if self.printer_names == [None]:
+            self.webgen = WebGen(self.history_length, self.log_length, static,
+                                 history_store=self.history_store, streams=self.streams)
+            self.webgens[None] = self.webgen
+            root = self.webgen
+        else:
+            for name in self.printer_names:
+                webgen = WebGen(self.history_length, self.log_length, static, '../../',
+                                self.history_store, name, self.streams)
+                self.webgens[name] = webgen
+                cherrypy.tree.mount(webgen, '/printer/%s' % (name), {'/': {}})
+            self.webgen = self.webgens[self.printer_names[0]]
+            root = FarmOverview(self.webgens, static)
+        self.printers = dict((name, PrinterStatus(webgen)) for name, webgen in self.webgens.items())
         cherrypy.config.update(http_config)
-        cherrypy.tree.mount(self.webgen, '/', mount_config)
+        cherrypy.tree.mount(root, '/', mount_config)
         # Disable redundant logging to screen
         cherrypy.log.screen = False
         if not self.show_cherrypy_logs:
@@ -85,19 +581,24 @@ class WebServer(object):
             cherrypy.log.access_log.propagate = False
         cherrypy.engine.start()
 
+    def printer(self, name=None):
+        '''Interface to one printer's dashboard'''
+        if name is None:
+            name = self.printer_names[0]
+        return self.printers[name]
+
     def update(self, state):
-        '''Update dynamic data'''
-        self.webgen.state = state
+        '''Update dynamic data of the first printer'''
+        self.printer().update(state)
 
     def log(self, msg):
-        '''Append a log message'''
-        timestamp = time.strftime('%H:%M:%S', time.localtime())
-        self.log_msgs.append('%s: %s<br/>\n' % (timestamp, msg))
-        if len(self.log_msgs) > 5:
-            self.log_msgs.pop(0)
-        self.webgen.log_msgs = '\n'.join(self.log_msgs)
+        '''Append a log message for the first printer'''
+        self.printer().log(msg)
 
     def stop(self):
         '''Stop web server'''
+        for webgen in self.webgens.values():
+            webgen.stop()
         cherrypy.engine.stop()
         self.webgen = None
+        self.webgens = {}
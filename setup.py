@@ -25,12 +25,16 @@ setup(
     packages=['filament_watch'],
     include_package_data=True,
     entry_points={
-        'console_scripts': ['filament_watch = filament_watch.filament_watch:main'],
+        'console_scripts': ['filament_watch = filament_watch.filament_watch:main',
+                            'filament_watch_replay = filament_watch.replay:main'],
     },
     install_requires=[
         'requests',
         'pyserial',
         'cherrypy>=3.1',
         'pyyaml'
-    ]
+    ],
+    extras_require={
+        'fast': ['numpy']
+    }
 )
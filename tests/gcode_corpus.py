@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+gcode_corpus.py
+
+G-code files exercising the extrusion index, and the line by line parse
+the bulk scanner must match
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import random
+
+from filament_watch import gcode_index
+from filament_watch.gcode_index import GcodeExtrusionParser
+from synthetic_gcode import generate
+
+def line_index(gcode, chunk_size=64 * 1024):
+    '''Build the sparse index by splitting each chunk into lines and passing
+    every line to parse_line, as feed did before the bulk scanner'''
+    parser = GcodeExtrusionParser()
+    partial_line = b''
+    for pos in range(0, len(gcode), chunk_size):
+        lines = (partial_line + gcode[pos:pos + chunk_size]).split(b'\n')
+        partial_line = lines.pop()
+        for line in lines:
+            parser.parse_line(line)
+    parser.parse_line(partial_line)
+    return parser.index
+
+def scanned_index(gcode, use_numpy=True, chunk_size=64 * 1024, scan_size=None):
+    '''Build the sparse index with the bulk scanner, optionally without
+    NumPy'''
+    saved = gcode_index.numpy
+    if not use_numpy:
+        gcode_index.numpy = None
+    try:
+        parser = GcodeExtrusionParser()
+        if scan_size:
+            parser.scan_size = scan_size
+        for pos in range(0, len(gcode), chunk_size):
+            parser.feed(gcode[pos:pos + chunk_size])
+        return parser.finish()
+    finally:
+        gcode_index.numpy = saved
+
+def index_result(func, *args):
+    '''The raw contents of the index built by func, or the exception
+    raised'''
+    try:
+        index = func(*args)
+    except ValueError as exc:
+        return type(exc)
+    return index.offsets.tobytes(), index.totals.tobytes()
+
+def edge_case_gcode(lines=20000, seed=1):
+    '''G-code exercising the corners of the parser's word splitting and
+    number formats'''
+    rng = random.Random(seed)
+    numbers = [b'1e-3', b'+.5', b'-0', b'1_0', b'.5', b'5.', b'1E2', b'00012.50000', b'-1.25\r',
+               b'123456789.123456789', b'1e-310', b'7' * 70, b'0.1', b'%.17g' % (rng.random())]
+    variants = [
+        lambda i: b'G1 X1 E' + rng.choice(numbers),
+        lambda i: b'G1 E%d E%d' % (i, i + 1),
+        lambda i: b'G1  E%d ;comment E99' % (i),
+        lambda i: b'G92 X0',
+        lambda i: b'G92 E%d E2' % (i % 7),
+        lambda i: b'G1\tE5',
+        lambda i: b'G10 E4',
+        lambda i: b';G1 E4',
+        lambda i: b'G1 E' + rng.choice([b'1', b'1', b'2']),
+        lambda i: b'G1',
+        lambda i: b'G1 X%d E%.5f' % (i, rng.random() * 1000),
+        lambda i: b'G1 E%d' % (rng.randint(-10 ** 15, 10 ** 15)),
+    ]
+    return b'\n'.join(rng.choice(variants)(i) for i in range(lines)) + b'\n'
+
+def corpus():
+    '''Files exercising the scanner, by name'''
+    return {
+        'synthetic': generate(512 * 1024),
+        'crlf': generate(256 * 1024, 2).replace(b'\n', b'\r\n'),
+        'no final newline': generate(64 * 1024, 3).rstrip(b'\n'),
+        'empty': b'',
+        'edge cases': edge_case_gcode(),
+        'repeated totals': b'G1 E1\nG1 E1\nG92 E0\nG1 E0\nG1 E1 E1\n' * 1000,
+        'empty word': b'G1 X1 E1\nG1 E\n',
+        'NUL byte': b'G1 E1\nG1 E2\x00\n',
+    }
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+synthetic_gcode.py
+
+Generate synthetic G-code files for benchmarking
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+
+import random
+
+def generate_lines(seed=1):
+    '''Yield an endless stream of plausible slicer output lines'''
+    rng = random.Random(seed)
+    extrude = 0.0
+    layer = 0
+    yield ';FLAVOR:RepRap\n'
+    yield 'G21\n'
+    yield 'G90\n'
+    yield 'M82\n'
+    yield 'G92 E0\n'
+    while True:
+        choice = rng.random()
+        if choice < 0.70:
+            extrude += rng.random() * 0.5
+            yield 'G1 X%.3f Y%.3f E%.5f\n' % (rng.random() * 200, rng.random() * 200, extrude)
+        elif choice < 0.82:
+            yield 'G1 F9000 X%.3f Y%.3f\n' % (rng.random() * 200, rng.random() * 200)
+        elif choice < 0.86:
+            extrude -= 1.0
+            yield 'G1 F2400 E%.5f\n' % (extrude)
+        elif choice < 0.88:
+            extrude = 0.0
+            yield 'G92 E0\n'
+        elif choice < 0.90:
+            layer += 1
+            yield ';LAYER:%d\n' % (layer)
+            yield 'G0 Z%.2f\n' % (layer * 0.2)
+        else:
+            yield 'G0 F9000 X%.3f Y%.3f\n' % (rng.random() * 200, rng.random() * 200)
+
+def generate(size, seed=1):
+    '''Return roughly size bytes of synthetic G-code'''
+    parts = []
+    length = 0
+    for line in generate_lines(seed):
+        parts.append(line)
+        length += len(line)
+        if length >= size:
+            break
+    return ''.join(parts).encode('ascii')
+
+def write_file(path, size, seed=1):
+    '''Write roughly size bytes of synthetic G-code to path'''
+    with open(path, 'wb') as gcode_file:
+        written = 0
+        batch = []
+        for line in generate_lines(seed):
+            batch.append(line)
+            written += len(line)
+            if len(batch) >= 10000 or written >= size:
+                gcode_file.write(''.join(batch).encode('ascii'))
+                batch = []
+            if written >= size:
+                break
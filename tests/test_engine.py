@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_engine.py
+
+The monitoring engine keeps every stage running through slow and failing
+calls, and raises no alarm on stale printer status
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import asyncio
+import time
+
+import pytest
+
+from filament_watch.engine import MonitorEngine
+from filament_watch.metrics import Counters, LatencyStats
+
+STAT = {'printing': True, 'summary': 'Printing', 'state': 'Printing',
+        'bed_target': 60.0, 'bed_actual': 60.0, 'tool0_target': 210.0, 'tool0_actual': 210.0}
+
+class FakeEncoder(object):
+    '''Reports a new position every interval seconds. Calls listed in
+    fail raise, and calls listed in slow take slow_time.'''
+    def __init__(self, interval=0.01, fail=(), slow=(), slow_time=0.0):
+        self.interval = interval
+        self.fail = fail
+        self.slow = slow
+        self.slow_time = slow_time
+        self.calls = 0
+        self.latency = LatencyStats()
+        self.counters = Counters()
+
+    def get_pos_change(self):
+        '''Next report'''
+        self.calls += 1
+        if self.calls in self.fail:
+            raise IOError('Encoder unplugged')
+        time.sleep(self.slow_time if self.calls in self.slow else self.interval)
+        return [self.calls, 1.0]
+
+class FakeOctoPrint(object):
+    '''Answers the first fresh status calls, then raises or hangs'''
+    def __init__(self, fresh=None, hang=0.0):
+        self.fresh = fresh
+        self.hang = hang
+        self.calls = 0
+        self.job_cmds = []
+        self.latency = LatencyStats()
+
+    def status(self):
+        '''Printer status'''
+        self.calls += 1
+        if self.fresh is not None and self.calls > self.fresh:
+            if self.hang:
+                time.sleep(self.hang)
+            raise IOError('OctoPrint down')
+        return dict(STAT)
+
+    def issue_job_cmd(self, cmd):
+        '''Record a job command'''
+        self.job_cmds.append(cmd)
+
+class FakeDetector(object):
+    '''Sets the alarm on every report'''
+    def update(self, pos, meas_change_raw, stat): # pylint: disable=no-self-use
+        '''Detector result'''
+        return {'pos': pos, 'meas_change_raw': meas_change_raw, 'meas_change_norm': meas_change_raw,
+                'printing_count': 100, 'valid': True, 'alarm': True, 'started': False, 'stopped': False,
+                'stat': stat}
+
+class FakeSink(object):
+    '''Records results, optionally failing on every one'''
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.detections = []
+
+    def update(self, detection):
+        '''Record a result'''
+        if self.fail:
+            raise IOError('Disk full')
+        self.detections.append(detection)
+
+    def log(self, msg):
+        '''Ignore log messages'''
+        pass
+
+def run_engine(engine, seconds):
+    '''Run the engine for the specified time, checking that it is still
+    running at the end'''
+    async def run():
+        task = asyncio.ensure_future(engine.run())
+        await asyncio.sleep(seconds)
+        assert not task.done(), 'engine stopped early'
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(run())
+
+def make_engine(encoder, octoprint, sinks, **kwargs):
+    '''Engine with short intervals and retry delays'''
+    engine = MonitorEngine(encoder, octoprint, FakeDetector(), sinks, 'cancel',
+                           status_interval=0.05, **kwargs)
+    engine.error_delay = 0.01
+    return engine
+
+def test_fresh_status_alarm_dispatched():
+    '''With up to date status, an alarm cancels the job'''
+    octoprint = FakeOctoPrint()
+    sink = FakeSink()
+    run_engine(make_engine(FakeEncoder(), octoprint, [sink]), 0.3)
+    assert octoprint.job_cmds and set(octoprint.job_cmds) == {'cancel'}
+    assert sink.detections and all(detection['alarm'] for detection in sink.detections)
+
+def test_stale_status_alarm_suppressed():
+    '''Once OctoPrint stops answering for three status intervals, no alarm
+    is dispatched and results are logged with the alarm clear'''
+    octoprint = FakeOctoPrint(fresh=1)
+    sink = FakeSink()
+    # The first encoder report arrives after the status has gone stale
+    engine = make_engine(FakeEncoder(slow=(1,), slow_time=0.3), octoprint, [sink])
+    run_engine(engine, 0.6)
+    assert engine.max_status_age == pytest.approx(0.15)
+    assert octoprint.calls > 1
+    assert not octoprint.job_cmds
+    assert sink.detections
+    assert all(detection['status_age'] > 0.15 and not detection['alarm'] for detection in sink.detections)
+    counts = engine.counters.snapshot()
+    assert counts['stale_alarm_suppressed'] == len(sink.detections)
+    assert counts['status_error'] >= 1
+
+def test_status_overrun_ages_status():
+    '''A status call that hangs past its deadline is counted, and the
+    status it leaves behind ages until alarms are suppressed'''
+    octoprint = FakeOctoPrint(fresh=1, hang=0.4)
+    sink = FakeSink()
+    engine = make_engine(FakeEncoder(), octoprint, [sink], deadlines={'status': 0.05})
+    run_engine(engine, 0.6)
+    counts = engine.counters.snapshot()
+    assert counts['status_overrun'] >= 1
+    assert counts['stale_alarm_suppressed'] >= 1
+    assert all(not detection['alarm'] for detection in sink.detections if detection['status_age'] > 0.15)
+
+def test_encoder_overrun_counted():
+    '''A slow encoder read is counted against its deadline and later
+    reports are still processed'''
+    sink = FakeSink()
+    engine = make_engine(FakeEncoder(slow=(2,), slow_time=0.15), FakeOctoPrint(), [sink],
+                         deadlines={'encoder': 0.05})
+    run_engine(engine, 0.4)
+    assert engine.counters.snapshot()['encoder_overrun'] == 1
+    assert max(detection['pos'] for detection in sink.detections) > 2
+
+def test_stages_survive_exceptions():
+    '''Failing encoder reads, status calls and sinks are counted and
+    retried, and the other stages carry on'''
+    encoder = FakeEncoder(fail=(2, 3))
+    failing_sink = FakeSink(fail=True)
+    sink = FakeSink()
+    engine = make_engine(encoder, FakeOctoPrint(), [failing_sink, sink])
+    run_engine(engine, 0.4)
+    counts = engine.counters.snapshot()
+    assert counts['encoder_error'] == 2
+    assert counts['sink0 FakeSink_error'] >= 1
+    assert max(detection['pos'] for detection in sink.detections) > 3
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_gcode_index.py
+
+The bulk G-code scanner and the file indexer give exactly the index of the
+line by line parser
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import tempfile
+import threading
+
+import pytest
+
+from filament_watch import gcode_index
+from filament_watch.gcode_index import index_file
+from gcode_corpus import corpus, index_result, line_index, scanned_index
+
+CORPUS = corpus()
+
+def numpy_options():
+    '''Scan with NumPy, if installed, and without it'''
+    return [True, False] if gcode_index.numpy is not None else [False]
+
+@pytest.mark.parametrize('name', sorted(CORPUS))
+@pytest.mark.parametrize('use_numpy', numpy_options())
+@pytest.mark.parametrize('chunk_size,scan_size', [(64 * 1024, None), (1000, 4096), (7, 50)])
+def test_scanner_matches_line_parser(name, use_numpy, chunk_size, scan_size):
+    '''However the file arrives, feed gives the same offsets and totals, or
+    the same error, as parsing every line'''
+    gcode = CORPUS[name]
+    expected = index_result(line_index, gcode)
+    assert index_result(scanned_index, gcode, use_numpy, chunk_size, scan_size) == expected
+
+@pytest.mark.parametrize('name', sorted(CORPUS))
+@pytest.mark.parametrize('processes,chunk_size', [(1, 16 * 1024 * 1024), (3, 64 * 1024)])
+def test_index_file_matches_line_parser(name, processes, chunk_size):
+    '''Indexing a file on disk in chunks across processes gives the same
+    result as parsing every line'''
+    gcode = CORPUS[name]
+    with tempfile.NamedTemporaryFile(suffix='.gcode') as gcode_file:
+        gcode_file.write(gcode)
+        gcode_file.flush()
+        assert index_result(index_file, gcode_file.name, processes, chunk_size) == index_result(line_index, gcode)
+
+class CancelAfter(object):
+    '''Cancel event that is set once it has been checked checks times'''
+    def __init__(self, checks):
+        self.checks = checks
+
+    def is_set(self):
+        '''Count a check'''
+        self.checks -= 1
+        return self.checks < 0
+
+@pytest.mark.parametrize('processes', [1, 3])
+@pytest.mark.parametrize('checks', [0, 2])
+def test_index_file_cancelled(processes, checks):
+    '''Cancelling stops indexing between chunks and returns None'''
+    with tempfile.NamedTemporaryFile(suffix='.gcode') as gcode_file:
+        gcode_file.write(CORPUS['synthetic'])
+        gcode_file.flush()
+        cancelled = CancelAfter(checks)
+        assert index_file(gcode_file.name, processes, 16 * 1024, cancelled) is None
+        assert cancelled.checks == -1
+        assert index_file(gcode_file.name, processes, 16 * 1024, threading.Event()) is not None
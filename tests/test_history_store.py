@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_history_store.py
+
+History rollups and the downsampling of chart series
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import math
+import random
+
+import pytest
+
+from filament_watch.downsample import lttb, min_max
+from filament_watch.history_store import HistoryStore
+
+def detection(timestamp, gcode, actual, printing=True):
+    '''A detector result'''
+    stat = {'printing': printing, 'file_name': 'part.gcode', 'gcode_change': gcode, 'file_pos': 0}
+    return {'time': timestamp, 'stat': stat, 'pos': 0, 'meas_change_norm': actual, 'alarm': False}
+
+def wave(count, start=0.0, seed=1):
+    '''count (time, value) points one second apart, with noise'''
+    rng = random.Random(seed)
+    return [(start + i, math.sin(i / 50.0) + rng.uniform(-0.1, 0.1)) for i in range(count)]
+
+def fill_store(path, points, batch_size=97):
+    '''A store holding one printer's results at points, with actual equal
+    to twice the G-code change'''
+    store = HistoryStore(path, retention_days=0, batch_interval=0.01, batch_size=batch_size).start()
+    for timestamp, value in points:
+        store.add('left', detection(timestamp, value, 2 * value))
+    store.stop()
+    return store
+
+def rollups_from_samples(store, level):
+    '''Rollup rows of one level computed directly from the samples'''
+    return store.connect().execute('''SELECT bucket, COUNT(*), SUM(gcode), MIN(gcode), MAX(gcode),
+                                             SUM(actual), MIN(actual), MAX(actual)
+                                      FROM (SELECT CAST(time / ? AS INTEGER) * ? AS bucket, gcode, actual
+                                            FROM samples)
+                                      GROUP BY bucket ORDER BY bucket''', (level, level)).fetchall()
+
+def stored_rollups(store, level):
+    '''Rollup rows of one level as stored'''
+    return store.connect().execute('''SELECT bucket, count, gcode_sum, gcode_min, gcode_max,
+                                             actual_sum, actual_min, actual_max
+                                      FROM rollups WHERE level = ? ORDER BY bucket''', (level,)).fetchall()
+
+def check_rollups(store):
+    '''Every rollup level matches the samples'''
+    for level in store.rollup_levels:
+        expected = rollups_from_samples(store, level)
+        actual = stored_rollups(store, level)
+        assert [row[:2] for row in actual] == [row[:2] for row in expected]
+        for row, expected_row in zip(actual, expected):
+            assert row[2:] == pytest.approx(expected_row[2:])
+
+def test_rollups_match_samples(tmp_path):
+    '''Rollups merged over many batches match aggregating the samples'''
+    check_rollups(fill_store(str(tmp_path / 'history.db'), wave(5000, 1000000.0)))
+
+def test_rollups_backfilled(tmp_path):
+    '''A database written without rollups is rolled up on start'''
+    path = str(tmp_path / 'history.db')
+    store = fill_store(path, wave(3000, 1000000.0))
+    with store.connect() as conn:
+        conn.execute('DELETE FROM rollups')
+    store = HistoryStore(path, retention_days=0).start()
+    store.stop()
+    check_rollups(store)
+
+@pytest.mark.parametrize('method', ['lttb', 'minmax'])
+def test_series_bounded(tmp_path, method):
+    '''A long range is served from the rollups in about the points asked
+    for, keeping a spike with min/max'''
+    points = wave(20000, 1000000.0)
+    points[12345] = (points[12345][0], 50.0)
+    store = fill_store(str(tmp_path / 'history.db'), points, batch_size=1000)
+    gcode, actual = store.series('left', 200, method, start=points[0][0], end=points[-1][0])
+    assert 0 < len(gcode) <= 200
+    assert len(actual) == len(gcode)
+    assert [point[0] for point in gcode] == sorted(point[0] for point in gcode)
+    if method == 'minmax':
+        assert (points[12345][0], 50.0) in gcode
+
+def test_lttb_small_inputs():
+    '''Nothing to pick from, or fewer points than asked for, returns the
+    input; fewer than three points asked for keeps the ends'''
+    points = wave(10)
+    assert lttb([], 5) == []
+    assert lttb(points[:1], 5) == points[:1]
+    assert lttb(points, 10) == points
+    assert lttb(points, 50) == points
+    assert lttb(points, 2) == [points[0], points[-1]]
+    assert lttb(points, 1) == [points[0]]
+    assert lttb(points, 0) == []
+
+@pytest.mark.parametrize('count', [4, 5, 11, 100, 1001])
+@pytest.mark.parametrize('threshold', [3, 4, 10, 99])
+def test_lttb_keeps_ends(count, threshold):
+    '''The first and last points are kept, exactly threshold points are
+    returned, and they are a subset of the input in time order'''
+    points = wave(count)
+    sampled = lttb(points, threshold)
+    assert len(sampled) == min(threshold, count)
+    assert sampled[0] == points[0]
+    assert sampled[-1] == points[-1]
+    assert [point[0] for point in sampled] == sorted(set(point[0] for point in sampled))
+    assert set(sampled) <= set(points)
+
+def test_lttb_keeps_spike():
+    '''A lone spike in a flat line is kept'''
+    points = [(float(i), 0.0) for i in range(1000)]
+    points[567] = (567.0, 10.0)
+    assert (567.0, 10.0) in lttb(points, 20)
+
+def test_min_max_small_inputs():
+    '''No points gives none, a lone point is kept'''
+    assert min_max([], 0.0, 10.0, 10) == []
+    assert min_max([(5.0, 1.0)], 0.0, 10.0, 10) == [(5.0, 1.0)]
+    assert min_max([(5.0, 1.0)], 5.0, 5.0, 10) == [(5.0, 1.0)]
+
+@pytest.mark.parametrize('count', [1, 2, 10, 1000])
+@pytest.mark.parametrize('threshold', [1, 2, 3, 10, 100])
+def test_min_max_bounded(count, threshold):
+    '''At most two points per bucket are returned, in time order, and the
+    extremes of the whole series are among them'''
+    points = wave(count)
+    sampled = min_max(points, points[0][0], points[-1][0], threshold)
+    assert len(sampled) <= 2 * max(1, threshold // 2)
+    assert len(sampled) <= max(threshold, 2)
+    assert [point[0] for point in sampled] == sorted(set(point[0] for point in sampled))
+    assert set(sampled) <= set(points)
+    assert min(points, key=lambda point: point[1]) in sampled
+    assert max(points, key=lambda point: point[1]) in sampled
+
+def test_min_max_outside_range():
+    '''Points outside start..end fall into the first and last buckets'''
+    points = [(-5.0, 3.0), (5.0, 0.0), (15.0, -3.0)]
+    assert min_max(points, 0.0, 10.0, 4) == points
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_microcontroller_if.py
+
+Decoding encoder samples in the binary and text protocols
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import binascii
+import struct
+import time
+
+import pytest
+
+from filament_watch import microcontroller_if
+from filament_watch.metrics import Counters
+from filament_watch.microcontroller_if import ArduinoInterface, FrameDecoder, SerialReader
+
+def frame(seq, timestamp, pos):
+    '''Encode a sample as the firmware does'''
+    body = struct.pack('<HIi', seq & 0xffff, timestamp & 0xffffffff, pos)
+    return b'\xa5\x5a' + body + struct.pack('<H', binascii.crc_hqx(body, 0xffff))
+
+SAMPLES = [(seq, seq * 100000, seq * 7 - 50) for seq in range(20)]
+STREAM = b''.join(frame(*sample) for sample in SAMPLES)
+
+@pytest.mark.parametrize('split', [1, 2, 13, 14, 15, 1000])
+def test_split_frames(split):
+    '''Frames are decoded however the bytes arrive'''
+    decoder = FrameDecoder()
+    frames = []
+    for pos in range(0, len(STREAM), split):
+        frames += decoder.feed(STREAM[pos:pos + split])
+    assert frames == SAMPLES
+    assert decoder.crc_errors == 0
+    assert decoder.skipped_bytes == 0
+
+def test_resync_after_garbage():
+    '''Bytes between frames, including false sync sequences, are skipped'''
+    decoder = FrameDecoder()
+    garbage = b'12345\r\n\xa5\x5a\x00\xa5'
+    frames = decoder.feed(garbage + frame(*SAMPLES[0]) + garbage + frame(*SAMPLES[1]))
+    assert frames == SAMPLES[:2]
+    assert decoder.skipped_bytes == 2 * len(garbage)
+
+def test_corrupted_frame_dropped():
+    '''A frame failing the CRC is dropped and the next one decoded'''
+    decoder = FrameDecoder()
+    corrupted = bytearray(frame(*SAMPLES[1]))
+    corrupted[9] ^= 0x10
+    frames = decoder.feed(frame(*SAMPLES[0]) + bytes(corrupted) + frame(*SAMPLES[2]))
+    assert frames == [SAMPLES[0], SAMPLES[2]]
+    assert decoder.crc_errors >= 1
+
+def test_truncated_frame_dropped():
+    '''A frame cut short by a dropped byte is dropped'''
+    decoder = FrameDecoder()
+    truncated = frame(*SAMPLES[1])[:-3]
+    frames = []
+    for data in (frame(*SAMPLES[0]), truncated, frame(*SAMPLES[2]), frame(*SAMPLES[3])):
+        frames += decoder.feed(data)
+    assert frames == [SAMPLES[0], SAMPLES[2], SAMPLES[3]]
+
+class FakePort(object):
+    '''Serial port of a board that sends nothing'''
+    in_waiting = 0
+
+    def __init__(self, dev, baudrate, timeout): # pylint: disable=unused-argument
+        self.timeout = timeout
+        self.written = b''
+
+    def write(self, data):
+        '''Record data sent to the board'''
+        self.written += data
+
+    def read(self, size): # pylint: disable=unused-argument
+        '''Wait out the timeout'''
+        time.sleep(0.01)
+        return b''
+
+    def close(self):
+        '''Nothing to close'''
+        pass
+
+@pytest.fixture
+def encoder(monkeypatch):
+    '''ArduinoInterface using the text protocol on a fake port'''
+    monkeypatch.setattr(microcontroller_if.serial, 'Serial', FakePort)
+    interface = ArduinoInterface('/dev/null', 115200, 10)
+    yield interface
+    interface.stop()
+
+def test_text_mode_requested(encoder):
+    '''Firmware left sending binary frames is switched back to text'''
+    assert b'\nASCII\n' in encoder.port.written
+
+def test_text_wraparound(encoder):
+    '''The 16-bit text position is unwrapped in both directions'''
+    positions = [encoder.add_text_sample(pos) for pos in (32000, 32767, -32768, -32000, 32000, 100)]
+    assert positions == [32000, 32767, 32768, 33536, 32000, 100]
+
+def test_lost_frames_interpolated(encoder):
+    '''Lost samples are filled in on a line between their neighbours'''
+    encoder.sample_rate = 10
+    for seq, pos in ((0, 0), (1, 10), (4, 70), (5, 80)):
+        encoder.add_frame(seq, seq * 100000, pos)
+    assert [encoder.recent_pos.value(ago) for ago in range(5, -1, -1)] == [0, 10, 30, 50, 70, 80]
+    assert encoder.recent_pos.timestamp(0) == pytest.approx(0.5)
+    assert encoder.counters.snapshot()['lost'] == 2
+
+def test_sequence_wraparound(encoder):
+    '''The 16-bit sequence number and 32-bit timestamp wrap without a gap'''
+    encoder.sample_rate = 10
+    encoder.add_frame(0xffff, 2 ** 32 - 50000, 0)
+    encoder.add_frame(0, 50000, 10)
+    assert encoder.recent_pos.latest() == 10
+    assert encoder.recent_pos.timestamp(0) == pytest.approx(0.1)
+    assert 'lost' not in encoder.counters.snapshot()
+
+def test_text_before_first_position_skipped(caplog):
+    '''Binary frames and acknowledgements before the first position line
+    are skipped without errors, and positions after it decoded'''
+    reader = SerialReader(None, False, Counters(), 10)
+    reader.decode_lines(frame(*SAMPLES[0]) + b'\r\nASCII\r\n12', 1.0)
+    reader.decode_lines(b'3\r\n-5\r\n', 2.0)
+    assert reader.get(0) == [(2.0, None, None, 123), (2.0, None, None, -5)]
+    assert not [record for record in caplog.records if record.levelname == 'ERROR']
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_octoprint_ctl.py
+
+Building the extrusion index of the file being printed, and deciding
+whether a status counts as printing
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import io
+import json
+import os
+
+import pytest
+import requests
+
+from filament_watch.gcode_cache import GcodeIndexCache
+from filament_watch.octoprint_ctl import GcodeIndexJob, OctoPrintAccess, print_in_progress
+
+GCODE = b'G92 E0\nG1 X1 E1.5\nG1 X2 E3\n' * 100
+DOWNLOAD_URL = 'http://octoprint/downloads/files/local/part.gcode'
+
+class FakeSession(object):
+    '''Answers requests from a table of url: (status code, body)'''
+    def __init__(self, replies):
+        self.replies = replies
+        self.urls = []
+
+    def request(self, method, url, **kwargs): # pylint: disable=unused-argument
+        '''Return the canned reply for url'''
+        self.urls.append(url)
+        status_code, body = self.replies[url]
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = url
+        response.raw = io.BytesIO(body)
+        return response
+
+def file_json(size=len(GCODE)):
+    '''OctoPrint's description of the file'''
+    return {'name': 'part.gcode', 'path': 'part.gcode', 'origin': 'local', 'size': size,
+            'date': 1, 'refs': {'download': DOWNLOAD_URL}}
+
+def replies(download=(200, GCODE), files=None):
+    '''Replies of a healthy OctoPrint, with any overridden'''
+    return {
+        'http://octoprint/api/files/local/part.gcode': files or (200, json.dumps(file_json()).encode('utf-8')),
+        DOWNLOAD_URL: download,
+    }
+
+def build(session, cache_dir, uploads_dir=None, cancel=False):
+    '''Index the file, as the indexing thread does'''
+    octoprint = OctoPrintAccess('octoprint', 'key', 10, index_cache=GcodeIndexCache(cache_dir, 1024 * 1024),
+                                session=session, uploads_dir=uploads_dir)
+    job = GcodeIndexJob(octoprint, 'part.gcode')
+    if cancel:
+        job.cancel()
+    return octoprint.build_index('part.gcode', job)
+
+def test_download_is_indexed_and_cached(tmp_path):
+    '''A good download is indexed and saved in the cache'''
+    index = build(FakeSession(replies()), str(tmp_path))
+    assert index.total() == pytest.approx(300.0)
+    session = FakeSession(replies(download=(503, b'')))
+    assert build(session, str(tmp_path)).total() == pytest.approx(300.0)
+    assert DOWNLOAD_URL not in session.urls
+
+@pytest.mark.parametrize('download', [(503, b'Service Unavailable'), (403, b'Forbidden'), (200, GCODE[:-100])])
+def test_failed_download_is_not_cached(tmp_path, download):
+    '''An error page or a truncated download raises instead of indexing,
+    and leaves nothing in the cache'''
+    with pytest.raises((requests.exceptions.HTTPError, ValueError)):
+        build(FakeSession(replies(download=download)), str(tmp_path))
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.idx')]
+    assert build(FakeSession(replies()), str(tmp_path)).total() == pytest.approx(300.0)
+
+def test_local_file_indexed(tmp_path):
+    '''A file in the local uploads folder is indexed without downloading it'''
+    (tmp_path / 'part.gcode').write_bytes(GCODE)
+    session = FakeSession(replies(download=(503, b'')))
+    assert build(session, str(tmp_path / 'cache'), str(tmp_path)).total() == pytest.approx(300.0)
+    assert DOWNLOAD_URL not in session.urls
+
+@pytest.mark.parametrize('local', [False, True])
+def test_cancelled(tmp_path, local):
+    '''A cancelled job indexes nothing, downloads nothing and caches
+    nothing'''
+    (tmp_path / 'part.gcode').write_bytes(GCODE)
+    session = FakeSession(replies())
+    cache_dir = tmp_path / 'cache'
+    assert build(session, str(cache_dir), str(tmp_path) if local else None, cancel=True) is None
+    assert not os.listdir(str(cache_dir))
+    if local:
+        assert DOWNLOAD_URL not in session.urls
+
+def test_file_info_error(tmp_path):
+    '''An error from the files API raises rather than being parsed'''
+    with pytest.raises(requests.exceptions.HTTPError):
+        build(FakeSession(replies(files=(502, b'Bad Gateway'))), str(tmp_path))
+
+@pytest.mark.parametrize('summary,tool0_target,gcode_filament_pos,printing', [
+    ('Printing part.gcode - 50%', 210.0, 12.5, True),
+    ('Printing part.gcode - 0%', 210.0, 0, False),
+    ('Printing part.gcode - 50%', 0, 12.5, False),
+    ('Indexing part.gcode - 50%', 210.0, -1, False),
+    ('Heating Hotend', 210.0, 12.5, False),
+    (None, 210.0, 12.5, False),
+])
+def test_print_in_progress(summary, tool0_target, gcode_filament_pos, printing):
+    '''Only a print with a hot end target and some G-code filament counts'''
+    assert print_in_progress(summary, tool0_target, gcode_filament_pos) == printing
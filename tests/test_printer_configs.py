@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_printer_configs.py
+
+Splitting the configuration file into the settings of each printer
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import pytest
+
+from filament_watch.filament_watch import get_printer_configs
+
+def farm_config(printers, **settings):
+    '''A configuration file monitoring the specified printers'''
+    config = {'dev': '/dev/ttyACM0', 'csvlog': None, 'apikey': 'key', 'printers': printers}
+    config.update(settings)
+    return config
+
+def test_single_printer():
+    '''Without a printers list the top level settings are the only printer'''
+    printers = get_printer_configs({'dev': '/dev/ttyACM0', 'csvlog': '/tmp/filament.csv'})
+    assert [(printer['name'], printer['csvlog']) for printer in printers] == [(None, '/tmp/filament.csv')]
+
+def test_csvlog_split_per_printer():
+    '''A top level CSV log gets the printer name, an explicit one is kept'''
+    printers = get_printer_configs(farm_config([
+        {'name': 'left', 'dev': '/dev/ttyACM0'},
+        {'name': 'right', 'dev': '/dev/ttyACM1'},
+        {'name': 'spare', 'dev': '/dev/ttyACM2', 'csvlog': '/tmp/spare.log'},
+    ], csvlog='/tmp/filament.csv'))
+    assert [printer['csvlog'] for printer in printers] == [
+        '/tmp/filament.left.csv', '/tmp/filament.right.csv', '/tmp/spare.log']
+
+@pytest.mark.parametrize('printers', [
+    [{'name': 'left'}, {'name': 'right'}],
+    [{'name': 'left', 'dev': '/dev/ttyACM0'}, {'name': 'right', 'dev': '/dev/ttyACM1', 'csvlog': '/tmp/a.csv'},
+     {'name': 'spare', 'dev': '/dev/ttyACM2', 'csvlog': '/tmp/a.csv'}],
+    [{'name': 'left'}, {'name': 'left', 'dev': '/dev/ttyACM1'}],
+])
+def test_shared_settings_rejected(printers):
+    '''Two printers may not share a name, an encoder or a CSV log'''
+    with pytest.raises(ValueError):
+        get_printer_configs(farm_config(printers))
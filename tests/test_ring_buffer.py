@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_ring_buffer.py
+
+TimeSeriesRing answers exactly as the lists it replaced
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import random
+
+import pytest
+
+from filament_watch.octoprint_ctl import GcodeWindow
+from filament_watch.ring_buffer import TimeSeriesRing
+
+class ListWindow(object):
+    '''The list based window TimeSeriesRing replaced: append, then drop the
+    oldest sample once over capacity'''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = []
+        self.values = []
+
+    def append(self, value, timestamp):
+        '''Add a sample'''
+        self.times.append(timestamp)
+        self.values.append(value)
+        if len(self.values) > self.capacity:
+            self.times.pop(0)
+            self.values.pop(0)
+
+    def fill(self, value, timestamp):
+        '''Replace the contents with capacity copies of one sample'''
+        self.times = [timestamp] * self.capacity
+        self.values = [value] * self.capacity
+
+    def delta(self, window):
+        '''Latest value minus the first of the last window values'''
+        return self.values[-1] - self.values[-window:][0]
+
+    def rate(self, window):
+        '''Average change per sample'''
+        return self.delta(window) / float(window)
+
+    def duration(self, window):
+        '''Time spanned by the last window samples'''
+        return self.times[-1] - self.times[-window:][0]
+
+def check_windows(ring, expected):
+    '''Every query on ring matches the list, for windows from one sample to
+    longer than the history'''
+    assert len(ring) == len(expected.values)
+    assert ring.latest() == expected.values[-1]
+    for ago in range(len(ring)):
+        assert ring.value(ago) == expected.values[-1 - ago]
+        assert ring.timestamp(ago) == expected.times[-1 - ago]
+    for window in range(1, ring.capacity + 5):
+        assert ring.delta(window) == expected.delta(window)
+        assert ring.rate(window) == expected.rate(window)
+        assert ring.duration(window) == expected.duration(window)
+
+@pytest.mark.parametrize('capacity', [1, 2, 7, 120])
+@pytest.mark.parametrize('prefill', [False, True])
+def test_matches_list(capacity, prefill):
+    '''Random samples give the same answers as the list, while filling up
+    and after wrapping around'''
+    rng = random.Random(capacity)
+    ring = TimeSeriesRing(capacity)
+    expected = ListWindow(capacity)
+    if prefill:
+        ring.fill(5.0, 1.0)
+        expected.fill(5.0, 1.0)
+        check_windows(ring, expected)
+    for i in range(3 * capacity + 5):
+        value = rng.choice([rng.uniform(-1e6, 1e6), float(rng.randint(-70000, 70000)), 0.1 * i])
+        ring.append(value, 2.0 + i * 0.25)
+        expected.append(value, 2.0 + i * 0.25)
+        check_windows(ring, expected)
+
+def test_empty():
+    '''An empty ring has nothing to report'''
+    ring = TimeSeriesRing(3)
+    for query in (ring.latest, lambda: ring.delta(1), lambda: ring.duration(1)):
+        with pytest.raises(IndexError):
+            query()
+    ring.append(1.0, 0.0)
+    ring.clear()
+    assert len(ring) == 0
+    with pytest.raises(IndexError):
+        ring.latest()
+    with pytest.raises(ValueError):
+        TimeSeriesRing(0)
+
+def test_gcode_window_matches_list():
+    '''GcodeWindow reports the change the status poll computed from a list
+    of G-code positions'''
+    rng = random.Random(1)
+    recent_length = 5
+    window = GcodeWindow(recent_length)
+    recent_gcode_pos = None
+    pos = 0.0
+    for _ in range(40):
+        pos += rng.choice([0.0, 0.5, rng.random() * 10])
+        if recent_gcode_pos is None:
+            recent_gcode_pos = [pos] * recent_length
+        recent_gcode_pos.append(pos)
+        recent_gcode_pos.pop(0)
+        expected = (recent_gcode_pos[-1] - recent_gcode_pos[0]) / len(recent_gcode_pos)
+        assert window.update(pos) == expected
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sinks.py
+
+Rotating the CSV log
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import os
+
+from filament_watch.sinks import CsvSink
+
+def detection(timestamp):
+    '''A detector result while printing'''
+    stat = {'printing': True, 'gcode_change': 1.0, 'summary': 'Printing', 'state': 'Printing',
+            'file_name': 'part.gcode', 'file_pos': 100, 'file_size': 1000, 'gcode_filament_pos': 10.0,
+            'gcode_filament_total': 100.0, 'bed_target': 60, 'bed_actual': 60, 'tool0_target': 210,
+            'tool0_actual': 210}
+    return {'time': timestamp, 'stat': stat, 'alarm': False, 'valid': True, 'pos': 5.0,
+            'meas_change_raw': 1, 'meas_change_norm': 1.0}
+
+def rows(path):
+    '''Data rows in a CSV log'''
+    with open(path) as csv_file:
+        return csv_file.read().splitlines()[1:]
+
+def test_rotate_by_size(tmp_path):
+    '''A full log is renamed and a new one started with a header'''
+    path = str(tmp_path / 'filament.csv')
+    sink = CsvSink(path, flush_interval=0, max_bytes=500, backups=2)
+    for i in range(10):
+        sink.update(detection(1000000 + i))
+    sink.close()
+    assert len(rows(path)) < 10
+    assert [name for name in os.listdir(str(tmp_path)) if name.endswith('.gz')]
+
+def test_rename_failure_keeps_logging(tmp_path, monkeypatch):
+    '''If the log can't be renamed, rows keep going to the current file'''
+    path = str(tmp_path / 'filament.csv')
+    sink = CsvSink(path, flush_interval=0, max_bytes=500)
+    def fail_rename(src, dst): # pylint: disable=unused-argument
+        raise PermissionError(13, 'Permission denied', src)
+    monkeypatch.setattr(os, 'rename', fail_rename)
+    for i in range(10):
+        sink.update(detection(1000000 + i))
+    sink.close()
+    assert len(rows(path)) == 10
+
+def test_log_removed_before_rotation(tmp_path):
+    '''A log deleted from under the sink is started again at rotation'''
+    path = str(tmp_path / 'filament.csv')
+    sink = CsvSink(path, flush_interval=0, max_bytes=500)
+    sink.update(detection(1000000))
+    os.remove(path)
+    for i in range(1, 10):
+        sink.update(detection(1000000 + i))
+    sink.close()
+    assert rows(path)
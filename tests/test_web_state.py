@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_web_state.py
+
+Published dashboard state is never read torn while it is being updated,
+and event streams are limited
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import gc
+import threading
+import time
+
+import cherrypy
+
+from filament_watch.web_server import WebGen
+from web_state_reader import reader
+
+def test_no_torn_reads():
+    '''Readers polling while the state is published see consistent replies'''
+    history_length = 120
+    webgen = WebGen(history_length, 5)
+    stop = threading.Event()
+    results = []
+    threads = [threading.Thread(target=reader, args=(webgen, history_length, stop, results))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+
+    seq = 0
+    log_seq = 0
+    end = time.time() + 1.0
+    try:
+        while time.time() < end:
+            seq += 1
+            webgen.update({'filament_pos': seq}, [seq, 1.0], [seq, 2.0])
+            if seq % 7 == 0:
+                log_seq += 1
+                webgen.add_log('%d log message' % (log_seq))
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    assert sum(result[0] for result in results) > 0
+    errors = [error for result in results for error in result[1]]
+    assert not errors, '%d inconsistent reads, e.g. %s' % (len(errors), errors[0])
+
+def test_stream_limit():
+    '''Streams beyond the limit are refused with 503, and a stream gives
+    its slot back however it ends'''
+    webgen = WebGen(10, 5, streams=threading.BoundedSemaphore(2))
+    first = webgen.gen_stream()
+    second = webgen.gen_stream()
+    assert next(first) == next(second) == b'retry: 1000\n\n'
+    assert webgen.gen_stream() == b''
+    assert cherrypy.response.status == 503
+    first.close()
+    third = webgen.gen_stream()
+    assert webgen.gen_stream() == b''
+    # A stream dropped without being read, or closed part way through
+    del third
+    gc.collect()
+    webgen.update({'filament_pos': 1}, [1, 1.0], [1, 2.0])
+    assert next(second).startswith(b'id: 1:0\n')
+    second.close()
+    streams = [webgen.gen_stream() for _ in range(2)]
+    assert all(stream != b'' for stream in streams)
+    assert webgen.gen_stream() == b''
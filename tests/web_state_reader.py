@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+web_state_reader.py
+
+A dashboard-like reader of the published web state that checks every reply
+for torn reads
+"""
+
+##############################################################################
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Richard L. Lynch <rich@richlynch.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+#
+##############################################################################
+
+import json
+
+def check_reply(reply, since, log_since, history_length):
+    '''Raise AssertionError unless the reply is internally consistent'''
+    seq = reply['seq']
+    # The writer stamps each state and point with its sequence number
+    assert reply.get('filament_pos', 0) == seq, 'state from a different publish than seq'
+    gcode = reply['gcode_points']
+    actual = reply['actual_points']
+    assert len(gcode) == len(actual), 'series lengths differ'
+    assert len(gcode) <= history_length, 'history too long'
+    if gcode:
+        assert gcode[-1][0] == seq, 'last point does not match seq'
+        assert [point[0] for point in gcode] == list(range(seq - len(gcode) + 1, seq + 1)), 'points not contiguous'
+        assert [point[0] for point in actual] == [point[0] for point in gcode], 'series out of step'
+    if not reply['reset']:
+        assert len(gcode) == seq - since, 'delta missing points'
+    log_seq = reply['log_seq']
+    log_ids = [int(msg.split(' ')[0]) for msg in reply['log_msgs']]
+    if log_ids:
+        assert log_ids == list(range(log_seq - len(log_ids) + 1, log_seq + 1)), 'log messages not contiguous'
+    if not reply['log_reset']:
+        assert len(log_ids) == log_seq - log_since, 'delta missing log messages'
+
+def reader(webgen, history_length, stop, results):
+    '''Poll like a dashboard, sometimes falling behind or starting over'''
+    since = None
+    log_since = None
+    reads = 0
+    errors = []
+    while not stop.is_set():
+        snapshot = webgen.snapshot
+        reply = json.loads(snapshot.encoded(since, log_since).decode('utf-8'))
+        try:
+            check_reply(reply, since, log_since, history_length)
+        except (AssertionError, KeyError, ValueError) as exc:
+            errors.append('%s: %s' % (type(exc).__name__, exc))
+        reads += 1
+        if reads % 97 == 0:
+            since, log_since = None, None
+        elif reads % 13 == 0:
+            # Pretend to have fallen behind
+            since, log_since = max(0, reply['seq'] - 50), max(0, reply['log_seq'] - 3)
+        else:
+            since, log_since = reply['seq'], reply['log_seq']
+    results.append((reads, errors))